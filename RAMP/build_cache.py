@@ -0,0 +1,194 @@
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+from contextlib import contextmanager
+from typing import Any, Dict, Iterable, Iterator, Optional  # noqa: F401
+
+from RAMP.cache import DiskCache
+from RAMP.common import default_file_mode
+from RAMP.version import VERSION
+
+try:
+    import fcntl
+except ImportError:
+    # no file locks on windows: concurrent packs may then lose a counter update, never corrupt the stats
+    fcntl = None
+
+# Bump when the way bundles are produced from the same inputs changes
+BUILD_CACHE_VERSION = 1
+
+# Sub directory of the RAMP cache dir and its default size limit
+BUILD_CACHE_NAME = 'builds'
+BUILD_CACHE_MAX_BYTES = 1024 * 1024 * 1024
+
+STATS_FILE = '.stats.json'
+STATS_LOCK_FILE = '.stats.lock'
+
+
+@contextmanager
+def _locked(path):
+    # type: (str) -> Iterator[None]
+    """
+    Holds an exclusive lock on path (created if needed) while the block runs, across processes.
+    """
+    with open(path, 'a') as f:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        yield
+
+
+def _tree_digest(path, sha256):
+    # type: (str, Any) -> None
+    """
+    Feeds the names, modes and contents of the files under path into sha256.
+    """
+    if not os.path.isdir(path):
+        with open(path, 'rb') as f:
+            sha256.update(b'%o\0' % os.stat(path).st_mode)
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                sha256.update(block)
+        return
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            file_path = os.path.join(root, name)
+            sha256.update(os.path.relpath(file_path, path).encode('utf-8') + b'\0')
+            _tree_digest(file_path, sha256)
+
+
+def build_key(metadata, output, local_paths, git_sha, redis_version, source_date_epoch=None):
+    # type: (Dict[str, Any], str, Iterable[str], Optional[str], Optional[int], Optional[int]) -> str
+    """
+    Returns a digest of everything a bundle is produced from: the metadata gathered from
+    defaults, manifest and arguments (module sha256 included), the output name template,
+    the names and contents of the dependencies embedded from local paths (not where they are),
+    the git sha, the redis version used for discovery, $SOURCE_DATE_EPOCH and the RAMP version.
+    """
+    sha256 = hashlib.sha256()
+    sha256.update(json.dumps({
+        "format": BUILD_CACHE_VERSION,
+        "ramp": VERSION,
+        "metadata": metadata,
+        "output": output,
+        "git_sha": git_sha,
+        "redis_version": redis_version,
+        "source_date_epoch": source_date_epoch,
+    }, sort_keys=True, default=str).encode('utf-8'))
+    for local_path in local_paths:
+        sha256.update(b'\0dependency\0' + os.path.basename(local_path).encode('utf-8') + b'\0')
+        _tree_digest(local_path, sha256)
+    return sha256.hexdigest()
+
+
+class BuildCache(DiskCache):
+    def __init__(self, max_bytes=BUILD_CACHE_MAX_BYTES):
+        # type: (int) -> None
+        """
+        Bundles produced by `ramp pack --build-cache`, keyed by build_key.
+        Each entry is a read only copy <key>.zip of the bundle, with its <key>.json holding the package name.
+        """
+        super(BuildCache, self).__init__(BUILD_CACHE_NAME, max_bytes)
+
+    def lookup(self, key):
+        # type: (str) -> Optional[str]
+        """
+        Returns the package name of a cached bundle, or None. Counts a hit or a miss.
+        """
+        entry = self.get_json(key)
+        packname = entry.get('packname') if isinstance(entry, dict) else None
+        if packname is not None and os.path.exists(self.entry_path(key, '.zip')):
+            self.touch(self.entry_path(key, '.zip'))
+            self._count('hits')
+            return packname
+        self._count('misses')
+        return None
+
+    def restore(self, key, path):
+        # type: (str, str) -> None
+        """
+        Puts a copy of the cached bundle at path, with the mode a freshly built bundle gets,
+        so it can be modified or replaced like one without touching the cache.
+        """
+        cached = self.entry_path(key, '.zip')
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(path))
+        os.close(fd)
+        try:
+            shutil.copyfile(cached, tmp_path)
+            os.chmod(tmp_path, default_file_mode())
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    def store(self, key, path, packname):
+        # type: (str, str, str) -> bool
+        """
+        Adds a copy of a freshly produced bundle to the cache, returns False if the cache couldn't be written.
+        Cached bundles are made read only, they are only ever copied out.
+        """
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=self.path, prefix='.' + key)
+            os.close(fd)
+            try:
+                shutil.copyfile(path, tmp_path)
+                os.chmod(tmp_path, 0o444)
+                os.replace(tmp_path, self.entry_path(key, '.zip'))
+            except BaseException:
+                os.remove(tmp_path)
+                raise
+        except (IOError, OSError):
+            return False
+        return self.put_json(key, {'packname': packname})
+
+    def _count(self, counter):
+        # type: (str) -> None
+        """
+        Increments a counter of the stats file. Concurrent packs (e.g. pack-many workers) serialize on a lock
+        file, and the stats are replaced atomically, so readers never see a partly written file.
+        """
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            with _locked(os.path.join(self.path, STATS_LOCK_FILE)):
+                stats = self.stats()
+                stats[counter] = stats.get(counter, 0) + 1
+                fd, tmp_path = tempfile.mkstemp(dir=self.path, prefix=STATS_FILE)
+                try:
+                    with os.fdopen(fd, 'w') as f:
+                        json.dump({'hits': stats['hits'], 'misses': stats['misses']}, f)
+                    os.replace(tmp_path, os.path.join(self.path, STATS_FILE))
+                except BaseException:
+                    os.remove(tmp_path)
+                    raise
+        except (IOError, OSError):
+            pass
+
+    def stats(self):
+        # type: () -> Dict[str, int]
+        """
+        Returns hit and miss counters, the number of cached bundles and their total size.
+        """
+        try:
+            with open(os.path.join(self.path, STATS_FILE)) as f:
+                stats = json.load(f)
+        except (IOError, OSError, ValueError):
+            stats = {}
+        result = {'hits': stats.get('hits', 0), 'misses': stats.get('misses', 0),
+                  'bundles': 0, 'bytes': 0, 'max_bytes': self.max_bytes}
+        try:
+            names = os.listdir(self.path)
+        except OSError:
+            names = []
+        for name in names:
+            if name.startswith('.'):
+                continue
+            try:
+                result['bytes'] += os.path.getsize(os.path.join(self.path, name))
+            except OSError:
+                continue
+            if name.endswith('.zip'):
+                result['bundles'] += 1
+        return result
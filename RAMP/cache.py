@@ -0,0 +1,155 @@
+import os
+import json
+import tempfile
+from typing import Any, Dict, List, Optional  # noqa: F401
+
+# Environment variable overriding the directory RAMP keeps its caches in
+CACHE_DIR_ENVVAR = 'RAMP_CACHE_DIR'
+
+
+def get_cache_dir():
+    # type: () -> str
+    """
+    Returns the directory RAMP keeps its caches in:
+    $RAMP_CACHE_DIR, $XDG_CACHE_HOME/ramp or ~/.cache/ramp
+    """
+    path = os.getenv(CACHE_DIR_ENVVAR)
+    if path:
+        return path
+    base = os.getenv('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'ramp')
+
+
+def load_json(name, default=None):
+    # type: (str, Any) -> Any
+    """
+    Reads a json file from the cache directory, returns `default` if it is missing or unreadable.
+    """
+    try:
+        with open(os.path.join(get_cache_dir(), name), 'r') as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return default
+
+
+def store_json(name, data):
+    # type: (str, Any) -> bool
+    """
+    Atomically writes a json file into the cache directory.
+    Failing to write the cache is not an error, False is returned instead.
+    """
+    cache_dir = get_cache_dir()
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir, prefix='.' + name)
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(data, f)
+            os.replace(tmp_path, os.path.join(cache_dir, name))
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+    except (IOError, OSError):
+        return False
+    return True
+
+
+class DiskCache(object):
+    def __init__(self, name, max_bytes):
+        # type: (str, int) -> None
+        """
+        A directory of cache entries under the RAMP cache dir, bounded in size.
+        Least recently used entries are evicted once the directory grows above `max_bytes`.
+        :param name: sub directory of the cache dir holding the entries
+        :param max_bytes: size limit of all entries together
+        """
+        self.name = name
+        self.max_bytes = max_bytes
+
+    @property
+    def path(self):
+        # type: () -> str
+        return os.path.join(get_cache_dir(), self.name)
+
+    def entry_path(self, key, suffix=''):
+        # type: (str, str) -> str
+        return os.path.join(self.path, key + suffix)
+
+    def touch(self, path):
+        # type: (str) -> None
+        """
+        Marks an entry as recently used.
+        """
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+
+    def get_json(self, key):
+        # type: (str) -> Any
+        """
+        Returns the json value stored under `key` or None.
+        """
+        path = self.entry_path(key, '.json')
+        try:
+            with open(path, 'r') as f:
+                data = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        self.touch(path)
+        return data
+
+    def put_json(self, key, data):
+        # type: (str, Any) -> bool
+        """
+        Stores a json value under `key`, returns False if the cache couldn't be written.
+        """
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=self.path, prefix='.' + key)
+            try:
+                with os.fdopen(fd, 'w') as f:
+                    json.dump(data, f)
+                os.replace(tmp_path, self.entry_path(key, '.json'))
+            except BaseException:
+                os.remove(tmp_path)
+                raise
+        except (IOError, OSError):
+            return False
+        self.evict()
+        return True
+
+    def evict(self):
+        # type: () -> None
+        """
+        Removes least recently used entries until the cache fits in max_bytes.
+        The files of a key (e.g. <key>.json and <key>.zip) are one entry: used as recently as the
+        most recent of them, and removed together, the .json first so the entry is never found half gone.
+        """
+        try:
+            names = os.listdir(self.path)
+        except OSError:
+            return
+        entries = {}  # type: Dict[str, List[Any]]
+        total = 0
+        for name in names:
+            if name.startswith('.'):
+                continue
+            try:
+                st = os.stat(os.path.join(self.path, name))
+            except OSError:
+                continue
+            entry = entries.setdefault(os.path.splitext(name)[0], [0, 0, []])
+            entry[0] = max(entry[0], st.st_mtime)
+            entry[1] += st.st_size
+            entry[2].append(name)
+            total += st.st_size
+        for _, size, files in sorted(entries.values()):
+            if total <= self.max_bytes:
+                break
+            for name in sorted(files, key=lambda name: not name.endswith('.json')):
+                try:
+                    os.remove(os.path.join(self.path, name))
+                except OSError:
+                    pass
+            total -= size
@@ -0,0 +1,202 @@
+import os
+import json
+import sqlite3
+from zipfile import ZipFile, BadZipfile
+from typing import Any, Dict, Iterable, Iterator, List, Optional  # noqa: F401
+
+from RAMP.module_metadata import sha256_checksum
+from .common import *
+
+# Default location of the catalog database
+CATALOG_FILE = 'ramp-index.db'
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS bundles (
+    path TEXT PRIMARY KEY,
+    mtime_ns INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    sha256 TEXT NOT NULL,
+    module_name TEXT,
+    version INTEGER,
+    semantic_version TEXT,
+    os TEXT,
+    architecture TEXT,
+    metadata TEXT
+);
+CREATE TABLE IF NOT EXISTS bundle_os (path TEXT NOT NULL, os TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS bundle_capabilities (path TEXT NOT NULL, capability TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS bundle_commands (path TEXT NOT NULL, command TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS bundles_module ON bundles (module_name, architecture, version);
+CREATE INDEX IF NOT EXISTS bundle_os_os ON bundle_os (os, path);
+CREATE INDEX IF NOT EXISTS bundle_os_path ON bundle_os (path);
+CREATE INDEX IF NOT EXISTS bundle_capabilities_capability ON bundle_capabilities (capability, path);
+CREATE INDEX IF NOT EXISTS bundle_capabilities_path ON bundle_capabilities (path);
+CREATE INDEX IF NOT EXISTS bundle_commands_command ON bundle_commands (command, path);
+CREATE INDEX IF NOT EXISTS bundle_commands_path ON bundle_commands (path);
+"""
+
+_DETAIL_TABLES = ['bundle_os', 'bundle_capabilities', 'bundle_commands']
+
+
+def connect(db_path=CATALOG_FILE):
+    # type: (str) -> sqlite3.Connection
+    """
+    Opens (and creates if needed) a catalog database.
+    """
+    conn = sqlite3.connect(db_path)
+    conn.row_factory = sqlite3.Row
+    conn.executescript(_SCHEMA)
+    return conn
+
+
+def _bundle_paths(paths):
+    # type: (Iterable[str]) -> Iterator[str]
+    """
+    Yields the bundles given directly or found (as *.zip) under the given directories.
+    """
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, files in os.walk(path):
+                for name in sorted(files):
+                    if name.endswith('.zip'):
+                        yield os.path.abspath(os.path.join(root, name))
+        else:
+            yield os.path.abspath(path)
+
+
+def _read_metadata(path):
+    # type: (str) -> Dict[str, Any]
+    with ZipFile(path) as zf:
+        with zf.open('module.json') as f:
+            return json.load(f)
+
+
+def _names(items):
+    # type: (Any) -> List[str]
+    """
+    Capabilities and commands are either plain names or objects carrying one.
+    """
+    names = []
+    for item in items or []:
+        if isinstance(item, dict):
+            item = item.get('name', item.get('command_name'))
+        if item:
+            names.append(str(item))
+    return names
+
+
+def _store(conn, path, st, sha256, metadata):
+    # type: (sqlite3.Connection, str, os.stat_result, str, Dict[str, Any]) -> None
+    try:
+        version = int(float(metadata.get('version')))
+    except (TypeError, ValueError):
+        version = None
+    _delete(conn, path)
+    conn.execute("INSERT INTO bundles VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                 (path, st.st_mtime_ns, st.st_size, sha256, metadata.get('module_name'), version,
+                  metadata.get('semantic_version'), metadata.get('os'), metadata.get('architecture'),
+                  json.dumps(metadata, sort_keys=True)))
+    conn.executemany("INSERT INTO bundle_os VALUES (?, ?)",
+                     [(path, os_name.lower()) for os_name in _names(metadata.get('operating_systems'))])
+    conn.executemany("INSERT INTO bundle_capabilities VALUES (?, ?)",
+                     [(path, cap) for cap in _names(metadata.get('capabilities'))])
+    conn.executemany("INSERT INTO bundle_commands VALUES (?, ?)",
+                     [(path, cmd.lower()) for cmd in _names(metadata.get('commands'))])
+
+
+def _delete(conn, path):
+    # type: (sqlite3.Connection, str) -> None
+    conn.execute("DELETE FROM bundles WHERE path = ?", (path,))
+    for table in _DETAIL_TABLES:
+        conn.execute("DELETE FROM {} WHERE path = ?".format(table), (path,))
+
+
+def index(conn, paths, prune=True):
+    # type: (sqlite3.Connection, Iterable[str], bool) -> Dict[str, int]
+    """
+    Adds bundles to the catalog, or refreshes them.
+    Bundles whose mtime and size didn't change are skipped without being opened,
+    bundles with a new mtime but the same sha256 only get their stat info updated.
+    :param paths: bundles, or directories to search for *.zip bundles
+    :param prune: drop catalog entries of bundles which no longer exist under the given directories
+    Returns counts of added, updated, unchanged, removed and failed bundles.
+    """
+    stats = dict.fromkeys(['added', 'updated', 'unchanged', 'removed', 'failed'], 0)
+    paths = list(paths)
+    seen = set()
+    with conn:
+        for path in _bundle_paths(paths):
+            seen.add(path)
+            try:
+                st = os.stat(path)
+            except OSError as e:
+                eprint("could not index {}: {}".format(path, e))
+                stats['failed'] += 1
+                continue
+
+            row = conn.execute("SELECT mtime_ns, size, sha256 FROM bundles WHERE path = ?", (path,)).fetchone()
+            if row is not None and row['mtime_ns'] == st.st_mtime_ns and row['size'] == st.st_size:
+                stats['unchanged'] += 1
+                continue
+
+            sha256 = sha256_checksum(path)
+            if row is not None and row['sha256'] == sha256:
+                conn.execute("UPDATE bundles SET mtime_ns = ?, size = ? WHERE path = ?",
+                             (st.st_mtime_ns, st.st_size, path))
+                stats['unchanged'] += 1
+                continue
+
+            try:
+                metadata = _read_metadata(path)
+            except (BadZipfile, KeyError, IOError, ValueError) as e:
+                eprint("could not index {}: {}".format(path, e))
+                stats['failed'] += 1
+                continue
+            _store(conn, path, st, sha256, metadata)
+            stats['added' if row is None else 'updated'] += 1
+
+        if prune:
+            for root in [os.path.abspath(p) for p in paths if os.path.isdir(p)]:
+                prefix = os.path.join(root, '')
+                for row in conn.execute("SELECT path FROM bundles WHERE substr(path, 1, ?) = ?",
+                                        (len(prefix), prefix)).fetchall():
+                    if row['path'] not in seen:
+                        _delete(conn, row['path'])
+                        stats['removed'] += 1
+    return stats
+
+
+def query(conn, module_name=None, os_name=None, architecture=None, capabilities=(), command=None, latest=False):
+    # type: (sqlite3.Connection, Optional[str], Optional[str], Optional[str], Iterable[str], Optional[str], bool) -> List[Dict[str, Any]]
+    """
+    Looks up bundles, newest versions first.
+    :param os_name: matches the bundle's operating_systems (e.g. rhel9) or its os (e.g. Linux)
+    :param capabilities: bundles must support all of them
+    :param latest: only return the newest bundle of every module
+    """
+    sql = "SELECT path, module_name, version, semantic_version, os, architecture, sha256 FROM bundles b WHERE 1"
+    params = []  # type: List[Any]
+    if module_name:
+        sql += " AND b.module_name = ?"
+        params.append(module_name)
+    if architecture:
+        sql += " AND b.architecture = ?"
+        params.append(architecture)
+    if os_name:
+        sql += " AND (lower(b.os) = ? OR EXISTS (SELECT 1 FROM bundle_os o WHERE o.path = b.path AND o.os = ?))"
+        params += [os_name.lower(), os_name.lower()]
+    for capability in capabilities:
+        sql += " AND EXISTS (SELECT 1 FROM bundle_capabilities c WHERE c.path = b.path AND c.capability = ?)"
+        params.append(capability)
+    if command:
+        sql += " AND EXISTS (SELECT 1 FROM bundle_commands m WHERE m.path = b.path AND m.command = ?)"
+        params.append(command.lower())
+    sql += " ORDER BY b.module_name, b.version DESC, b.path"
+
+    results = [dict(row) for row in conn.execute(sql, params)]
+    if latest:
+        newest = {}  # type: Dict[str, Dict[str, Any]]
+        for row in results:
+            newest.setdefault(row['module_name'], row)
+        results = list(newest.values())
+    return results
@@ -1,11 +1,20 @@
 import os.path
+import socket
+
+from redis.exceptions import ResponseError
 
 from RAMP.disposableredis import DisposableRedis
-from RAMP import config
+from RAMP import config, timings
 from .common import *
 
 OK = "OK"
 
+# Whether disposable servers can be reached over unix domain sockets on this platform
+UNIX_SOCKETS = hasattr(socket, 'AF_UNIX')
+
+# Pool of warm redis servers shared by discoveries in this process, see use_server_pool
+_server_pool = None
+
 class Module(object):
     def __init__(self, module_name, module_version):
         self.name = module_name
@@ -28,9 +37,29 @@ class ModuleCommand(object):
         return self.__dict__
 
 def redis(extra_args=None):
-    redis_client = DisposableRedis(verbose=config.debug, **extra_args)
+    # talk to redis over a private unix socket when available, so parallel discoveries never race for ports
+    redis_client = DisposableRedis(verbose=config.debug, unix_socket=UNIX_SOCKETS,
+                                   **(extra_args or {}))
     return redis_client
 
+def use_server_pool(pool):
+    """
+    Makes discovery borrow servers from the given DisposableRedisPool
+    instead of starting a new server per discovery. Pass None to stop pooling.
+    """
+    global _server_pool
+    _server_pool = pool
+
+def _redis_server(extra_args, pool=None):
+    """
+    Returns a context manager yielding a client to a clean redis server,
+    borrowed from the pool when it runs servers with matching arguments.
+    """
+    pool = pool or _server_pool
+    if pool is not None and pool.accepts(extra_args):
+        return pool.acquire()
+    return redis(extra_args)
+
 def _get_modules_list(redis_client):
     """
     Finds out which modules are loaded into Redis.
@@ -42,10 +71,31 @@ def _get_modules_list(redis_client):
     #       3) "ver"
     #       4) (integer) 1
 
-    loaded_modules = []
-    loaded_modules = [(m['name'], float(m['ver'])) for m in modules_list]
+    return _parse_modules_list(modules_list)
+
+def _parse_modules_list(modules_list):
+    return [(m['name'], float(m['ver'])) for m in modules_list]
+
+def _loaded_module(previously_loaded_modules, loaded_modules):
+    """
+    Returns the Module which MODULE LOAD added, None unless exactly one was.
+    """
+    relevant_module_list = [x for x in loaded_modules if x not in previously_loaded_modules]
+    if len(relevant_module_list) != 1:
+        return None
+
+    module_name, module_version = relevant_module_list[0]
+    return Module(module_name, module_version)
+
+def _module_command_names(core_redis_commands, extended_redis_commands):
+    """
+    Returns the sorted names of the commands MODULE LOAD added.
+    """
+    # module_commands = extended_redis_commands - core_redis_commands
+    return sorted(set(extended_redis_commands.keys()).symmetric_difference(set(core_redis_commands.keys())))
 
-    return loaded_modules
+def _load_command(module_path, module_args):
+    return "MODULE LOAD {} {}".format(os.path.abspath(module_path), module_args)
 
 def _load_module(redis_client, path_to_module, module_args):
     """
@@ -55,44 +105,31 @@ def _load_module(redis_client, path_to_module, module_args):
     Assuming only a single module is loaded.
     """
     previously_loaded_modules = _get_modules_list(redis_client)
-    resp = redis_client.execute_command("MODULE LOAD {} {}".format(
-        os.path.abspath(path_to_module), module_args))
+    with timings.span('MODULE LOAD', module=os.path.basename(path_to_module)):
+        resp = redis_client.execute_command(_load_command(path_to_module, module_args))
     if resp != OK:
         return None
 
-    loaded_modules = _get_modules_list(redis_client)
-    relevant_module_list = [x for x in loaded_modules if x not in previously_loaded_modules]
-    if len(relevant_module_list) != 1:
-        return None
-
-    module_name, module_version = relevant_module_list[0]
-    return Module(module_name, module_version)
+    return _loaded_module(previously_loaded_modules, _get_modules_list(redis_client))
 
 def _get_redis_commands(redis_client):
     """
     Retrieves a set of commands from Redis
     """
-    commands = redis_client.command()
+    with timings.span('COMMAND'):
+        commands = redis_client.command()
     return commands
 
-def _get_redis_command_info(redis_client, command_name):
+def _parse_command_info(command_info):
     """
-        Retrieves command info from Redis
-        Returns ModuleCommand
+        Converts a single raw COMMAND INFO entry into a ModuleCommand
     """
-    command_info = redis_client.execute_command("COMMAND INFO {}".format(command_name))
-    # 1) 1) "graph.ADDEDGE"
-    #    2) (integer) -1
-    #    3) 1) write
-    #    4) (integer) 1
-    #    5) (integer) 1
-    #    6) (integer) 1
-
-    if len(command_info) != 1:
-        return None
-
-    command_info = command_info[0]
-
+    # 1) "graph.ADDEDGE"
+    # 2) (integer) -1
+    # 3) 1) write
+    # 4) (integer) 1
+    # 5) (integer) 1
+    # 6) (integer) 1
     command_name = command_info[0]
     command_arity = command_info[1]
     flags = command_info[2]
@@ -102,29 +139,128 @@ def _get_redis_command_info(redis_client, command_name):
 
     return ModuleCommand(command_name, command_arity, flags, first_key, last_key, step)
 
-def discover_modules_commands(path_to_module, module_args, redis_extra_args=None):
+def _get_redis_command_info(redis_client, command_name):
+    """
+        Retrieves command info from Redis
+        Returns ModuleCommand
+    """
+    command_info = redis_client.execute_command("COMMAND INFO {}".format(command_name))
+    if len(command_info) != 1 or command_info[0] is None:
+        return None
+
+    return _parse_command_info(command_info[0])
+
+def _get_redis_commands_info(redis_client, command_names):
+    """
+        Retrieves info for several commands using a single COMMAND INFO call.
+        Falls back to one COMMAND INFO per command on servers which reject
+        multiple command names.
+        Returns a list of ModuleCommand, None for unknown commands.
+    """
+    command_names = list(command_names)
+    if not command_names:
+        return []
+
+    try:
+        with timings.span('COMMAND INFO', commands=len(command_names)):
+            commands_info = redis_client.execute_command("COMMAND INFO", *command_names)
+    except ResponseError:
+        return [_get_redis_command_info(redis_client, name) for name in command_names]
+
+    if len(commands_info) != len(command_names):
+        return [_get_redis_command_info(redis_client, name) for name in command_names]
+
+    return [_parse_command_info(info) if info is not None else None for info in commands_info]
+
+def discover_modules_commands(path_to_module, module_args, redis_extra_args=None, pool=None):
     """
         Retrieves module command(s) info.
         :param path_to_module: where does the module file is located
         :param module_args: command line arguments for the module
         :param redis_extra_args: command line arguments for redis
+        :param pool: DisposableRedisPool to borrow the server from (defaults to the one set by use_server_pool)
         Returns Module object populated with command(s) info.
     """
-    with redis(redis_extra_args) as redis_client:
+    with _redis_server(redis_extra_args, pool) as redis_client:
         core_redis_commands = _get_redis_commands(redis_client)
         module = _load_module(redis_client, path_to_module, module_args)
         if module is None:
             raise Exception("Failed to load module {} {}".format(path_to_module, module_args))
 
         extended_redis_commands = _get_redis_commands(redis_client)
-        module_commands = (set(extended_redis_commands.keys()).symmetric_difference(set(core_redis_commands.keys())))
-        # module_commands = extended_redis_commands - core_redis_commands
+        module_commands = _module_command_names(core_redis_commands, extended_redis_commands)
+        commands = _get_redis_commands_info(redis_client, module_commands)
+        _add_commands(module, module_commands, commands)
 
-        for module_command in module_commands:
-            command = _get_redis_command_info(redis_client, module_command)
-            if command is None:
-                raise Exception("Failed to retreive command info for {}".format(module_command))
+        return module
+
+def _add_commands(module, module_commands, commands):
+    for module_command, command in zip(module_commands, commands):
+        if command is None:
+            raise Exception("Failed to retreive command info for {}".format(module_command))
+
+        module.add_command(command)
+
+def async_redis(extra_args=None):
+    from RAMP.disposableredis.aio import AsyncDisposableRedis
+
+    return AsyncDisposableRedis(verbose=config.debug, unix_socket=UNIX_SOCKETS, **(extra_args or {}))
+
+async def _async_load_module(redis_client, path_to_module, module_args):
+    """
+    Loads given module to redis, like _load_module.
+    """
+    previously_loaded_modules = _parse_modules_list(await redis_client.module_list())
+    resp = await redis_client.execute_command(_load_command(path_to_module, module_args))
+    if resp != OK:
+        return None
+
+    return _loaded_module(previously_loaded_modules, _parse_modules_list(await redis_client.module_list()))
+
+async def _async_get_redis_command_info(redis_client, command_name):
+    command_info = await redis_client.execute_command("COMMAND INFO {}".format(command_name))
+    if len(command_info) != 1 or command_info[0] is None:
+        return None
+
+    return _parse_command_info(command_info[0])
+
+async def _async_get_redis_commands_info(redis_client, command_names):
+    """
+        Retrieves info for several commands using a single COMMAND INFO call, like _get_redis_commands_info.
+    """
+    command_names = list(command_names)
+    if not command_names:
+        return []
+
+    try:
+        commands_info = await redis_client.execute_command("COMMAND INFO", *command_names)
+    except ResponseError:
+        commands_info = None
+
+    if commands_info is None or len(commands_info) != len(command_names):
+        return [await _async_get_redis_command_info(redis_client, name) for name in command_names]
+
+    return [_parse_command_info(info) if info is not None else None for info in commands_info]
+
+async def async_discover_modules_commands(path_to_module, module_args, redis_extra_args=None):
+    """
+        Retrieves module command(s) info, like discover_modules_commands, from an event loop.
+        Every discovery starts its own AsyncDisposableRedis, so many can run concurrently:
+            modules = await asyncio.gather(*(async_discover_modules_commands(p, "") for p in paths))
+        :param path_to_module: where does the module file is located
+        :param module_args: command line arguments for the module
+        :param redis_extra_args: command line arguments for redis
+        Returns Module object populated with command(s) info.
+    """
+    async with async_redis(redis_extra_args) as redis_client:
+        core_redis_commands = await redis_client.command()
+        module = await _async_load_module(redis_client, path_to_module, module_args)
+        if module is None:
+            raise Exception("Failed to load module {} {}".format(path_to_module, module_args))
 
-            module.add_command(command)
+        extended_redis_commands = await redis_client.command()
+        module_commands = _module_command_names(core_redis_commands, extended_redis_commands)
+        commands = await _async_get_redis_commands_info(redis_client, module_commands)
+        _add_commands(module, module_commands, commands)
 
         return module
@@ -7,6 +7,22 @@ import os
 def eprint(*args, **kwargs):
     print(*args, file=sys.stderr, **kwargs)
 
+def _read_umask():
+    # os.umask can only be read by setting it, for the whole process
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+# Read once at import, before any thread is started, rather than while e.g. archive() builds
+# dependencies in worker threads, which would create their files under a umask of 0 meanwhile
+_UMASK = _read_umask()
+
+def default_file_mode():
+    """
+    Returns the permissions a newly created file gets under the umask the process started with.
+    """
+    return 0o666 & ~_UMASK
+
 def normalize_dependencies(deps):
     if isinstance(deps, dict):
         for dep_name, dep in deps.items():
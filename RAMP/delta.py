@@ -0,0 +1,404 @@
+import io
+import os
+import json
+import lzma
+import shutil
+import struct
+import hashlib
+import time
+import tempfile
+import zipfile
+from typing import Any, Dict, IO, Iterator, List, Optional, Tuple  # noqa: F401
+
+from RAMP.unpacker import (open_bundle, open_zip, unpack, UnpackerPackageError, COPY_BUFFER_SIZE,
+                           verifying_stream, validate_metadata, dependency_sha256)
+from .common import *
+
+# Bundle entry describing a delta bundle, its presence is what tells a delta from a regular bundle
+DELTA_FILE = 'delta.json'
+DELTA_FORMAT = 1
+
+PATCH_MAGIC = b'RAMPDIF1'
+_PATCH_HEADER = '<QQQQQ'  # old size, new size, compressed sizes of the control, diff and extra streams
+_CONTROL = '<QQQ'  # literal bytes, copied bytes, offset in old to copy from
+
+# Exact matches are looked up by blocks of this size, the index of the old module
+# holds at most MAX_INDEX_BLOCKS of them (sampled further apart for large modules)
+BLOCK_SIZE = 32
+MAX_INDEX_BLOCKS = 1 << 19
+
+# Matches are extended chunk by chunk while at least this share of the chunk's bytes are equal,
+# so code whose addresses moved is copied with a few differing bytes rather than stored again
+CHUNK_SIZE = 256
+MIN_SIMILARITY = 0.5
+
+# After a run of misses, blocks are looked up further and further apart (a step of one more byte every
+# 2**SKIP_SHIFT misses), so unrelated data costs a few thousand lookups per MB instead of one per byte.
+# A match found late is extended backward over the bytes skipped.
+SKIP_SHIFT = 5
+
+# Both modules are held in memory to be diffed, a module above this size is stored whole instead,
+# as is a module which shares too little with its base for a patch to pay off
+MAX_MODULE_SIZE = 512 * 1024 * 1024
+MAX_LITERAL_SHARE = 0.5
+
+
+def _xor(a, b):
+    # type: (bytes, bytes) -> bytes
+    return (int.from_bytes(a, 'big') ^ int.from_bytes(b, 'big')).to_bytes(len(a), 'big')
+
+
+def _index(old):
+    # type: (bytes) -> Dict[bytes, int]
+    stride = max(BLOCK_SIZE, -(-len(old) // MAX_INDEX_BLOCKS))
+    index = {}  # type: Dict[bytes, int]
+    for offset in range(0, len(old) - BLOCK_SIZE + 1, stride):
+        index.setdefault(old[offset:offset + BLOCK_SIZE], offset)
+    return index
+
+
+def _extend_forward(old, new, j, o):
+    # type: (bytes, bytes, int, int) -> Tuple[int, int]
+    while j < len(new) and o < len(old):
+        n = min(CHUNK_SIZE, len(new) - j, len(old) - o)
+        a, b = new[j:j + n], old[o:o + n]
+        if a != b:
+            x = _xor(a, b)
+            if x.count(0) < n * MIN_SIMILARITY:
+                k = n - len(x.lstrip(b'\0'))
+                return j + k, o + k
+        j += n
+        o += n
+    return j, o
+
+
+def _extend_backward(old, new, j, o, floor):
+    # type: (bytes, bytes, int, int, int) -> Tuple[int, int]
+    while j > floor and o > 0:
+        n = min(CHUNK_SIZE, j - floor, o)
+        a, b = new[j - n:j], old[o - n:o]
+        if a != b:
+            x = _xor(a, b)
+            if x.count(0) < n * MIN_SIMILARITY:
+                k = n - len(x.rstrip(b'\0'))
+                return j - k, o - k
+        j -= n
+        o -= n
+    return j, o
+
+
+def create_patch(old, new, max_literal=None):
+    # type: (bytes, bytes, Optional[int]) -> Optional[bytes]
+    """
+    Returns a binary patch turning old into new, in the spirit of bsdiff: new is described as
+    literal bytes and regions copied from old, copied regions carrying the xor of their old
+    and new bytes, which is mostly zeros and compresses to next to nothing.
+    Returns None, before compressing anything, if more than max_literal bytes of new are not found in old.
+    """
+    index = _index(old)
+    control = []  # type: List[Tuple[int, int, int]]
+    diff = io.BytesIO()
+    extra = io.BytesIO()
+
+    pos = 0  # start of the literal bytes not written yet
+    j = 0
+    delta = 0  # offset in old minus offset in new of the last match, tried first
+    misses = 0
+    while j + BLOCK_SIZE <= len(new):
+        block = new[j:j + BLOCK_SIZE]
+        o = j + delta  # type: Optional[int]
+        if not (0 <= o <= len(old) - BLOCK_SIZE and old[o:o + BLOCK_SIZE] == block):
+            o = index.get(block)
+            if o is None:
+                misses += 1
+                j += 1 + (misses >> SKIP_SHIFT)
+                continue
+
+        start, old_start = _extend_backward(old, new, j, o, pos)
+        end, _ = _extend_forward(old, new, j + BLOCK_SIZE, o + BLOCK_SIZE)
+        control.append((start - pos, end - start, old_start))
+        extra.write(new[pos:start])
+        for offset in range(0, end - start, COPY_BUFFER_SIZE):
+            n = min(COPY_BUFFER_SIZE, end - start - offset)
+            diff.write(_xor(new[start + offset:start + offset + n], old[old_start + offset:old_start + offset + n]))
+        delta = o - j
+        misses = 0
+        pos = j = end
+
+    if pos < len(new):
+        control.append((len(new) - pos, 0, 0))
+        extra.write(new[pos:])
+    if max_literal is not None and extra.tell() > max_literal:
+        return None
+
+    streams = [lzma.compress(b''.join(struct.pack(_CONTROL, *op) for op in control)),
+               lzma.compress(diff.getvalue()),
+               lzma.compress(extra.getvalue())]
+    header = PATCH_MAGIC + struct.pack(_PATCH_HEADER, len(old), len(new), *[len(s) for s in streams])
+    return header + b''.join(streams)
+
+
+def iter_patch(old, patch):
+    # type: (bytes, bytes) -> Iterator[bytes]
+    """
+    Applies a patch made by create_patch to old, yields the new file in chunks.
+    Only old and the (compressed) patch are held in memory.
+    """
+    header_size = len(PATCH_MAGIC) + struct.calcsize(_PATCH_HEADER)
+    if patch[:len(PATCH_MAGIC)] != PATCH_MAGIC:
+        raise UnpackerPackageError(message="delta patch invalid", reason="Unknown patch format",
+                                   error_code="delta_patch_invalid")
+    old_size, new_size, control_size, diff_size, extra_size = struct.unpack_from(
+        _PATCH_HEADER, patch, len(PATCH_MAGIC))
+    if old_size != len(old):
+        raise UnpackerPackageError(message="delta base invalid", reason="The patch applies to another module",
+                                   error_code="delta_base_mismatch")
+
+    control_start = header_size
+    diff_start = control_start + control_size
+    extra_start = diff_start + diff_size
+    control = lzma.decompress(patch[control_start:diff_start])
+    diff = lzma.LZMAFile(io.BytesIO(patch[diff_start:extra_start]))
+    extra = lzma.LZMAFile(io.BytesIO(patch[extra_start:extra_start + extra_size]))
+
+    written = 0
+    for literal, copy, offset in struct.iter_unpack(_CONTROL, control):
+        while literal:
+            data = extra.read(min(literal, COPY_BUFFER_SIZE))
+            if not data:
+                raise UnpackerPackageError(message="delta patch invalid", reason="Truncated patch",
+                                           error_code="delta_patch_invalid")
+            literal -= len(data)
+            written += len(data)
+            yield data
+        for start in range(offset, offset + copy, COPY_BUFFER_SIZE):
+            n = min(COPY_BUFFER_SIZE, offset + copy - start)
+            data = diff.read(n)
+            if len(data) != n or start + n > len(old):
+                raise UnpackerPackageError(message="delta patch invalid", reason="Truncated patch",
+                                           error_code="delta_patch_invalid")
+            written += n
+            yield _xor(old[start:start + n], data)
+    if written != new_size:
+        raise UnpackerPackageError(message="delta patch invalid", reason="Truncated patch",
+                                   error_code="delta_patch_invalid")
+
+
+def apply_patch(old, patch):
+    # type: (bytes, bytes) -> bytes
+    return b''.join(iter_patch(old, patch))
+
+
+class _PatchReader(io.RawIOBase):
+    """
+    Read-only stream of the file a patch produces.
+    """
+
+    def __init__(self, chunks):
+        # type: (Iterator[bytes]) -> None
+        super(_PatchReader, self).__init__()
+        self._chunks = chunks
+        self._pending = b''
+
+    def readable(self):
+        # type: () -> bool
+        return True
+
+    def readinto(self, b):
+        # type: (Any) -> int
+        while not self._pending:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                return 0
+            self._pending = memoryview(chunk)
+        n = min(len(b), len(self._pending))
+        b[:n] = self._pending[:n]
+        self._pending = self._pending[n:]
+        return n
+
+
+def _read_all(stream):
+    # type: (IO[bytes]) -> bytes
+    with stream:
+        return stream.read()
+
+
+def _module_size(bundle):
+    # type: (Any) -> int
+    return next(entry.size for entry in bundle.entries() if entry.kind == "module")
+
+
+def create_delta(old_bundle, new_bundle, output):
+    # type: (str, str, str) -> Dict[str, Any]
+    """
+    Writes a delta bundle holding new_bundle's metadata, a patch turning old_bundle's module
+    into new_bundle's module, and the dependencies which differ between the two.
+    When the modules differ too much (or are too large) for a patch to pay off, new_bundle is
+    copied to output instead: open_delta unpacks it as is.
+    The modules are verified while they are read.
+    Returns the sizes of the new bundle, its module, the patch and the delta bundle, and whether
+    the full bundle was written.
+    """
+    with open_bundle(old_bundle) as old, open_bundle(new_bundle) as new:
+        module_bytes = _module_size(new)
+        patch = None
+        if max(_module_size(old), module_bytes) <= MAX_MODULE_SIZE:
+            old_module = _read_all(old.open_module())
+            new_module = _read_all(new.open_module())
+            patch = create_patch(old_module, new_module, int(len(new_module) * MAX_LITERAL_SHARE))
+
+        fd, tmp_name = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(output)),
+                                        prefix='.' + os.path.basename(output))
+        os.close(fd)
+        try:
+            if patch is not None:
+                _write_delta(old, new, old_module, patch, new_bundle, tmp_name)
+            if patch is None or os.path.getsize(tmp_name) >= os.path.getsize(new_bundle):
+                patch = None
+                shutil.copyfile(new_bundle, tmp_name)
+            os.chmod(tmp_name, default_file_mode())
+            os.replace(tmp_name, output)
+        except BaseException:
+            os.remove(tmp_name)
+            raise
+
+    return {'bundle_bytes': os.path.getsize(new_bundle), 'module_bytes': module_bytes,
+            'patch_bytes': len(patch) if patch is not None else 0, 'delta_bytes': os.path.getsize(output),
+            'full': patch is None}
+
+
+def _write_delta(old, new, old_module, patch, new_bundle, path):
+    # type: (Any, Any, bytes, bytes, str, str) -> None
+    base_dependencies = []
+    changed_dependencies = []
+    for filename in new.dependencies():
+        sha256 = dependency_sha256(new.metadata, filename)
+        if sha256 is not None and filename in old.dependencies() and \
+                dependency_sha256(old.metadata, filename) == sha256:
+            base_dependencies.append(filename)
+        else:
+            changed_dependencies.append(filename)
+
+    module_file = new.metadata["module_file"]
+    description = {
+        "format": DELTA_FORMAT,
+        "base_sha256": hashlib.sha256(old_module).hexdigest(),
+        "base_size": len(old_module),
+        "base_version": old.metadata.get("version"),
+        "module_file": module_file,
+        "patch": module_file + ".patch",
+        "base_dependencies": base_dependencies,
+    }
+
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr(DELTA_FILE, json.dumps(description, indent=4, sort_keys=True))
+        # the patch is compressed already
+        zf.writestr(zipfile.ZipInfo(description["patch"], date_time=time.localtime()[:6]), patch)
+        for filename in changed_dependencies:
+            with new.open_dependency(filename) as src, zf.open(filename, 'w') as dst:
+                shutil.copyfileobj(src, dst, COPY_BUFFER_SIZE)
+        # as is, the metadata of an opened bundle has been normalized by its validation
+        with zipfile.ZipFile(new_bundle) as new_zf:
+            zf.writestr('module.json', new_zf.read('module.json'))
+
+
+def is_delta(bundle):
+    # type: (str) -> bool
+    """
+    Returns whether the zip file at path bundle, or an opened ZipFile, is a delta bundle.
+    """
+    if isinstance(bundle, zipfile.ZipFile):
+        return DELTA_FILE in bundle.namelist()
+    try:
+        with zipfile.ZipFile(bundle) as zf:
+            return DELTA_FILE in zf.namelist()
+    except (zipfile.BadZipfile, IOError):
+        return False
+
+
+def _read_base(base, expected_sha256):
+    # type: (Any, str) -> Tuple[bytes, Any]
+    """
+    Reads the module a delta applies to from base: a bundle (returned as well, for its
+    dependencies) or the module file itself.
+    """
+    base_bundle = None
+    if isinstance(base, (str, bytes, os.PathLike)) and not zipfile.is_zipfile(base):
+        with open(base, 'rb') as f:
+            module = f.read()
+    else:
+        base_bundle = open_bundle(base)
+        try:
+            module = _read_all(base_bundle.open_module())
+        except BaseException:
+            base_bundle.close()
+            raise
+    if hashlib.sha256(module).hexdigest() != expected_sha256:
+        if base_bundle is not None:
+            base_bundle.close()
+        raise UnpackerPackageError(message="delta base invalid",
+                                   reason="The delta applies to a module with sha256 {}".format(expected_sha256),
+                                   error_code="delta_base_mismatch")
+    return module, base_bundle
+
+
+def open_delta(delta, base):
+    # type: (Any, Any) -> Tuple[Dict[str, Any], IO[bytes], Dict[str, IO[bytes]]]
+    """
+    Unpacks a delta bundle against the bundle (or module file) it was made from, like unpacker.unpack:
+    the module metadata, the reconstructed module and the bundle deps are returned.
+    A full bundle, which create_delta writes when a patch does not pay off, is unpacked as is.
+    A module file is enough of a base only if the delta carries every dependency, otherwise the
+    dependencies which didn't change come from the base bundle.
+    The reconstructed module and deps are checked against their sha256 while they are read.
+    :raises: UnpackerPackageError
+    """
+    zf = open_zip(delta)
+    if DELTA_FILE not in zf.namelist() and 'module.json' in zf.namelist():
+        # create_delta writes the full bundle when a patch does not pay off, it needs no base
+        return unpack(zf)
+    with zf:
+        try:
+            with zf.open(DELTA_FILE) as f:
+                description = json.load(f)
+            with zf.open('module.json') as f:
+                metadata = json.load(f)
+            patch = zf.read(description["patch"])
+        except KeyError:
+            raise UnpackerPackageError(message="delta bundle invalid", reason="Not a delta bundle",
+                                       error_code="delta_invalid")
+        except ValueError:
+            raise UnpackerPackageError("Failed to read module.json")
+        if description.get("format") != DELTA_FORMAT:
+            raise UnpackerPackageError(message="delta bundle invalid",
+                                       reason="Unsupported delta format {}".format(description.get("format")),
+                                       error_code="delta_invalid")
+        validate_metadata(metadata)
+
+        old_module, base_bundle = _read_base(base, description["base_sha256"])
+        if base_bundle is None and description.get("base_dependencies"):
+            raise UnpackerPackageError(message="delta base incomplete",
+                                       reason="Dependencies {} are only in the base bundle, not in its module".format(
+                                           ', '.join(description["base_dependencies"])),
+                                       error_code="delta_base_incomplete")
+        module = verifying_stream(io.BufferedReader(_PatchReader(iter_patch(old_module, patch))),
+                                  metadata.get("sha256"), "module did not pass sanity validation",
+                                  "module_sha256_mismatch")
+
+        deps_files = {}
+        for filename in zf.namelist():
+            if filename.startswith('deps/') and filename != 'deps/':
+                deps_files[filename] = verifying_stream(
+                    zf.open(filename), dependency_sha256(metadata, filename),
+                    "dependency {} did not pass sanity validation".format(filename), "dependency_sha256_mismatch")
+        if base_bundle is not None:
+            with base_bundle:
+                for filename in description.get("base_dependencies", []):
+                    # verified against the base bundle's checksum, which has to be the one of the new bundle
+                    if dependency_sha256(base_bundle.metadata, filename) != dependency_sha256(metadata, filename):
+                        raise UnpackerPackageError(message="delta base invalid",
+                                                   reason="Dependency {} differs".format(filename),
+                                                   error_code="delta_base_mismatch")
+                    deps_files[filename] = base_bundle.open_dependency(filename)
+
+    return metadata, module, deps_files
@@ -0,0 +1,59 @@
+import json
+import hashlib
+from typing import Any, Dict, Optional  # noqa: F401
+
+from RAMP.cache import DiskCache
+from RAMP.commands_discovery import Module, ModuleCommand
+
+# Bump when the format of cached entries changes
+DISCOVERY_CACHE_VERSION = 1
+
+# Sub directory of the RAMP cache dir and its size limit
+DISCOVERY_CACHE_NAME = 'discovery'
+DISCOVERY_CACHE_MAX_BYTES = 32 * 1024 * 1024
+
+_cache = DiskCache(DISCOVERY_CACHE_NAME, DISCOVERY_CACHE_MAX_BYTES)
+
+
+def discovery_key(module_sha256, module_args, redis_version, redis_args):
+    # type: (str, str, int, Optional[Dict[str, Any]]) -> str
+    """
+    Returns the cache key of a discovery: everything that can change what redis reports about a module.
+    """
+    key = json.dumps({
+        "format": DISCOVERY_CACHE_VERSION,
+        "sha256": module_sha256,
+        "module_args": module_args,
+        "redis_version": redis_version,
+        "redis_args": redis_args or {},
+    }, sort_keys=True)
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+
+def load(key):
+    # type: (str) -> Optional[Module]
+    """
+    Returns the cached discovery result, or None.
+    """
+    data = _cache.get_json(key)
+    if not isinstance(data, dict):
+        return None
+    try:
+        module = Module(data["module_name"], data["module_version"])
+        for command in data["commands"]:
+            module.add_command(ModuleCommand(**command))
+    except (KeyError, TypeError):
+        return None
+    return module
+
+
+def store(key, module):
+    # type: (str, Module) -> bool
+    """
+    Caches a discovery result.
+    """
+    return _cache.put_json(key, {
+        "module_name": module.name,
+        "module_version": module.version,
+        "commands": [cmd.to_dict() for cmd in module.commands],
+    })
@@ -2,16 +2,39 @@ import subprocess
 import socket
 import tempfile
 import redis
+from redis.backoff import NoBackoff
+from redis.retry import Retry
 import time
 import os
 import itertools
+import shutil
 import sys
 
+from .. import cache, timings
 from ..common import *
 
 # Environment variable pointing to the redis executable
 REDIS_PATH_ENVVAR = 'REDIS_PATH'
 
+# File in the RAMP cache dir holding the parsed `redis-server --version` per binary
+REDIS_VERSIONS_CACHE = 'redis_versions.json'
+
+# Number of random ports tried before giving up when another process grabbed the port first
+PORT_ATTEMPTS = 3
+
+# Readiness polling: first retry delay, cap on the delay between retries and default overall timeout (seconds)
+READY_POLL_INITIAL = 0.001
+READY_POLL_MAX = 0.05
+READY_TIMEOUT = 10
+
+# Unix socket of a server, in its private directory. sun_path holds 108 bytes on Linux and 104 on macOS
+# and the BSDs, terminating NUL included: longer socket paths make the server listen on TCP instead
+SOCKET_FILE = 'redis.sock'
+UNIX_SOCKET_PATH_MAX = 104
+
+# Parsed versions of redis binaries probed by this process, keyed like the on disk cache
+_redis_versions = {}
+
 
 def get_random_port():
     sock = socket.socket()
@@ -22,88 +45,229 @@ def get_random_port():
     return port
 
 
+def _parse_redis_version(out):
+    v = out[out.find("v=") + 2:out.find("sha=") - 1].split('.')
+    return int(v[0]) * 10000 + int(v[1]) * 100 + int(v[2])
+
+
+def _probe_redis_version(path):
+    with timings.span('redis-server --version'):
+        p = subprocess.run(args=[path, '--version'], stdin=subprocess.DEVNULL,
+                           stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if p.returncode != 0:
+        raise Exception('Could not extract Redis version')
+    return _parse_redis_version(p.stdout.decode('utf-8'))
+
+
+def get_redis_version(path='redis-server', persist=True):
+    """
+    Returns the version of the given redis executable as an integer (e.g. 70205 for 7.2.5).
+    Versions are cached per binary, keyed by its resolved path, size and mtime,
+    both in memory and (unless `persist` is False) in the RAMP cache directory,
+    so `redis-server --version` only runs once per binary.
+    """
+    resolved = shutil.which(path) or path
+    try:
+        resolved = os.path.realpath(resolved)
+        st = os.stat(resolved)
+    except OSError:
+        return _probe_redis_version(path)
+
+    key = '{}:{}:{}'.format(resolved, st.st_size, st.st_mtime_ns)
+    version = _redis_versions.get(key)
+    if version is not None:
+        return version
+
+    versions = cache.load_json(REDIS_VERSIONS_CACHE, {}) if persist else {}
+    if not isinstance(versions, dict):
+        versions = {}
+    version = versions.get(key)
+    if version is None:
+        version = _probe_redis_version(resolved)
+        if persist:
+            # drop stale entries of a binary that has been replaced
+            versions = {k: v for k, v in versions.items() if not k.startswith(resolved + ':')}
+            versions[key] = version
+            cache.store_json(REDIS_VERSIONS_CACHE, versions)
+
+    _redis_versions[key] = version
+    return version
+
+
 class DisposableRedis(object):
-    def __init__(self, port=None, path='redis-server', verbose=False, **extra_args):
+    def __init__(self, port=None, path='redis-server', verbose=False, startup_timeout=READY_TIMEOUT,
+                 unix_socket=False, **extra_args):
         """
         :param port: port number to start the redis server on. Specify none to automatically generate
         :type port: int|None
+        :param unix_socket: listen on a unix domain socket inside a private temp directory instead of TCP,
+        unless the socket path would be too long for the platform (e.g. under a long $TMPDIR)
+        :param startup_timeout: seconds to wait for the server to accept commands
         :param extra_args: any extra arguments kwargs will be passed to redis server as --key val
         """
 
         self._port = port
         self.verbose = verbose
+        self.startup_timeout = startup_timeout
 
         # this will hold the actual port the redis is listening on. It's equal to `_port` unless `_port` is None
         # in that case `port` is randomly generated
         self.port = None
+        self.unix_socket = unix_socket
+        # private working directory of the server, also holds the unix socket when `unix_socket` is set
+        self.dir = None
+        self.socket_path = None
         self.extra_args = list(itertools.chain(
                 *(('--%s'%k, v) for k, v in extra_args.items())
                ))
         self.path = os.getenv(REDIS_PATH_ENVVAR, path)
+        # version of the redis executable, known once the server has been started
+        self.version = None
+        self.process = None
+        # seconds it took the started server to answer PING
+        self.time_to_ready = None
 
     def _getRedisVersion(self):
-        options = {
-            'stderr': subprocess.PIPE,
-            'stdin': subprocess.PIPE,
-            'stdout': subprocess.PIPE,
-        }
-        p = subprocess.Popen(args=[self.path, '--version'], **options)
-        while p.poll() is None:
-            time.sleep(0.1)
-        exit_code = p.poll()
-        if exit_code != 0:
-            raise Exception('Could not extract Redis version')
-        out, err = p.communicate()
-        out = out.decode('utf-8')
-        v = out[out.find("v=") + 2:out.find("sha=") - 1].split('.')
-        return int(v[0]) * 10000 + int(v[1]) * 100 + int(v[2])
+        return get_redis_version(self.path)
 
     def __enter__(self):
-        if self._port is None:
-            self.port = get_random_port()
+        with timings.span('redis start'):
+            return self._enter()
+
+    def _enter(self):
+        # probe first, so a missing or broken redis-server leaves no directory behind
+        self.version = self._getRedisVersion()
+        self._make_dir()
+
+        attempts = PORT_ATTEMPTS if self._port is None and not self.unix_socket else 1
+        for attempt in range(attempts):
+            try:
+                return self._start()
+            except RuntimeError:
+                # a random port may have been taken between picking and binding it, retry with another
+                if self.process.returncode is None or attempt == attempts - 1:
+                    self._cleanup()
+                    raise
+            except BaseException:
+                self._cleanup()
+                raise
+
+    def _make_dir(self):
+        """
+        Creates the private directory of the server, falls back to TCP if the unix socket path wouldn't fit.
+        """
+        self.dir = tempfile.mkdtemp(prefix='ramp-redis-')
+        if self.unix_socket and len(os.path.join(self.dir, SOCKET_FILE)) >= UNIX_SOCKET_PATH_MAX:
+            if self.verbose:
+                eprint("{} is too long for a unix socket path, using TCP".format(self.dir))
+            self.unix_socket = False
+
+    def _server_args(self):
+        """
+        Picks the port or socket path the server will listen on, returns its command line.
+        """
+        if self.unix_socket:
+            self.port = 0
+            self.socket_path = os.path.join(self.dir, SOCKET_FILE)
+            listen_args = ['--port', '0',
+                           '--unixsocket', self.socket_path,
+                           '--unixsocketperm', '700']
         else:
-            self.port = self._port
-        args = [self.path,
-                '--port', str(self.port),
-                '--dir', tempfile.gettempdir(),
+            if self._port is None:
+                self.port = get_random_port()
+            else:
+                self.port = self._port
+            listen_args = ['--port', str(self.port)]
+        args = [self.path] + listen_args + [
+                '--dir', self.dir,
                 '--save', ''] + self.extra_args
 
-        if self._getRedisVersion() >= 70000:
+        if self.version >= 70000:
             args += ['--enable-module-command', 'yes']
+        return args
 
+    def _start(self):
+        args = self._server_args()
         if self.verbose:
             out = sys.stdout
             err = sys.stderr
         else:
-            out  = open(os.devnull, 'w')
+            out = subprocess.DEVNULL
             err = subprocess.STDOUT
-        self.process = subprocess.Popen(
-            args,
-            #cwd=os.getcwd(),
-            stdin=subprocess.PIPE,
-            stdout=out,
-            stderr=err,
-            env=os.environ.copy(),
-        )
+        started = time.monotonic()
+        with timings.span('redis spawn'):
+            self.process = subprocess.Popen(
+                args,
+                #cwd=os.getcwd(),
+                stdin=subprocess.PIPE,
+                stdout=out,
+                stderr=err,
+                env=os.environ.copy(),
+            )
+        with timings.span('redis ready'):
+            return self._wait_until_ready(started)
 
+    def _wait_until_ready(self, started):
+        """
+        Pings the server over a single connection, backing off exponentially
+        from a few milliseconds, until it answers or startup_timeout expires.
+        Pings time out too, so a server which accepts connections but never answers can't hang startup,
+        and are not retried by the client, the backoff here is the only one.
+        Returns the connected client.
+        """
+        client = self.client(socket_timeout=self.startup_timeout, retry=Retry(NoBackoff(), 0))
+        delay = READY_POLL_INITIAL
         while True:
             try:
-                self.client().ping()
+                client.ping()
                 break
-            except redis.ConnectionError:
+            except (redis.ConnectionError, redis.TimeoutError):
                 self.process.poll()
                 if self.process.returncode is not None:
+                    client.close()
                     raise RuntimeError("Process has exited")
-                time.sleep(0.1)
+                if time.monotonic() - started > self.startup_timeout:
+                    client.close()
+                    self.process.terminate()
+                    raise RuntimeError("Redis did not become ready within {}s".format(self.startup_timeout))
+                time.sleep(delay)
+                delay = min(delay * 2, READY_POLL_MAX)
+        # the timeout is only meant for startup, MODULE LOAD and others may legitimately take longer
+        client.close()
+        client = self.client()
 
-        return self.client()
+        self.time_to_ready = time.monotonic() - started
+        if self.verbose:
+            eprint("redis ready on {} after {:.3f}s".format(self.address(), self.time_to_ready))
+        return client
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self.process.terminate()
+        with timings.span('redis stop'):
+            self.process.terminate()
+            self._cleanup()
 
-    def client(self):
+    def _cleanup(self):
+        if self.dir is None:
+            return
+        if self.process is not None:
+            self.process.wait()
+        shutil.rmtree(self.dir, ignore_errors=True)
+        self.dir = None
+
+    def address(self):
+        """
+        Returns a printable address the server listens on.
         """
+        return self.socket_path if self.unix_socket else 'port {}'.format(self.port)
+
+    def client(self, **kwargs):
+        """
+        :param kwargs: extra redis.StrictRedis arguments, e.g. socket_timeout
         :rtype: redis.StrictRedis
         """
 
-        return redis.StrictRedis(port=self.port, decode_responses=True)
+        if self.unix_socket:
+            return redis.StrictRedis(unix_socket_path=self.socket_path, decode_responses=True, **kwargs)
+        return redis.StrictRedis(port=self.port, decode_responses=True, **kwargs)
+
+from .pool import DisposableRedisPool
@@ -0,0 +1,123 @@
+import asyncio
+import os
+import shutil
+import subprocess
+import time
+
+import redis
+import redis.asyncio
+from redis.asyncio.retry import Retry
+from redis.backoff import NoBackoff
+
+from . import DisposableRedis, PORT_ATTEMPTS, READY_POLL_INITIAL, READY_POLL_MAX
+from ..common import *
+
+
+class AsyncDisposableRedis(DisposableRedis):
+    """
+    DisposableRedis for asyncio: the server is spawned with asyncio subprocess management and
+    talked to with redis.asyncio, so many servers can be started and used from one event loop.
+
+        async with AsyncDisposableRedis(unix_socket=True) as client:
+            await client.ping()
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(AsyncDisposableRedis, self).__init__(*args, **kwargs)
+        self._client = None
+
+    def __enter__(self):
+        raise TypeError("AsyncDisposableRedis is used with `async with`, see DisposableRedis")
+
+    async def __aenter__(self):
+        # cached per binary, so `redis-server --version` only blocks the loop's executor the first time
+        self.version = await asyncio.get_running_loop().run_in_executor(None, self._getRedisVersion)
+        self._make_dir()
+
+        attempts = PORT_ATTEMPTS if self._port is None and not self.unix_socket else 1
+        for attempt in range(attempts):
+            try:
+                self._client = await self._astart()
+                return self._client
+            except RuntimeError:
+                # a random port may have been taken between picking and binding it, retry with another
+                if self.process.returncode is None or attempt == attempts - 1:
+                    await self._acleanup()
+                    raise
+            except BaseException:
+                await self._acleanup()
+                raise
+
+    async def _astart(self):
+        args = self._server_args()
+        started = time.monotonic()
+        self.process = await asyncio.create_subprocess_exec(
+            *args,
+            stdin=subprocess.PIPE,
+            stdout=None if self.verbose else subprocess.DEVNULL,
+            stderr=None if self.verbose else subprocess.STDOUT,
+            env=os.environ.copy(),
+        )
+        return await self._await_until_ready(started)
+
+    async def _await_until_ready(self, started):
+        """
+        Pings the server like DisposableRedis._wait_until_ready, yielding to the event loop between attempts.
+        Returns the connected client.
+        """
+        client = self.client(socket_timeout=self.startup_timeout, retry=Retry(NoBackoff(), 0))
+        delay = READY_POLL_INITIAL
+        while True:
+            try:
+                await client.ping()
+                break
+            except (redis.ConnectionError, redis.TimeoutError):
+                if self.process.returncode is not None:
+                    await _close(client)
+                    raise RuntimeError("Process has exited")
+                if time.monotonic() - started > self.startup_timeout:
+                    await _close(client)
+                    self.process.terminate()
+                    raise RuntimeError("Redis did not become ready within {}s".format(self.startup_timeout))
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, READY_POLL_MAX)
+        await _close(client)
+        client = self.client()
+
+        self.time_to_ready = time.monotonic() - started
+        if self.verbose:
+            eprint("redis ready on {} after {:.3f}s".format(self.address(), self.time_to_ready))
+        return client
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        if self._client is not None:
+            await _close(self._client)
+            self._client = None
+        await self._acleanup()
+
+    async def _acleanup(self):
+        if self.dir is None:
+            return
+        if self.process is not None:
+            # also reached when the startup is cancelled, so the server may still be running
+            if self.process.returncode is None:
+                self.process.terminate()
+            await self.process.wait()
+        shutil.rmtree(self.dir, ignore_errors=True)
+        self.dir = None
+
+    def client(self, **kwargs):
+        """
+        :param kwargs: extra redis.asyncio.StrictRedis arguments, e.g. socket_timeout
+        :rtype: redis.asyncio.StrictRedis
+        """
+
+        if self.unix_socket:
+            return redis.asyncio.StrictRedis(unix_socket_path=self.socket_path, decode_responses=True, **kwargs)
+        return redis.asyncio.StrictRedis(port=self.port, decode_responses=True, **kwargs)
+
+
+async def _close(client):
+    # redis.asyncio clients have aclose() since redis 5.0.1, close() before
+    close = getattr(client, 'aclose', None) or client.close
+    await close()
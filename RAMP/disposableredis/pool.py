@@ -0,0 +1,176 @@
+import threading
+from contextlib import contextmanager
+
+import redis
+
+from . import DisposableRedis
+from ..common import *
+
+
+class DisposableRedisPool(object):
+    def __init__(self, size=1, path='redis-server', verbose=False, unix_socket=False, warm=True, **extra_args):
+        """
+        Keeps up to `size` disposable redis servers running so they can be handed out
+        again and again instead of spawning a fresh server per use.
+        Servers are started in the background: when the pool is created (unless `warm` is False)
+        and whenever a server had to be recycled, so the next acquire finds one ready.
+        :param size: number of idle servers to keep warm
+        :param unix_socket: have the servers listen on private unix domain sockets instead of TCP
+        :param warm: start `size` servers in the background right away
+        :param extra_args: any extra arguments kwargs will be passed to each redis server as --key val
+        """
+
+        self.size = size
+        self.path = path
+        self.verbose = verbose
+        self.unix_socket = unix_socket
+        self.extra_args = extra_args
+        self._idle = []
+        self._lock = threading.Lock()
+        self._closed = False
+        # background thread running _refill, if any
+        self._warmer = None
+        if warm:
+            self.refill()
+
+    def _spawn(self):
+        server = DisposableRedis(path=self.path, verbose=self.verbose, unix_socket=self.unix_socket,
+                                 **self.extra_args)
+        client = server.__enter__()
+        try:
+            server.baseline_modules = set(m['name'] for m in client.module_list())
+        except Exception:
+            _stop(server)
+            raise
+        finally:
+            client.close()
+        return server
+
+    def accepts(self, extra_args):
+        """
+        Returns whether servers of this pool were started with the given redis arguments.
+        """
+        return (extra_args or {}) == self.extra_args
+
+    def warm(self):
+        """
+        Starts servers until `size` of them are idle.
+        """
+        while True:
+            with self._lock:
+                if self._closed or len(self._idle) >= self.size:
+                    return
+            server = self._spawn()
+            self._release(server)
+
+    def refill(self):
+        """
+        Starts servers in the background until `size` of them are idle, unless that is already going on.
+        """
+        with self._lock:
+            if self._closed or self._warmer is not None:
+                return
+            self._warmer = threading.Thread(target=self._refill, name='ramp-redis-pool', daemon=True)
+            self._warmer.start()
+
+    def _refill(self):
+        try:
+            while True:
+                with self._lock:
+                    if self._closed or len(self._idle) >= self.size:
+                        # decided under the lock, so a refill() racing with this exit starts a new thread
+                        self._warmer = None
+                        return
+                self._release(self._spawn())
+        except Exception as e:
+            # acquire spawns its own server, and reports the error, when none is idle
+            with self._lock:
+                self._warmer = None
+            if self.verbose:
+                eprint("could not warm a redis server: {}".format(e))
+
+    @contextmanager
+    def acquire(self):
+        """
+        Hands out a clean server, yields a client connected to it.
+        The server is reset and returned to the pool once the block exits,
+        or terminated when it can't be reset.
+        """
+        server = None
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("Pool is closed")
+            if self._idle:
+                server = self._idle.pop()
+        if server is None:
+            server = self._spawn()
+
+        client = server.client()
+        try:
+            yield client
+        except BaseException:
+            client.close()
+            _stop(server)
+            self.refill()
+            raise
+
+        try:
+            clean = self._reset(server, client)
+        finally:
+            client.close()
+        if clean:
+            self._release(server)
+        else:
+            if self.verbose:
+                eprint("recycling redis server on {}".format(server.address()))
+            _stop(server)
+            self.refill()
+
+    def _reset(self, server, client):
+        """
+        Unloads modules loaded since the server was spawned and drops any data they created.
+        Returns False when the server couldn't be brought back to its initial state.
+        """
+        if server.process.poll() is not None:
+            return False
+        try:
+            for module in client.module_list():
+                if module['name'] not in server.baseline_modules:
+                    client.execute_command("MODULE UNLOAD", module['name'])
+            client.flushall()
+            loaded = set(m['name'] for m in client.module_list())
+        except redis.RedisError:
+            return False
+        return loaded == server.baseline_modules
+
+    def _release(self, server):
+        with self._lock:
+            if not self._closed and len(self._idle) < self.size:
+                self._idle.append(server)
+                return
+        _stop(server)
+
+    def close(self):
+        """
+        Terminates all idle servers, servers in use are terminated when released.
+        """
+        with self._lock:
+            self._closed = True
+            warmer = self._warmer
+        if warmer is not None:
+            # let a server being started come up, it is stopped when released into the closed pool
+            warmer.join()
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for server in idle:
+            _stop(server)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def _stop(server):
+    server.__exit__(None, None, None)
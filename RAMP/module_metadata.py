@@ -104,9 +104,13 @@ def get_curr_os():
     rlec_os = RLEC_OS_MAP.get(curr_os, curr_os)
     return rlec_os
 
-def create_default_metadata(module_path):
-    # type: (str) -> Dict[str, Any]
-    """Creates a default metadata"""
+def create_default_metadata(module_path, checksum=True):
+    # type: (str, bool) -> Dict[str, Any]
+    """
+    Creates a default metadata
+    :param checksum: compute the module sha256 now, otherwise it is left as None
+    for packer.archive to fill in while compressing the module
+    """
     return {
         "module_name": MODULE_NAME,
         "module_file": os.path.basename(module_path),
@@ -130,7 +134,7 @@ def create_default_metadata(module_path):
         "min_redis_pack_version": MIN_REDIS_PACK_VERSION,
         "compatible_redis_version": COMPATIBLE_REDIS_VERSION,
         "bigstore_version_2_support": BIGSTORE_VERSION_2_SUPPORT,
-        "sha256": sha256_checksum(module_path),
+        "sha256": sha256_checksum(module_path) if checksum else None,
         "commands": MODULE_COMMANDS,
         "ramp_format_version": RAMP_FORMAT_VERSION,
         "config_command": CONFIG_COMMAND,
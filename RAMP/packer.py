@@ -1,19 +1,49 @@
 import os
+import stat
+import copy
 import json
 import zipfile
 import yaml
 import semantic_version
-import tempfile
+import time
+import gzip
+import shutil
 import tarfile
-import uuid
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from subprocess import Popen, PIPE
 import hashlib
 
-from RAMP import config
+from RAMP import cache, config, timings
 import RAMP.module_metadata as module_metadata
+from RAMP import discovery_cache, static_discovery
+from RAMP.build_cache import BuildCache, BUILD_CACHE_MAX_BYTES, build_key
 from RAMP.commands_discovery import discover_modules_commands
+from RAMP.disposableredis import get_redis_version, REDIS_PATH_ENVVAR
 from .common import *
 
+# Dependency tarballs built concurrently are kept in memory up to this size, then spill to disk
+DEPENDENCY_SPOOL_SIZE = 16 * 1024 * 1024
+COPY_BUFFER_SIZE = 1024 * 1024
+
+# Zip compression methods bundle entries can use, all of them can be read by unpacker.unpack
+COMPRESSIONS = {
+    'store': zipfile.ZIP_STORED,
+    'deflate': zipfile.ZIP_DEFLATED,
+    'bzip2': zipfile.ZIP_BZIP2,
+    'lzma': zipfile.ZIP_LZMA,
+}
+COMPRESSION = 'deflate'
+
+# Module digests remembered by file identity, so packing an unchanged module again doesn't read it upfront
+DIGEST_CACHE_DIR = 'digests'
+DIGEST_CACHE_MAX_BYTES = 1024 * 1024
+
+# Timestamp of the entries of reproducible bundles when $SOURCE_DATE_EPOCH isn't set,
+# 1980-01-01T00:00:00Z is the earliest date a zip entry can carry
+SOURCE_DATE_EPOCH_ENVVAR = 'SOURCE_DATE_EPOCH'
+REPRODUCIBLE_EPOCH = 315532800
+
 
 def version_to_semantic_version(version):
     """
@@ -30,13 +60,50 @@ def version_to_semantic_version(version):
     # sem_version_str = '%02d.%02d.%02d' % (major, minor, patch)
     return semantic_version.Version(sem_version_str)
 
-def set_defaults(module_path):
+# Options set_defaults adds which change the bundle, though they don't go into module.json
+PACKING_OPTIONS = ('compression', 'compression_level', 'compress_deps', 'reproducible', 'static_discovery')
+
+def set_defaults(module_path, checksum=True):
     """
     Creates a module metadata using default values
     """
-    metadata = module_metadata.create_default_metadata(module_path)
+    metadata = module_metadata.create_default_metadata(module_path, checksum)
+    # packing options, they may be given in the manifest but are removed before writing module.json
+    metadata["compression"] = COMPRESSION
+    metadata["compression_level"] = None
+    metadata["compress_deps"] = False
+    metadata["reproducible"] = False
+    # true, or a dict of static_discovery hints, to discover commands from the module binary instead of redis
+    metadata["static_discovery"] = False
     return metadata
 
+
+def source_date_epoch():
+    """
+    Returns $SOURCE_DATE_EPOCH as a timestamp, or None if it isn't set.
+    """
+    value = os.getenv(SOURCE_DATE_EPOCH_ENVVAR)
+    if not value:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        raise Exception("error: {} must be a unix timestamp, got {}".format(SOURCE_DATE_EPOCH_ENVVAR, value))
+
+
+def _zip_date_time(epoch):
+    """
+    Returns the zip entry date_time of a timestamp, in UTC so it doesn't depend on the local timezone.
+    """
+    return time.gmtime(max(epoch, REPRODUCIBLE_EPOCH))[:6]
+
+
+def _normalized_mode(mode):
+    """
+    Keeps only whether a file is executable: 0755 for directories and executables, 0644 otherwise.
+    """
+    return 0o755 if stat.S_ISDIR(mode) or mode & 0o111 else 0o644
+
 def init_from_manifest(metadata, manifest):
     """
     Creates module metadata from user provided menifest file
@@ -52,60 +119,339 @@ def init_from_manifest(metadata, manifest):
         eprint(exc)
 
 
-def archive(module_path, metadata, archive_name='module.zip'):
+def module_sha256(module_path, use_cache=True):
+    """
+    Returns the sha256 of the module.
+    :param use_cache: remember the digest in the RAMP cache dir under the module's path, size, modification and
+    change times, so it is only read again once it changed
+    """
+    if not use_cache:
+        return module_metadata.sha256_checksum(module_path)
+    path = os.path.realpath(module_path)
+    try:
+        st = os.stat(path)
+    except OSError:
+        return module_metadata.sha256_checksum(module_path)
+    digests = cache.DiskCache(DIGEST_CACHE_DIR, DIGEST_CACHE_MAX_BYTES)
+    identity = '{}:{}:{}:{}'.format(path, st.st_size, st.st_mtime_ns, st.st_ctime_ns)
+    key = hashlib.sha256(identity.encode('utf-8')).hexdigest()
+    cached = digests.get_json(key)
+    if isinstance(cached, str):
+        return cached
+    sha256 = module_metadata.sha256_checksum(path)
+    digests.put_json(key, sha256)
+    return sha256
+
+
+def _write_hashed(archive_file, path, arcname, epoch=None, sha256=None, block_size=COPY_BUFFER_SIZE):
+    """
+    Writes a file into the archive reading it once, returns the sha256 of the bytes written.
+    :param epoch: if set, the entry carries this timestamp and normalized permissions instead of the file's
+    :param sha256: the digest the file is expected to have, e.g. computed upfront for a cache key,
+    an exception is raised if the bytes written don't match it
+    """
+    digest = hashlib.sha256()
+    zinfo = zipfile.ZipInfo.from_file(path, arcname)
+    if epoch is not None:
+        zinfo.date_time = _zip_date_time(epoch)
+        zinfo.external_attr = (stat.S_IFREG | _normalized_mode(zinfo.external_attr >> 16)) << 16
+    zinfo.compress_type = archive_file.compression
+    zinfo._compresslevel = archive_file.compresslevel
+    with open(path, 'rb') as src, archive_file.open(zinfo, 'w') as dst:
+        for block in iter(lambda: src.read(block_size), b''):
+            digest.update(block)
+            dst.write(block)
+    if sha256 is not None and digest.hexdigest() != sha256:
+        raise Exception("error: {} changed while it was packed, its sha256 is {} instead of {}".format(
+            path, digest.hexdigest(), sha256))
+    return digest.hexdigest()
+
+
+class _HashingWriter(object):
+    """
+    Write-only file object computing the sha256 of everything written through it.
+    """
+
+    def __init__(self, fileobj):
+        self._fileobj = fileobj
+        self.sha256 = hashlib.sha256()
+
+    def write(self, data):
+        self.sha256.update(data)
+        return self._fileobj.write(data)
+
+    def flush(self):
+        self._fileobj.flush()
+
+
+def _file_size(path):
+    """
+    Returns the size of a regular file, 0 for symlinks (dangling ones included) and special files
+    which the tarball only holds a header of.
+    """
+    st = os.lstat(path)
+    return st.st_size if stat.S_ISREG(st.st_mode) else 0
+
+
+def _tree_size(path):
+    """
+    Returns the total size of the regular files under path.
+    """
+    if not os.path.isdir(path):
+        return _file_size(path)
+    return sum(_file_size(os.path.join(root, f)) for root, _, files in os.walk(path) for f in files)
+
+
+def _tar_dependency(local_path, fileobj, epoch=None):
+    """
+    Writes a gzipped tarball of local_path to fileobj, returns the tarball's sha256.
+    The tarball is produced as a stream, memory use doesn't depend on the dependency size.
+    :param epoch: if set, the gzip header and tar members carry this timestamp, members are owned
+    by root and have normalized permissions, making the tarball depend on file contents only
+    """
+    def normalize(tarinfo):
+        tarinfo.mtime = epoch
+        tarinfo.uid = tarinfo.gid = 0
+        tarinfo.uname = tarinfo.gname = ''
+        tarinfo.mode = _normalized_mode(tarinfo.mode | (stat.S_IFDIR if tarinfo.isdir() else 0))
+        return tarinfo
+
+    out = _HashingWriter(fileobj)
+    with timings.span('tar dependency', path=local_path), \
+            gzip.GzipFile(filename='', mode='wb', fileobj=out, mtime=epoch) as gz:
+        with tarfile.open(fileobj=gz, mode='w|') as tar:
+            # directories are added in sorted order
+            tar.add(local_path, arcname=os.path.basename(local_path), filter=normalize if epoch is not None else None)
+    return out.sha256.hexdigest()
+
+
+def _open_dependency_entry(archive_file, arcname, size, compress, epoch=None):
+    """
+    Opens a zip entry for writing a dependency tarball of (at most) the given size.
+    Tarballs are already gzipped, they are stored as is unless `compress` is set.
+    """
+    zinfo = zipfile.ZipInfo(arcname, date_time=_zip_date_time(epoch) if epoch is not None else time.localtime()[:6])
+    if compress:
+        zinfo.compress_type = archive_file.compression
+        zinfo._compresslevel = archive_file.compresslevel
+    else:
+        zinfo.compress_type = zipfile.ZIP_STORED
+    zinfo.external_attr = 0o644 << 16
+    return archive_file.open(zinfo, 'w', force_zip64=size > zipfile.ZIP64_LIMIT // 2)
+
+
+def _build_dependency(local_path, epoch=None):
+    """
+    Builds a dependency tarball into a spooled temporary file, returns the file, its sha256 and its size.
+    """
+    tgz = tempfile.SpooledTemporaryFile(max_size=DEPENDENCY_SPOOL_SIZE)
+    try:
+        sha256 = _tar_dependency(local_path, tgz, epoch)
+    except BaseException:
+        tgz.close()
+        raise
+    size = tgz.tell()
+    tgz.seek(0)
+    return tgz, sha256, size
+
+
+def _write_dependencies(archive_file, local_paths, workers=None, compress=False, epoch=None):
+    """
+    Embeds local dependencies as deps/<name>.tgz, returns their sha256 by name.
+    A single dependency is streamed straight into the archive. Several dependencies are
+    tarred concurrently, each into a spooled temporary file, and added in the given order.
+    """
+    checksums = {}
+    if len(local_paths) == 1:
+        (name, local_path), = local_paths.items()
+        with _open_dependency_entry(archive_file, 'deps/%s.tgz' % name, _tree_size(local_path), compress,
+                                    epoch) as entry:
+            checksums[name] = _tar_dependency(local_path, entry, epoch)
+        return checksums
+
+    workers = workers or min(len(local_paths), os.cpu_count() or 1)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [(name, executor.submit(_build_dependency, local_path, epoch)) for name, local_path in local_paths.items()]
+        try:
+            for name, future in futures:
+                tgz, checksums[name], size = future.result()
+                with tgz, _open_dependency_entry(archive_file, 'deps/%s.tgz' % name, size, compress, epoch) as entry, \
+                        timings.span('write dependency', dependency=name):
+                    shutil.copyfileobj(tgz, entry, COPY_BUFFER_SIZE)
+        finally:
+            for _, future in futures:
+                if future.done() and future.exception() is None:
+                    future.result()[0].close()
+    return checksums
+
+
+def archive(module_path, metadata, archive_name='module.zip', workers=None,
+            compression=COMPRESSION, compression_level=None, compress_deps=False, reproducible=False):
     """
     Archives both module and module metadata.
+    :param workers: number of threads building dependency tarballs
+    :param compression: compression of the module and module.json, one of COMPRESSIONS
+    :param compression_level: level passed to the compressor, None for its default
+    :param compress_deps: compress the (already gzipped) dependency tarballs too, instead of storing them
+    :param reproducible: produce the same bytes from the same inputs: entries are dated $SOURCE_DATE_EPOCH
+    (or 1980-01-01), permissions are normalized, dependencies are sorted and their tarballs don't carry
+    timestamps or owners of the local files
+    """
+    if compression not in COMPRESSIONS:
+        raise Exception("error: unknown compression {}, expected one of {}".format(
+            compression, ', '.join(sorted(COMPRESSIONS))))
+    epoch = None
+    if reproducible:
+        epoch = source_date_epoch()
+        if epoch is None:
+            epoch = REPRODUCIBLE_EPOCH
+
+    archive_name = archive_name.format(**metadata)
+    # write next to the destination and rename once complete: a failed pack leaves no partial bundle
+    fd, tmp_name = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(archive_name)),
+                                    prefix='.' + os.path.basename(archive_name))
+    os.close(fd)
+    try:
+        with timings.span('archive', compression=compression):
+            _archive(module_path, metadata, tmp_name, workers, compression, compression_level, compress_deps, epoch)
+        os.chmod(tmp_name, default_file_mode())
+        os.replace(tmp_name, archive_name)
+    except BaseException:
+        os.remove(tmp_name)
+        raise
+    print(archive_name)
+
+
+def _archive(module_path, metadata, archive_name, workers, compression, compression_level, compress_deps, epoch):
+    with zipfile.ZipFile(archive_name, 'w', COMPRESSIONS[compression],
+                         compresslevel=compression_level) as archive_file:
+        # the module is hashed while it is compressed and checked against the digest package() may have
+        # needed upfront, module.json goes last so it carries the checksum of the bytes actually written
+        with timings.span('compress module', file=metadata["module_file"]):
+            metadata["sha256"] = _write_hashed(archive_file, module_path, metadata["module_file"], epoch,
+                                               metadata.get("sha256"))
+
+        # pop out dependencies that are embeded inside the package
+        local_paths = {}
+        for dep_name, dep in metadata['dependencies'].items():
+            if 'local_path' in dep.keys():
+                local_paths[dep_name] = eval('f"%s"' % (dep['local_path']), globals())
+        if epoch is not None:
+            local_paths = dict(sorted(local_paths.items()))
+        if local_paths:
+            with timings.span('dependencies', count=len(local_paths)):
+                checksums = _write_dependencies(archive_file, local_paths, workers, compress_deps, epoch)
+            for dep_name, sha256 in checksums.items():
+                metadata['dependencies'][dep_name].pop('local_path')
+                metadata['dependencies'][dep_name]['sha256'] = sha256
+
+        module_json = json.dumps(metadata, indent=4, sort_keys=True)
+        if epoch is None:
+            archive_file.writestr('module.json', module_json)
+        else:
+            zinfo = zipfile.ZipInfo('module.json', date_time=_zip_date_time(epoch))
+            zinfo.compress_type = archive_file.compression
+            zinfo.external_attr = 0o644 << 16
+            archive_file.writestr(zinfo, module_json, compresslevel=archive_file.compresslevel)
+
+
+def discover(module_path, module_args, redis_args, module_sha256, use_cache=True):
+    """
+    Discovers module commands, reusing a cached discovery of the same module binary,
+    module arguments, redis version and redis arguments when there is one.
+    """
+    if not use_cache:
+        return discover_modules_commands(module_path, module_args, redis_args)
+
+    redis_version = get_redis_version(os.getenv(REDIS_PATH_ENVVAR, 'redis-server'))
+    key = discovery_cache.discovery_key(module_sha256, module_args, redis_version, redis_args)
+    with timings.span('discovery cache lookup'):
+        module = discovery_cache.load(key)
+    if module is not None:
+        if config.verbose:
+            print("using cached discovery of {}".format(module_path))
+        return module
+
+    module = discover_modules_commands(module_path, module_args, redis_args)
+    discovery_cache.store(key, module)
+    return module
+
+
+def _git_sha():
     """
-    dependencies_files = {}
-    for dep_name, dep in metadata['dependencies'].items():
-        if 'local_path' in dep.keys():
-            local_path = eval('f"%s"' % (dep['local_path']), globals())
-            name = os.path.basename(local_path)
-            _, path = tempfile.mkstemp()
-            with tarfile.open(path, "w:gz") as tar:
-                tar.add(local_path, arcname=name)
-                dependencies_files[dep_name] = path
-            
-    
-    # pop out dependencies that are embeded inside the package
-    for name, path in dependencies_files.items():
-        with open(path, 'rb') as f:
-            data = f.read()
-            readable_hash = hashlib.sha256(data).hexdigest();
-            metadata['dependencies'][name].pop('local_path')
-            metadata['dependencies'][name]['sha256'] = readable_hash
-
-    with tempfile.NamedTemporaryFile(mode='w', prefix='ramp.json', delete=False) as outfile:
-        jfile = outfile.name
-        archive_name = archive_name.format(**metadata)
-        json.dump(metadata, outfile, indent=4, sort_keys=True)
+    Returns the sha of the git HEAD the pack runs in, or None.
+    """
+    try:
+        p = Popen('git rev-parse HEAD'.split(' '), stdin=PIPE, stdout=PIPE, stderr=PIPE)
+        git_sha, err = p.communicate()
+        if p.returncode != 0:
+            eprint("could not extract git sha {}".format(err))
+            return None
+        return str(git_sha.strip())
+    except Exception as e:
+        eprint("could not extract git sha {}".format(e))
+        return None
 
+
+def _build_key(metadata, output, git_sha):
+    """
+    Returns the build cache key of a pack, or None if it can't be cached.
+    Only what changes the bundle is keyed: the module.json fields gathered so far (module sha256 included)
+    and the packing options, not e.g. --debug, and local dependencies by their contents and directory name.
+    """
     try:
-        with zipfile.ZipFile(archive_name, 'w', zipfile.ZIP_DEFLATED) as archive_file:
-            archive_file.write(module_path, metadata["module_file"])
-            archive_file.write(jfile, arcname='module.json')
-            for name, path in dependencies_files.items():
-                archive_file.write(path, arcname='deps/%s.tgz' % name)
-            print(archive_name)
-    finally:
-        os.remove(jfile)
+        fields = set(module_metadata.FIELDS).union(PACKING_OPTIONS)
+        inputs = {key: value for key, value in metadata.items() if key in fields}
+        inputs["dependencies"] = normalize_dependencies(copy.deepcopy(metadata["dependencies"]))
+        local_paths = []
+        for _, dep in sorted(inputs["dependencies"].items()):
+            if 'local_path' in dep:
+                local_paths.append(eval('f"%s"' % (dep['local_path']), globals()))
+                # the tarball only carries the directory name
+                dep['local_path'] = os.path.basename(local_paths[-1])
+        try:
+            redis_version = get_redis_version(os.getenv(REDIS_PATH_ENVVAR, 'redis-server'))
+        except Exception:
+            redis_version = None
+        return build_key(inputs, output, local_paths, git_sha, redis_version, source_date_epoch())
+    except Exception as e:
+        if config.verbose:
+            eprint("not using the build cache: {}".format(e))
+        return None
 
 
 def package(module, **args):
     module_path = module
 
-    nonkeys = dict.fromkeys(['manifest', 'verbose', 'print_filename_only', 'packname_file', 'output', 'redis_args'], 1)
+    nonkeys = dict.fromkeys(['manifest', 'verbose', 'print_filename_only', 'packname_file', 'output', 'redis_args',
+                             'no_discovery_cache', 'build_cache', 'build_cache_size',
+                             'timings', 'timings_file', 'timings_format', 'static_discovery'], 1)
     manifest = args['manifest']
     print_filename_only = args['print_filename_only']
     packname_file = args['packname_file']
     output = args['output']
 
     # start with default values (lowest priority)
-    metadata = set_defaults(module_path)
+    # the module checksum is needed upfront only to look up cached discoveries and bundles
+    # or to name the package, it is computed again while archiving and has to match
+    use_discovery_cache = not args.get('no_discovery_cache')
+    use_build_cache = bool(args.get('build_cache'))
+    checksum = use_discovery_cache or use_build_cache or '{sha256' in output
+    with timings.span('default metadata', checksum=checksum):
+        metadata = set_defaults(module_path, checksum=False)
+        if checksum:
+            metadata["sha256"] = module_sha256(module_path, use_cache=use_discovery_cache or use_build_cache)
 
     # fill in keys from manifest file
     if manifest:
-        init_from_manifest(metadata, manifest)
+        with timings.span('manifest'):
+            init_from_manifest(metadata, manifest)
+    # static discovery may take the name the module registers with from the manifest, not from -n
+    # which only names the package
+    registered_name = metadata["module_name"]
+    # --static-discovery keeps the hints the manifest may give
+    if args.get('static_discovery') and not metadata["static_discovery"]:
+        metadata["static_discovery"] = True
 
     # fill in keys from arguments
     for key in args.keys():
@@ -116,10 +462,47 @@ def package(module, **args):
             continue
         metadata[key] = value
 
+    with timings.span('git rev-parse'):
+        git_sha = _git_sha()
+
+    # reuse the bundle of an earlier pack of the very same inputs
+    build_cache = None
+    build_cache_key = None
+    if use_build_cache:
+        cache_size = args.get('build_cache_size')
+        build_cache = BuildCache(cache_size * 1024 * 1024 if cache_size else BUILD_CACHE_MAX_BYTES)
+        with timings.span('build cache lookup'):
+            build_cache_key = _build_key(metadata, output, git_sha)
+            packname = build_cache.lookup(build_cache_key) if build_cache_key is not None else None
+        if packname is not None:
+            if packname_file:
+                with open(packname_file, 'w') as file:
+                    file.write(packname)
+            if print_filename_only:
+                if not packname_file:
+                    print(packname)
+                return 0
+            with timings.span('build cache restore'):
+                build_cache.restore(build_cache_key, packname)
+            if config.verbose:
+                print("restored {} from the build cache".format(packname))
+            print(packname)
+            return 0
+
     # Load module into redis and discover its commands
     cmd_line_args = metadata.pop('run_command_line_args', None)
     redis_args = metadata.pop('redis_args')
-    module = discover_modules_commands(module_path, eval('f"%s"' % (cmd_line_args if cmd_line_args else metadata["command_line_args"]), globals()), redis_args)
+    module_args = eval('f"%s"' % (cmd_line_args if cmd_line_args else metadata["command_line_args"]), globals())
+    static = metadata.pop('static_discovery')
+    with timings.span('discovery', static=bool(static)):
+        if static:
+            hints = dict(static) if isinstance(static, dict) else {}
+            if 'module_name' not in hints and registered_name:
+                hints['module_name'] = registered_name
+            module = static_discovery.discover_modules_commands(module_path, hints)
+        else:
+            module = discover(module_path, module_args, redis_args, metadata["sha256"],
+                              use_cache=use_discovery_cache)
     metadata["module_name"] = module.name
     metadata["version"] = module.version
     metadata["semantic_version"] = str(version_to_semantic_version(module.version))
@@ -164,15 +547,14 @@ def package(module, **args):
     metadata["dependencies"] = normalize_dependencies(metadata["dependencies"])
     metadata["optional-dependencies"] = normalize_dependencies(metadata["optional-dependencies"])
 
-    try:
-        p = Popen('git rev-parse HEAD'.split(' '), stdin=PIPE, stdout=PIPE, stderr=PIPE)
-        git_sha, err = p.communicate()
-        if p.returncode != 0:
-            eprint("could not extract git sha {}".format(err))
-        else:
-            metadata["git_sha"] = str(git_sha.strip())
-    except Exception:
-        eprint("could not extract git sha {}".format(err))
+    if git_sha is not None:
+        metadata["git_sha"] = git_sha
+
+    # packing options which may come from the manifest but don't belong in module.json
+    compression = metadata.pop('compression')
+    compression_level = metadata.pop('compression_level')
+    compress_deps = metadata.pop('compress_deps')
+    reproducible = metadata.pop('reproducible') or source_date_epoch() is not None
 
     # cleanup metadata from utility keys
     fields = dict.fromkeys(module_metadata.FIELDS, 1)
@@ -196,5 +578,9 @@ def package(module, **args):
         print("Module Metadata:")
         print(json.dumps(metadata, indent=2))
 
-    archive(module_path, metadata, archive_name=output)
+    archive(module_path, metadata, archive_name=output, compression=compression,
+            compression_level=compression_level, compress_deps=compress_deps, reproducible=reproducible)
+    if build_cache_key is not None:
+        with timings.span('build cache store'):
+            build_cache.store(build_cache_key, packname, packname)
     return 0
@@ -1,15 +1,21 @@
 #!/usr/bin/env python
 
 import os
+import sys
 import json
+import time
 import click
 
 from RAMP import config
-from RAMP.packer import package
-from RAMP.unpacker import unpack as unpack_bundle
-from RAMP.version import VERSION
 from .common import *
 
+# Commands import what they use when they run, so that e.g. `ramp version` or `ramp validate`
+# don't pay for loading redis, yaml, the packer or the installed package metadata. The option choices and defaults below mirror
+# packer.COMPRESSIONS, catalog.CATALOG_FILE and timings.FORMATS for the same reason.
+COMPRESSION_CHOICES = ['bzip2', 'deflate', 'lzma', 'store']
+CATALOG_FILE = 'ramp-index.db'
+TIMINGS_FORMATS = ['json', 'chrome']
+
 
 def comma_seperated_to_list(ctx, param, value):
     """
@@ -39,46 +45,177 @@ def json_str_to_json(ctx, param, value):
     return json.loads(value) if value else None
 
 
+def print_version(ctx, param, value):
+    """
+    Prints the version for --version, like click.version_option but only looking it up when asked.
+    """
+    if not value or ctx.resilient_parsing:
+        return
+    from RAMP.version import VERSION
+    click.echo('{}, version {}'.format(ctx.find_root().info_name, VERSION))
+    ctx.exit()
+
+
 @click.group()
-@click.version_option(version=VERSION)
+@click.option('--version', is_flag=True, expose_value=False, is_eager=True, callback=print_version,
+              help='Show the version and exit.')
 def ramp():
     pass
 
 
 @ramp.command()
 def version():
+    from RAMP.version import VERSION
+
     print('RAMP packer v={}'.format(str(VERSION)))
     return 0
 
 
-@ramp.command()
-@click.argument('bundle')
-def validate(bundle):
+def _bundle_source(bundle):
+    """
+    Maps the `-` bundle argument to stdin.
+    """
+    return sys.stdin.buffer if bundle == '-' else bundle
+
+
+def _validate_entry(bundle):
+    """
+    Validates a single bundle, returns its report record.
+    """
+    from RAMP.unpacker import unpack as unpack_bundle, verify, UnpackerPackageError
+
+    result = {'bundle': bundle}
+    started = time.time()
     try:
-        unpack(bundle)
-        print("package is valid")
-        return 0
+        _, module, dep_files = unpack_bundle(_bundle_source(bundle))
+        verify(module, dep_files)
+        result['status'] = 'valid'
+    except UnpackerPackageError as e:
+        result.update(status='invalid', error=str(e), error_code=e.error_code, reason=e.reason)
     except Exception as e:
-        eprint("package is invalid, reason: {}".format(e))
-        return 1
+        result.update(status='invalid', error=str(e), error_code=None, reason=None)
+    result['seconds'] = round(time.time() - started, 3)
+    return result
+
+
+def _expand_bundles(patterns):
+    """
+    Expands glob patterns into bundle paths, patterns matching nothing are kept as is.
+    """
+    import glob
+
+    bundles = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern)) if glob.has_magic(pattern) else []
+        bundles += matches or [pattern]
+    return bundles
+
+
+@ramp.command()
+@click.argument('bundles', nargs=-1, required=True)
+@click.option('--jobs', '-j', type=int, default=None, help='number of bundles to validate in parallel (default: number of cpus)')
+@click.option('--json', 'json_report', is_flag=True, default=False, help='print a json report')
+def validate(bundles, jobs, json_report):
+    """
+    Validates bundles, BUNDLES being paths or glob patterns, `-` reads a bundle from stdin.
+    """
+    bundles = _expand_bundles(bundles)
+    started = time.time()
+    if len(bundles) > 1 and jobs != 1 and '-' not in bundles:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            results = list(executor.map(_validate_entry, bundles, chunksize=4))
+    else:
+        results = [_validate_entry(bundle) for bundle in bundles]
+    invalid = len([r for r in results if r['status'] != 'valid'])
+
+    if json_report:
+        json.dump({'bundles': results, 'invalid': invalid, 'seconds': round(time.time() - started, 3)},
+                  sys.stdout, indent=2)
+        print()
+    elif len(bundles) == 1:
+        if invalid:
+            eprint("package is invalid, reason: {}".format(results[0]['error']))
+        else:
+            print("package is valid")
+    else:
+        for r in results:
+            if r['status'] == 'valid':
+                print("{}: package is valid".format(r['bundle']))
+            else:
+                eprint("{}: package is invalid, reason: {}".format(r['bundle'], r['error']))
+
+    if invalid:
+        sys.exit(1)
 
 
 @ramp.command()
 @click.argument('bundle')
-def unpack(bundle):
-    metadata, module, dep_files = unpack_bundle(bundle)
+@click.option('--base', default=None, help='bundle (or module file) a delta BUNDLE was made against')
+def unpack(bundle, base):
+    """
+    Extracts the module and its metadata from BUNDLE, `-` reads the bundle from stdin.
+    """
+    from RAMP.unpacker import unpack as unpack_bundle, open_zip, extract_to, UnpackerPackageError
+    from RAMP import delta
+
+    try:
+        # stdin is spooled first, so a delta piped in is told from a bundle like a delta file
+        source = open_zip(_bundle_source(bundle))
+    except UnpackerPackageError as e:
+        raise click.ClickException(str(e))
+    if base is not None:
+        try:
+            metadata, module, dep_files = delta.open_delta(source, base)
+        except UnpackerPackageError as e:
+            raise click.ClickException(str(e))
+    elif delta.is_delta(source):
+        source.close()
+        raise click.ClickException("{} is a delta bundle, pass the bundle it was made against with --base".format(
+            'stdin' if bundle == '-' else bundle))
+    else:
+        metadata, module, dep_files = unpack_bundle(source)
     module_metadata_file_name = os.path.join(os.getcwd(), metadata['module_name'] + '.json')
     module_file_name = os.path.join(os.getcwd(), metadata['module_file'])
 
+    # the module checksum is verified while it is extracted, write the metadata only once it passed
+    try:
+        extract_to(module, module_file_name)
+    except UnpackerPackageError as e:
+        raise click.ClickException(str(e))
+
     with open(module_metadata_file_name, 'w') as outfile:
         json.dump(metadata, outfile)
         print(module_metadata_file_name)
+    print(module_file_name)
+
+    return 0
 
-    with open(module_file_name, 'wb') as outfile:
-        for line in module.readlines():
-            outfile.write(line)
-        print(module_file_name)
 
+@ramp.command('delta')
+@click.argument('old')
+@click.argument('new')
+@click.option('--output', '-o', default=None, help='delta bundle file name (default: NEW with a .delta.zip extension)')
+def make_delta(old, new, output):
+    """
+    Creates a delta bundle: NEW's metadata and dependencies which changed, with its module stored as
+    a binary patch against OLD's module. `ramp unpack DELTA --base OLD` restores NEW's module.
+    """
+    from RAMP import delta
+    from RAMP.unpacker import UnpackerPackageError
+
+    if output is None:
+        output = (new[:-len('.zip')] if new.endswith('.zip') else new) + '.delta.zip'
+    try:
+        stats = delta.create_delta(old, new, output)
+    except UnpackerPackageError as e:
+        raise click.ClickException(str(e))
+    print(output)
+    if stats['full']:
+        eprint("the modules differ too much for a patch, {} is a copy of {}".format(output, new))
+    else:
+        eprint("{} bytes instead of {} ({} bytes module patch)".format(stats['delta_bytes'], stats['bundle_bytes'],
+                                                                      stats['patch_bytes']))
     return 0
 
 
@@ -114,9 +251,178 @@ def unpack(bundle):
 @click.option('--verbose', '-v', is_flag=True, default=False, help='verbose mode: print the resulting metadata')
 @click.option('--debug', is_flag=True, default=False, help='Print interaction with Redis. Implies --verbose.')
 @click.option('--redis-args', 'redis_args', callback=json_str_to_json, help='redis command line arguments')
+@click.option('--compression', type=click.Choice(COMPRESSION_CHOICES), default=None, help='compression of the module in the bundle (default: deflate)')
+@click.option('--compression-level', type=int, default=None, help='compression level, defaults to the compressor\'s default')
+@click.option('--compress-deps', is_flag=True, default=None, help='compress dependency tarballs in the bundle instead of storing them')
+@click.option('--reproducible', is_flag=True, default=None, help='produce identical bundles from identical inputs (implied by $SOURCE_DATE_EPOCH)')
+@click.option('--static-discovery', is_flag=True, default=False, help='discover commands from the module binary instead of loading it into redis')
+@click.option('--no-discovery-cache', is_flag=True, default=False, help='always load the module into redis to discover its commands')
+@click.option('--build-cache/--no-build-cache', default=False, help='reuse the bundle of an earlier pack of the very same inputs, keeping a copy of every bundle built in the cache (default: off)')
+@click.option('--build-cache-size', type=int, default=None, help='size limit of the build cache in MB (default: 1024)')
+@click.option('--timings', is_flag=True, default=False, help='print how long each phase of the pack took')
+@click.option('--timings-file', default=None, help='write the timings of the pack phases to this file')
+@click.option('--timings-format', type=click.Choice(TIMINGS_FORMATS), default='json', help='format of --timings-file, chrome being the Chrome trace event format')
 def pack(module, *args, **kwargs):
+    from RAMP import timings
+    from RAMP.packer import package
+
     config.set(kwargs)
-    return package(module, **kwargs)
+    if not kwargs['timings'] and not kwargs['timings_file']:
+        return package(module, **kwargs)
+
+    timings.enable()
+    try:
+        with timings.span('pack', module=os.path.basename(module)):
+            return package(module, **kwargs)
+    finally:
+        if kwargs['timings']:
+            eprint(timings.summary())
+        if kwargs['timings_file']:
+            timings.write(kwargs['timings_file'], kwargs['timings_format'])
+        timings.disable()
+
+
+def _init_pack_worker():
+    """
+    Runs once in every pack-many worker process: sets up the warm discovery server
+    shared by all packs running in that process, and sends whatever the packs print
+    (bundle names, subprocess output) to stderr, keeping stdout for the json summary.
+    """
+    import multiprocessing.util
+    from RAMP import commands_discovery
+    from RAMP.disposableredis import DisposableRedisPool
+
+    # file descriptors rather than sys.stdout/stderr, which may have been swapped for buffers (e.g. by CliRunner)
+    os.dup2(2, 1)
+
+    pool = DisposableRedisPool(size=1, unix_socket=commands_discovery.UNIX_SOCKETS)
+    commands_discovery.use_server_pool(pool)
+    multiprocessing.util.Finalize(None, pool.close, exitpriority=10)
+
+
+def _pack_entry(entry):
+    """
+    Packs a single pack-many entry, returns its result record.
+    """
+    import tempfile
+    from RAMP.packer import package
+
+    result = {'module': entry.get('module'), 'manifest': entry.get('manifest'),
+              'output': entry.get('output'), 'bundle': None}
+    started = time.time()
+    fd, packname_file = tempfile.mkstemp(prefix='ramp.packname')
+    os.close(fd)
+    try:
+        argv = [entry['module']]
+        if entry.get('manifest'):
+            argv += ['-m', entry['manifest']]
+        if entry.get('output'):
+            argv += ['-o', entry['output']]
+        argv += [str(arg) for arg in entry.get('args', [])]
+        argv += ['--packname-file', packname_file]
+        with pack.make_context('pack', argv) as ctx:
+            config.set(ctx.params)
+            package(ctx.params.pop('module'), **ctx.params)
+        with open(packname_file) as f:
+            result['bundle'] = f.read()
+        result['status'] = 'ok'
+    except Exception as e:
+        result['status'] = 'error'
+        result['error'] = str(e)
+    finally:
+        os.remove(packname_file)
+    result['seconds'] = round(time.time() - started, 3)
+    return result
+
+
+@ramp.command('pack-many')
+@click.argument('entries', type=click.File('rb'))
+@click.option('--jobs', '-j', type=int, default=None, help='number of packs to run in parallel (default: number of cpus)')
+@click.option('--summary', '-s', type=click.File('w'), default=None, help='write the json summary to this file instead of stdout')
+def pack_many(entries, jobs, summary):
+    """
+    Packs many modules in parallel.
+
+    ENTRIES is a yaml/json list of {module, manifest, output, args} objects,
+    `args` being a list of extra `ramp pack` arguments.
+    Each worker process keeps a redis server warm for the discoveries it runs.
+    """
+    import yaml
+    from concurrent.futures import ProcessPoolExecutor
+
+    entries = yaml.load(entries, Loader=yaml.FullLoader) or []
+    for entry in entries:
+        if not isinstance(entry, dict) or 'module' not in entry:
+            raise click.BadParameter('every entry must be an object with a module path', param_hint='ENTRIES')
+
+    started = time.time()
+    with ProcessPoolExecutor(max_workers=jobs, initializer=_init_pack_worker) as executor:
+        results = list(executor.map(_pack_entry, entries))
+
+    report = {
+        'bundles': results,
+        'failed': len([r for r in results if r['status'] != 'ok']),
+        'seconds': round(time.time() - started, 3),
+    }
+    if summary is None:
+        summary = sys.stdout
+    json.dump(report, summary, indent=2)
+    summary.write('\n')
+    if report['failed']:
+        sys.exit(1)
+
+
+@ramp.command('cache-stats')
+def cache_stats():
+    """
+    Prints build cache hits, misses and size as json.
+    """
+    from RAMP.build_cache import BuildCache
+
+    print(json.dumps(BuildCache().stats(), indent=2))
+
+
+@ramp.command('index')
+@click.argument('paths', nargs=-1, required=True)
+@click.option('--db', default=CATALOG_FILE, show_default=True, help='catalog database')
+def index_bundles(paths, db):
+    """
+    Adds bundles to a catalog, or refreshes them. PATHS are bundles or directories holding them.
+    """
+    import contextlib
+    from RAMP import catalog
+
+    with contextlib.closing(catalog.connect(db)) as conn:
+        stats = catalog.index(conn, paths)
+    print(', '.join('{} {}'.format(count, key) for key, count in stats.items()))
+    if stats['failed']:
+        sys.exit(1)
+
+
+@ramp.command('query')
+@click.option('--db', default=CATALOG_FILE, show_default=True, help='catalog database')
+@click.option('--name', '-n', 'module_name', default=None, help='module name')
+@click.option('--os', '-O', 'os_name', default=None, help='operating system, e.g. rhel9, or os, e.g. Linux')
+@click.option('--architecture', '-A', default=None, help='architecture, e.g. x86_64')
+@click.option('--capability', '-C', 'capabilities', multiple=True, help='required capability, may be repeated')
+@click.option('--command', default=None, help='command the module must provide')
+@click.option('--latest', is_flag=True, default=False, help='only the newest version of each module')
+@click.option('--json', 'json_output', is_flag=True, default=False, help='print matching bundles as json')
+def query_bundles(db, module_name, os_name, architecture, capabilities, command, latest, json_output):
+    """
+    Looks up bundles in a catalog built by `ramp index`, newest versions first.
+    """
+    import contextlib
+    from RAMP import catalog
+
+    with contextlib.closing(catalog.connect(db)) as conn:
+        results = catalog.query(conn, module_name=module_name, os_name=os_name, architecture=architecture,
+                                capabilities=capabilities, command=command, latest=latest)
+    if json_output:
+        print(json.dumps(results, indent=2))
+    else:
+        for result in results:
+            print(result['path'])
 
 
 if __name__ == '__main__':
@@ -0,0 +1,252 @@
+import re
+import struct
+from typing import Any, BinaryIO, Dict, Iterator, List, Optional, Tuple  # noqa: F401
+
+from RAMP.commands_discovery import Module, ModuleCommand
+from .common import *
+
+ELF_MAGIC = b'\x7fELF'
+
+SHT_DYNSYM = 11
+SHN_UNDEF = 0
+
+# Exported by every redis module, redis calls it on MODULE LOAD
+ONLOAD_SYMBOL = 'RedisModule_OnLoad'
+
+# Module commands are conventionally named <PREFIX>.<NAME>, e.g. GRAPH.QUERY
+COMMAND_RE = re.compile(r'^([A-Za-z][A-Za-z0-9_-]*)\.([A-Za-z][A-Za-z0-9_.|-]*)$')
+VERSION_RE = re.compile(r'^v?(\d{1,2})\.(\d{1,2})\.(\d{1,2})$')
+
+# Strings looking like <PREFIX>.<NAME> which are file names rather than commands
+FILE_EXTENSIONS = {'c', 'h', 'cc', 'cpp', 'hpp', 'rs', 'so', 'py', 'json', 'yml', 'yaml', 'txt', 'conf', 'log',
+                   'rdb', 'aof', 'tmp', 'md', 'html', 'xml', 'csv', 'sh', 'lua', 'js', 'o', 'a'}
+
+# What redis reports for module commands it knows nothing else about:
+# arity -1 (variadic) and no key positions unless the module registered them
+DEFAULT_ARITY = -1
+DEFAULT_FLAGS = ['module']
+
+_HEADER = {
+    # class: (e_shoff format, e_shoff offset, section header format)
+    1: ('I', 32, 'IIIIIIIIII'),
+    2: ('Q', 40, 'IIQQQQIIQQ'),
+}
+_SYMBOL = {
+    # class: (symbol format, offsets of st_name and st_shndx in the unpacked symbol)
+    1: ('IIIBBH', 0, 5),
+    2: ('IBBHQQ', 0, 3),
+}
+
+
+class _Section(object):
+    def __init__(self, name, sh_type, flags, offset, size, link, entsize):
+        self.name = name
+        self.type = sh_type
+        self.flags = flags
+        self.offset = offset
+        self.size = size
+        self.link = link
+        self.entsize = entsize
+
+
+def _read_at(f, offset, size):
+    # type: (BinaryIO, int, int) -> bytes
+    f.seek(offset)
+    data = f.read(size)
+    if len(data) != size:
+        raise Exception("error: truncated ELF file")
+    return data
+
+
+def _read_sections(f):
+    # type: (BinaryIO) -> Tuple[str, int, List[_Section]]
+    """
+    Reads the section headers of an ELF file, returns its byte order, class and sections.
+    Only the ELF header and the section headers are read, so this works for any architecture.
+    """
+    ident = f.read(16)
+    if len(ident) < 16 or ident[:4] != ELF_MAGIC:
+        raise Exception("error: not an ELF file")
+    elf_class, data = ident[4], ident[5]
+    if elf_class not in _HEADER or data not in (1, 2):
+        raise Exception("error: unsupported ELF class {} / data encoding {}".format(elf_class, data))
+    endian = '<' if data == 1 else '>'
+    shoff_format, shoff_offset, section_format = _HEADER[elf_class]
+
+    f.seek(shoff_offset)
+    shoff, = struct.unpack(endian + shoff_format, f.read(struct.calcsize(shoff_format)))
+    f.seek(shoff_offset + struct.calcsize(shoff_format) + 4 + 2 + 2)  # e_flags, e_ehsize, e_phentsize
+    _, shentsize, shnum, shstrndx = struct.unpack(endian + 'HHHH', f.read(8))
+    if shoff == 0 or shnum == 0:
+        raise Exception("error: the ELF file has no section headers")
+
+    headers = []
+    for i in range(shnum):
+        raw = _read_at(f, shoff + i * shentsize, struct.calcsize(section_format))
+        name, sh_type, flags, _, offset, size, link, _, _, entsize = struct.unpack(endian + section_format, raw)
+        headers.append((name, sh_type, flags, offset, size, link, entsize))
+
+    names = _read_at(f, headers[shstrndx][3], headers[shstrndx][4]) if shstrndx < shnum else b''
+    sections = [_Section(names[h[0]:names.find(b'\0', h[0])].decode('ascii', 'replace'), *h[1:])
+                for h in headers]
+    return endian, elf_class, sections
+
+
+def _strings(data, min_length=2):
+    # type: (bytes, int) -> Iterator[str]
+    """
+    Yields the printable NUL terminated strings of a string table or data section.
+    """
+    for raw in data.split(b'\0'):
+        if len(raw) < min_length:
+            continue
+        try:
+            s = raw.decode('ascii')
+        except UnicodeDecodeError:
+            continue
+        if s.isprintable():
+            yield s
+
+
+def _defined_symbols(f, endian, elf_class, sections):
+    # type: (BinaryIO, str, int, List[_Section]) -> set
+    """
+    Returns the names of the dynamic symbols the ELF file defines (as opposed to imports).
+    """
+    symbol_format, name_index, shndx_index = _SYMBOL[elf_class]
+    symbol_size = struct.calcsize(endian + symbol_format)
+    defined = set()
+    for section in sections:
+        if section.type != SHT_DYNSYM or section.link >= len(sections):
+            continue
+        strtab = sections[section.link]
+        names = _read_at(f, strtab.offset, strtab.size)
+        data = _read_at(f, section.offset, section.size)
+        for offset in range(0, len(data) - symbol_size + 1, section.entsize or symbol_size):
+            symbol = struct.unpack_from(endian + symbol_format, data, offset)
+            if symbol[shndx_index] != SHN_UNDEF:
+                start = symbol[name_index]
+                defined.add(names[start:names.find(b'\0', start)].decode('ascii', 'replace'))
+    return defined
+
+
+def read_module_strings(path):
+    # type: (str) -> List[str]
+    """
+    Returns the strings of the read only data sections of a redis module,
+    after checking it is a shared object exporting RedisModule_OnLoad.
+    """
+    with open(path, 'rb') as f:
+        endian, elf_class, sections = _read_sections(f)
+        if ONLOAD_SYMBOL not in _defined_symbols(f, endian, elf_class, sections):
+            raise Exception("error: {} does not export {}, is it a redis module?".format(path, ONLOAD_SYMBOL))
+        strings = []  # type: List[str]
+        for section in sections:
+            if section.name.startswith('.rodata') or section.name == '.data.rel.ro':
+                strings.extend(_strings(_read_at(f, section.offset, section.size)))
+    return strings
+
+
+def _command_candidates(strings):
+    # type: (List[str]) -> Dict[str, set]
+    """
+    Groups strings shaped like module commands by their prefix (upper cased).
+    """
+    candidates = {}  # type: Dict[str, set]
+    for s in strings:
+        match = COMMAND_RE.match(s)
+        if match is None or match.group(2).lower() in FILE_EXTENSIONS:
+            continue
+        candidates.setdefault(match.group(1).upper(), set()).add(s)
+    return candidates
+
+
+def _infer_prefix(candidates):
+    # type: (Dict[str, set]) -> Optional[str]
+    """
+    Picks the prefix shared by most upper case <PREFIX>.<NAME> strings, as commands are usually spelled.
+    """
+    best = None
+    best_count = 0
+    for prefix, names in sorted(candidates.items()):
+        count = len([n for n in names if n == n.upper()])
+        if count > best_count:
+            best, best_count = prefix, count
+    return best
+
+
+def _infer_version(strings):
+    # type: (List[str]) -> Optional[int]
+    versions = set()
+    for s in strings:
+        match = VERSION_RE.match(s)
+        if match:
+            major, minor, patch = (int(g) for g in match.groups())
+            versions.add(major * 10000 + minor * 100 + patch)
+    return versions.pop() if len(versions) == 1 else None
+
+
+def discover_modules_commands(path_to_module, hints=None):
+    # type: (str, Optional[Dict[str, Any]]) -> Module
+    """
+    Retrieves module command(s) info from the module binary, without loading it into redis.
+    Works for modules built for any architecture, but only recovers what the binary spells out:
+    command names are taken from its read only data, so are the module name and version when
+    they can be told apart. Everything else comes from the hints: commands found without hints are an error,
+    unless allow_unknown is set, in which case they get what redis reports for a module command registered
+    without key specs (arity -1, no keys), which is wrong for commands taking keys.
+    :param path_to_module: where does the module file is located
+    :param hints: dict with any of
+        module_name: name the module registers itself with (RedisModule_Init)
+        version: numeric module version
+        command_prefix: prefix of the module commands, defaults to the module name
+        commands: {command_name: {arity, flags, first_key, last_key, step}}, commands missing
+                  from the binary are added
+        allow_unknown: pack commands without hints with placeholder arity, flags and key positions
+    Returns Module object populated with command(s) info.
+    """
+    hints = hints or {}
+    strings = read_module_strings(path_to_module)
+    candidates = _command_candidates(strings)
+
+    module_name = hints.get('module_name')
+    prefix = hints.get('command_prefix') or (module_name if module_name and module_name.upper() in candidates
+                                             else _infer_prefix(candidates))
+    if module_name is None and prefix is not None:
+        # the name given to RedisModule_Init usually is the command prefix, often in lower case
+        module_name = next((s for s in strings if s.upper() == prefix.upper() and s.lower() == s),
+                           next((s for s in strings if s.upper() == prefix.upper()), None))
+    if module_name is None:
+        raise Exception("error: could not tell the module name of {}, set static_discovery.module_name".format(
+            path_to_module))
+
+    version = hints.get('version')
+    if version is None:
+        version = _infer_version(strings)
+    if version is None:
+        raise Exception("error: could not tell the version of {}, set static_discovery.version".format(
+            path_to_module))
+
+    command_hints = {name.lower(): hint for name, hint in (hints.get('commands') or {}).items()}
+    names = set(n.lower() for n in candidates.get(prefix.upper(), ())) if prefix else set()
+    names.update(command_hints)
+
+    module = Module(module_name, int(version))
+    unknown = []
+    for name in sorted(names):
+        hint = command_hints.get(name)
+        if hint is None:
+            unknown.append(name)
+            hint = {}
+        flags = list(hint.get('flags', []))
+        flags += [f for f in DEFAULT_FLAGS if f not in flags]
+        module.add_command(ModuleCommand(name, hint.get('arity', DEFAULT_ARITY), flags,
+                                         hint.get('first_key', 0), hint.get('last_key', 0), hint.get('step', 0)))
+    if unknown and not hints.get('allow_unknown'):
+        raise Exception("error: flags and key positions of {} command(s) of {} are unknown, set them in "
+                        "static_discovery.commands or set static_discovery.allow_unknown: {}".format(
+                            len(unknown), path_to_module, ' '.join(unknown)))
+    if unknown:
+        eprint("static discovery: flags and key positions of {} command(s) are unknown, "
+               "packing them with arity {} and no keys: {}".format(len(unknown), DEFAULT_ARITY, ' '.join(unknown)))
+    return module
@@ -0,0 +1,113 @@
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional  # noqa: F401
+
+# Formats spans can be written in: plain json, or the Chrome trace event format
+# (loadable in chrome://tracing or https://ui.perfetto.dev)
+FORMATS = ['json', 'chrome']
+
+# Recorded spans while recording is enabled, None otherwise
+_spans = None  # type: Optional[List[Dict[str, Any]]]
+_origin = 0.0
+_local = threading.local()
+
+
+def enable():
+    # type: () -> None
+    """
+    Starts recording spans, dropping the ones recorded before.
+    """
+    global _spans, _origin
+    _origin = time.perf_counter()
+    _spans = []
+
+
+def disable():
+    # type: () -> None
+    global _spans
+    _spans = None
+
+
+def enabled():
+    # type: () -> bool
+    return _spans is not None
+
+
+@contextmanager
+def span(name, **args):
+    # type: (str, Any) -> Iterator[None]
+    """
+    Records how long the block takes under `name`. Costs next to nothing while recording is disabled.
+    :param args: details shown with the span, e.g. the file being processed
+    """
+    spans = _spans
+    if spans is None:
+        yield
+        return
+    depth = getattr(_local, 'depth', 0)
+    _local.depth = depth + 1
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        end = time.perf_counter()
+        _local.depth = depth
+        spans.append({'name': name, 'start': start - _origin, 'duration': end - start, 'depth': depth,
+                      'thread': threading.current_thread().name, 'tid': threading.get_ident(), 'args': args})
+
+
+def spans():
+    # type: () -> List[Dict[str, Any]]
+    """
+    Returns the recorded spans ordered by start time.
+    """
+    return sorted(_spans or [], key=lambda s: (s['start'], s['depth']))
+
+
+def summary():
+    # type: () -> str
+    """
+    Returns the recorded spans as a table, nested spans indented under the span they ran in.
+    """
+    lines = ['{:>10}  {}'.format('ms', 'phase')]
+    for s in spans():
+        detail = ' '.join('{}={}'.format(k, v) for k, v in sorted(s['args'].items()))
+        thread = '' if s['thread'] == 'MainThread' else ' [{}]'.format(s['thread'])
+        lines.append('{:>10.1f}  {}{}{}{}'.format(s['duration'] * 1000, '  ' * s['depth'], s['name'],
+                                                  ' ' + detail if detail else '', thread))
+    return '\n'.join(lines)
+
+
+def chrome_trace():
+    # type: () -> Dict[str, Any]
+    """
+    Returns the recorded spans as complete ("X") events of the Chrome trace event format.
+    """
+    pid = os.getpid()
+    return {
+        'displayTimeUnit': 'ms',
+        'traceEvents': [{'name': s['name'], 'ph': 'X', 'pid': pid, 'tid': s['tid'],
+                         'ts': round(s['start'] * 1e6, 1), 'dur': round(s['duration'] * 1e6, 1),
+                         'args': {k: str(v) for k, v in s['args'].items()}} for s in spans()],
+    }
+
+
+def write(path, fmt='json'):
+    # type: (str, str) -> None
+    """
+    Writes the recorded spans to path, in one of FORMATS.
+    """
+    if fmt not in FORMATS:
+        raise Exception("error: unknown timings format {}, expected one of {}".format(fmt, ', '.join(FORMATS)))
+    if fmt == 'chrome':
+        data = chrome_trace()  # type: Any
+    else:
+        data = {'spans': [{'name': s['name'], 'start': round(s['start'], 6), 'duration': round(s['duration'], 6),
+                           'depth': s['depth'], 'thread': s['thread'],
+                           'args': {k: str(v) for k, v in s['args'].items()}} for s in spans()]}
+    with open(path, 'w') as f:
+        json.dump(data, f, indent=2)
+        f.write('\n')
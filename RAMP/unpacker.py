@@ -1,12 +1,24 @@
+import io
+import os
 import json
 import re
+import hashlib
+import shutil
+import tempfile
 from zipfile import ZipFile, BadZipfile
-from typing import Dict, Any, IO, Tuple, Optional  # noqa: F401
+from typing import Dict, Any, IO, Iterator, List, Tuple, Optional  # noqa: F401
 from .common import *
 
 
 INVALID_METADATA = "module metadata invalid"
 
+# Read size used when extracting bundle entries to disk
+COPY_BUFFER_SIZE = 4 * 1024 * 1024
+
+# Bundles read from streams which can't seek (e.g. stdin) are buffered in memory up to
+# this size, larger bundles spill over to a temporary file
+SPOOL_MAX_SIZE = 64 * 1024 * 1024
+
 class UnpackerPackageError(Exception):
     """
     Represents an error within the unpacking process
@@ -24,36 +36,281 @@ class UnpackerPackageError(Exception):
         return "{}, reason: {}".format(super(UnpackerPackageError, self).__str__(), self.reason)
 
 
+class _VerifyingReader(io.RawIOBase):
+    """
+    Reads a bundle entry computing its sha256 on the way,
+    the checksum is verified as soon as the entry has been read to its end.
+    """
+
+    def __init__(self, stream, expected_sha256, error_message, error_code):
+        # type: (IO[bytes], str, str, str) -> None
+        super(_VerifyingReader, self).__init__()
+        self._stream = stream
+        self._expected_sha256 = expected_sha256
+        self._sha256 = hashlib.sha256()
+        self._error_message = error_message
+        self._error_code = error_code
+        self.verified = False
+
+    def readable(self):
+        # type: () -> bool
+        return True
+
+    def readinto(self, b):
+        # type: (Any) -> int
+        n = self._stream.readinto(b)
+        if n:
+            self._sha256.update(memoryview(b)[:n])
+        elif not self.verified and len(b) > 0:
+            self._verify()
+        return n
+
+    def _verify(self):
+        # type: () -> None
+        if self._sha256.hexdigest() != self._expected_sha256:
+            raise UnpackerPackageError(message=self._error_message,
+                                       reason="Wrong signature",
+                                       error_code=self._error_code)
+        self.verified = True
+
+    def close(self):
+        # type: () -> None
+        self._stream.close()
+        super(_VerifyingReader, self).close()
+
+
+def verifying_stream(stream, expected_sha256, error_message, error_code):
+    # type: (IO[bytes], Optional[str], str, str) -> IO[bytes]
+    """
+    Wraps stream so its sha256 is checked against expected_sha256 once it's been read,
+    streams without a known checksum are returned as is.
+    """
+    if not expected_sha256:
+        return stream
+    # default buffer size: the buffer is allocated upfront for every entry opened, and large reads
+    # (like extract_to's) go around it anyway
+    return io.BufferedReader(_VerifyingReader(stream, expected_sha256, error_message, error_code))
+
+
+def dependency_sha256(metadata, filename):
+    # type: (Dict[str, Any], str) -> Optional[str]
+    """
+    Returns the sha256 recorded in the metadata for a deps/<name>.tgz bundle entry.
+    """
+    name = filename[len('deps/'):-len('.tgz')] if filename.startswith('deps/') and filename.endswith('.tgz') else None
+    for key in ['dependencies', 'optional-dependencies']:
+        deps = metadata.get(key)
+        if isinstance(deps, dict) and isinstance(deps.get(name), dict):
+            return deps[name].get('sha256')
+    return None
+
+
+class BundleEntry(object):
+    """
+    A file within a bundle
+    """
+
+    def __init__(self, name, kind, size, compressed_size):
+        # type: (str, str, int, int) -> None
+        self.name = name
+        self.kind = kind  # one of "metadata", "module" or "dependency"
+        self.size = size
+        self.compressed_size = compressed_size
+
+
+def seekable(bundle, spool_max_size=SPOOL_MAX_SIZE):
+    # type: (Any, int) -> Any
+    """
+    Returns bundle if it is a path or a seekable file, otherwise a seekable copy of the stream:
+    in memory up to spool_max_size bytes, in a temporary file beyond that.
+    """
+    if isinstance(bundle, (str, bytes, os.PathLike)):
+        return bundle
+    try:
+        if bundle.seekable():
+            return bundle
+    except (AttributeError, ValueError):
+        pass
+    spool = tempfile.SpooledTemporaryFile(max_size=spool_max_size)
+    shutil.copyfileobj(bundle, spool, COPY_BUFFER_SIZE)
+    spool.seek(0)
+    return spool
+
+
+def open_zip(bundle, spool_max_size=SPOOL_MAX_SIZE):
+    # type: (Any, int) -> ZipFile
+    """
+    Opens the zip file of a bundle given as a path or file object, a ZipFile is returned as is.
+    A stream which can't seek is spooled first (see seekable), the copy belongs to the zip file:
+    it is closed once the zip file and every entry opened from it are closed.
+    :raises: UnpackerPackageError
+    """
+    if isinstance(bundle, ZipFile):
+        return bundle
+    source = seekable(bundle, spool_max_size)
+    try:
+        zf = ZipFile(source)
+    except BaseException as e:
+        if source is not bundle:
+            source.close()
+        if isinstance(e, BadZipfile):
+            raise UnpackerPackageError(message="Failed to extract bundle")
+        raise
+    if source is not bundle:
+        # as if the zip file had opened it itself
+        zf._filePassed = False
+    return zf
+
+
+class Bundle(object):
+    """
+    A bundle opened for reading: the metadata is read and validated right away,
+    the module and deps are only opened (and decompressed) when asked for.
+    Use as a context manager, or close() it once done.
+    """
+
+    def __init__(self, bundle, spool_max_size=SPOOL_MAX_SIZE):
+        # type: (Any, int) -> None
+        """
+        :param bundle: path, file object or opened ZipFile of the bundle, which then belongs to the Bundle.
+        Streams which can't seek, like stdin, are first copied: in memory up to spool_max_size bytes,
+        in a temporary file beyond that. The copy is removed once the bundle and its entries are closed.
+        """
+        self._zf = None
+        try:
+            self._zf = open_zip(bundle, spool_max_size)
+            _validate_zip_file(self._zf)
+            with self._zf.open('module.json') as f:
+                self.metadata = json.load(f)
+            validate_metadata(self.metadata)
+
+        except BadZipfile:
+            self.close()
+            raise UnpackerPackageError(message="Failed to extract bundle")
+
+        except (IOError, ValueError):
+            self.close()
+            raise UnpackerPackageError("Failed to read module.json")
+
+        except BaseException:  # includes exceptions raised by validator-methods
+            self.close()
+            raise
+
+    def _kind(self, filename):
+        # type: (str) -> Optional[str]
+        if filename == 'module.json':
+            return "metadata"
+        if filename == self.metadata["module_file"]:
+            return "module"
+        if filename == "deps/":
+            return None
+        return "dependency"
+
+    def entries(self):
+        # type: () -> Iterator[BundleEntry]
+        """
+        Iterates over the files within the bundle, without reading them.
+        """
+        for info in self._zf.infolist():
+            kind = self._kind(info.filename)
+            if kind is not None:
+                yield BundleEntry(info.filename, kind, info.file_size, info.compress_size)
+
+    def dependencies(self):
+        # type: () -> List[str]
+        """
+        Returns the names of the dependency files within the bundle.
+        """
+        return [entry.name for entry in self.entries() if entry.kind == "dependency"]
+
+    def open_module(self):
+        # type: () -> IO[bytes]
+        """
+        Opens the module, its checksum is verified once it has been read to its end.
+        """
+        return verifying_stream(self._zf.open(self.metadata["module_file"]), self.metadata.get("sha256"),
+                                "module did not pass sanity validation", "module_sha256_mismatch")
+
+    def open_dependency(self, filename):
+        # type: (str) -> IO[bytes]
+        """
+        Opens a dependency file, its checksum is verified once it has been read to its end.
+        """
+        return verifying_stream(self._zf.open(filename), dependency_sha256(self.metadata, filename),
+                                "dependency {} did not pass sanity validation".format(filename),
+                                "dependency_sha256_mismatch")
+
+    def close(self):
+        # type: () -> None
+        """
+        Closes the bundle. Module and deps already opened remain readable until they are closed.
+        """
+        if self._zf is not None:
+            self._zf.close()
+
+    def __enter__(self):
+        # type: () -> Bundle
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        # type: (Any, Any, Any) -> None
+        self.close()
+
+
+def open_bundle(bundle, spool_max_size=SPOOL_MAX_SIZE):
+    # type: (Any, int) -> Bundle
+    """
+    Opens a bundled module for reading, performs sanity validation on bundle.
+    :raises: UnpackerPackageError
+    """
+    return Bundle(bundle, spool_max_size)
+
+
 def unpack(bundle):
     # type: (IO[bytes]) -> Tuple[Dict[str, Any], IO[bytes], Dict[str, IO[bytes]]]
     """
     Unpacks a bundled module, performs sanity validation on bundle.
-    the module metadata, the actual module and bundle deps are returned
+    the module metadata, the actual module and bundle deps are returned.
+    The module and deps are checked against their sha256 while they are read,
+    reading one to its end raises UnpackerPackageError if it was tampered with.
     :rtype: tuple
     """
-    deps_files = dict()
+    with open_bundle(bundle) as reader:
+        module = reader.open_module()
+        deps_files = dict((filename, reader.open_dependency(filename)) for filename in reader.dependencies())
+
+    return reader.metadata, module, deps_files
+
+
+def verify(module, deps_files):
+    # type: (IO[bytes], Dict[str, IO[bytes]]) -> None
+    """
+    Reads the module and deps returned by unpack to their end, so their checksums get verified.
+    :raises: UnpackerPackageError
+    """
+    for stream in [module] + list(deps_files.values()):
+        while stream.read(COPY_BUFFER_SIZE):
+            pass
+
+
+def extract_to(stream, path, buffer_size=COPY_BUFFER_SIZE):
+    # type: (IO[bytes], str, int) -> None
+    """
+    Copies a bundle entry to path in fixed size chunks.
+    Data goes to a temporary file next to path which is renamed into place once complete,
+    so path never holds a partially written file.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(path))
     try:
-        with ZipFile(bundle) as zf:
-            _validate_zip_file(zf)
-            metadata = json.load(zf.open('module.json'))
-            module = zf.open(metadata["module_file"])
-            _validate_metadata(metadata)
-            for filename in zf.namelist():
-                if filename in ['module.json', metadata["module_file"], "deps/"]:
-                    continue
-                deps_files[filename] = zf.open(filename)
-
-    except BadZipfile:
-        raise UnpackerPackageError(message="Failed to extract bundle")
-
-    except (IOError, ValueError):
-        raise UnpackerPackageError("Failed to read module.json")
-
-    except UnpackerPackageError:  # re-raise exceptions raised by validator-methods
+        with os.fdopen(fd, 'wb') as outfile:
+            shutil.copyfileobj(stream, outfile, buffer_size)
+        os.chmod(tmp_path, default_file_mode())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
         raise
 
-    return metadata, module, deps_files
-
 
 def _validate_zip_file(zip_file):
     # type: (ZipFile) -> None
@@ -73,7 +330,7 @@ def _validate_zip_file(zip_file):
                                    error_code="invalid_number_of_files")
 
 
-def _validate_metadata(metadata):
+def validate_metadata(metadata):
     # type: (Dict[str, Any]) -> None
     """
     Checks metadata isn't missing any required fields
@@ -115,14 +372,7 @@ def _validate_metadata(metadata):
             except UnpackerPackageError:
                 raise
 
-    # wrong signature
-    # TODO: this check should be deferred to a later stage
-    # As sha256_checksum will read entire module file
-    # And we're unable to seek it back to its starting point.
-    # if sha256_checksum(module) != metadata["sha256"]:
-    # [If needed, use module_metadata.sha256_checksum]
-    #     raise UnpackerPackageError(message="module did not pass sanity validation",
-    #                                reason="Wrong signature")
+    # wrong signature is detected while the module is read, see _VerifyingReader
 
 
 def _os_version_parser(os_version):
@@ -0,0 +1,64 @@
+"""
+Compares bundle compressions: pack time, unpack time and bundle size per compression.
+
+    python -m benchmarks.compression [--module-size MB] [--deps N] [--dep-size MB] [--module PATH] [--json]
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+
+from RAMP import unpacker
+from benchmarks.synthetic import make_module, make_dependency, make_bundle
+
+MB = 1024 * 1024
+
+
+def bench_compression(module_path, dep_dirs, compression, level, out_dir):
+    bundle = os.path.join(out_dir, 'bundle-%s-%s.zip' % (compression, level))
+
+    started = time.time()
+    make_bundle(module_path, bundle, dep_dirs, compression, level)
+    pack_seconds = time.time() - started
+
+    started = time.time()
+    _, module, deps = unpacker.unpack(bundle)
+    while module.read(MB):
+        pass
+    for dep in deps.values():
+        while dep.read(MB):
+            pass
+    unpack_seconds = time.time() - started
+
+    return {'compression': compression, 'level': level, 'bundle_bytes': os.path.getsize(bundle),
+            'pack_seconds': round(pack_seconds, 3), 'unpack_seconds': round(unpack_seconds, 3)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--module', help='benchmark this module instead of a synthetic one')
+    parser.add_argument('--module-size', type=int, default=64, help='synthetic module size in MB')
+    parser.add_argument('--deps', type=int, default=2, help='number of synthetic dependencies')
+    parser.add_argument('--dep-size', type=int, default=16, help='size of each synthetic dependency in MB')
+    parser.add_argument('--json', action='store_true', help='print results as json')
+    args = parser.parse_args()
+
+    policies = [('store', None), ('deflate', 1), ('deflate', None), ('deflate', 9), ('bzip2', None), ('lzma', None)]
+    with tempfile.TemporaryDirectory() as temp_dir:
+        module_path = args.module or make_module(os.path.join(temp_dir, 'bench.so'), args.module_size * MB)
+        dep_dirs = [make_dependency(temp_dir, 'dep%d' % i, args.dep_size * MB, seed=i) for i in range(args.deps)]
+        results = [bench_compression(module_path, dep_dirs, compression, level, temp_dir)
+                   for compression, level in policies]
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print('%-10s %6s %14s %12s %12s' % ('method', 'level', 'bundle bytes', 'pack s', 'unpack s'))
+    for r in results:
+        print('%-10s %6s %14d %12.3f %12.3f' % (r['compression'], r['level'] if r['level'] is not None else '-',
+                                                 r['bundle_bytes'], r['pack_seconds'], r['unpack_seconds']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+"""
+Measures delta bundles: their size compared to the full bundle, and how long they take to create and apply.
+
+    python -m benchmarks.delta [--module-size MB] [--edits N] [--insert KB] [--rebuilt]
+                               [--old BUNDLE --new BUNDLE] [--json]
+
+Without --old/--new, the new module is a synthetic module with `--edits` scattered single byte changes
+(like relocated addresses) and `--insert` KB of new code in the middle, the kind of change a patch release makes.
+With --rebuilt, the new module shares nothing with the old one, like a rebuild with another toolchain:
+the worst case for creating a delta, which ends up writing the full bundle.
+"""
+import argparse
+import json
+import os
+import random
+import tempfile
+import time
+
+from RAMP import delta
+from benchmarks.synthetic import make_module, make_bundle
+
+MB = 1024 * 1024
+
+
+def make_bundles(temp_dir, module_size, edits, insert, seed=0, rebuilt=False):
+    os.makedirs(os.path.join(temp_dir, 'old'))
+    old_module = make_module(os.path.join(temp_dir, 'old', 'bench.so'), module_size, seed)
+    source = make_module(os.path.join(temp_dir, 'rebuilt.so'), module_size, seed + 1) if rebuilt else old_module
+    with open(source, 'rb') as f:
+        data = bytearray(f.read())
+    rnd = random.Random(seed)
+    for _ in range(edits):
+        data[rnd.randrange(len(data))] = rnd.randrange(256)
+    middle = len(data) // 2
+    data[middle:middle] = os.urandom(insert)
+    os.makedirs(os.path.join(temp_dir, 'new'))
+    new_module = os.path.join(temp_dir, 'new', 'bench.so')
+    with open(new_module, 'wb') as f:
+        f.write(bytes(data))
+
+    return [make_bundle(module_path, os.path.join(os.path.dirname(module_path), 'bench.zip'))
+            for module_path in [old_module, new_module]]
+
+
+def bench_delta(old_bundle, new_bundle, out_dir, runs):
+    delta_bundle = os.path.join(out_dir, 'bench.delta.zip')
+    create_seconds = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        stats = delta.create_delta(old_bundle, new_bundle, delta_bundle)
+        create_seconds.append(time.perf_counter() - started)
+
+    apply_seconds = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        _, module, _ = delta.open_delta(delta_bundle, old_bundle)
+        while module.read(MB):
+            pass
+        apply_seconds.append(time.perf_counter() - started)
+
+    stats.update({'ratio': round(stats['delta_bytes'] / stats['bundle_bytes'], 4),
+                  'create_seconds': round(min(create_seconds), 3),
+                  'apply_seconds': round(min(apply_seconds), 3)})
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--old', help='old bundle, instead of a synthetic one')
+    parser.add_argument('--new', help='new bundle, instead of a synthetic one')
+    parser.add_argument('--module-size', type=float, default=32, help='synthetic module size in MB')
+    parser.add_argument('--edits', type=int, default=5000, help='scattered byte changes in the new module')
+    parser.add_argument('--insert', type=int, default=16, help='KB of code inserted into the new module')
+    parser.add_argument('--rebuilt', action='store_true', help='new module unrelated to the old one')
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--json', action='store_true', help='print results as json')
+    args = parser.parse_args()
+    if bool(args.old) != bool(args.new):
+        parser.error('--old and --new go together')
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        if args.old:
+            old_bundle, new_bundle = args.old, args.new
+        else:
+            old_bundle, new_bundle = make_bundles(temp_dir, int(args.module_size * MB), args.edits, args.insert * 1024,
+                                                   rebuilt=args.rebuilt)
+        result = bench_delta(old_bundle, new_bundle, temp_dir, args.runs)
+
+    if args.json:
+        print(json.dumps(result, indent=2))
+    else:
+        print('bundle %d bytes, %s %d bytes (%.2f%%), created in %.3fs, applied in %.3fs' % (
+            result['bundle_bytes'], 'full bundle' if result['full'] else 'delta', result['delta_bytes'],
+            result['ratio'] * 100, result['create_seconds'], result['apply_seconds']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+"""
+Measures how long importing the CLI takes, and fails when it goes over a budget.
+
+    python -m benchmarks.import_time [--budget MS] [--runs N] [--top N] [--json]
+
+Every run is a fresh interpreter started with `-X importtime`, the best run is reported together
+with the modules taking most of it. The exit status is 1 when the import takes longer than the
+budget, so the check can guard CI against eager imports of redis, yaml or the packer creeping back.
+"""
+import argparse
+import json
+import subprocess
+import sys
+
+MODULE = 'RAMP.ramp'
+
+
+def import_times(module=MODULE):
+    """
+    Imports module in a fresh interpreter, returns the cumulative import time of every module in microseconds.
+    """
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    times = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        times[name.strip()] = int(cumulative)
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--budget', type=float, default=150, help='maximum import time of %s in ms' % MODULE)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--top', type=int, default=10, help='number of slowest modules to show')
+    parser.add_argument('--json', action='store_true', help='print results as json')
+    args = parser.parse_args()
+
+    best = min((import_times() for _ in range(args.runs)), key=lambda times: times[MODULE])
+    total_ms = best[MODULE] / 1000.0
+    top = sorted(((name, us) for name, us in best.items() if name != MODULE), key=lambda item: -item[1])[:args.top]
+    result = {'module': MODULE, 'ms': round(total_ms, 1), 'budget_ms': args.budget,
+              'top': [{'module': name, 'ms': round(us / 1000.0, 1)} for name, us in top]}
+
+    if args.json:
+        print(json.dumps(result, indent=2))
+    else:
+        print('import %s: %.1f ms (budget %.0f ms)' % (MODULE, total_ms, args.budget))
+        for name, us in top:
+            print('  %8.1f ms  %s' % (us / 1000.0, name))
+    if total_ms > args.budget:
+        print('over budget', file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
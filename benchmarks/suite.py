@@ -0,0 +1,218 @@
+"""
+Times the main RAMP code paths on synthetic inputs and writes the results as json,
+so runs of different releases can be compared.
+
+    python -m benchmarks.suite [--module-size MB] [--commands N] [--deps N] [--dep-size MB] [--dep-files N]
+                               [--module PATH] [--runs N] [--output FILE] [--baseline FILE] [--threshold RATIO]
+
+Benchmarks: packer.archive, unpacker.unpack (reading and verifying every entry), the CLI `unpack` and
+`validate` commands, and, given a real module with --module and a redis-server to load it into,
+discover_modules_commands and packer.package. Those two are recorded as skipped otherwise.
+
+With --baseline, every benchmark's best time is compared to the one in the baseline file and the
+exit status is 1 when any got slower by more than --threshold.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+from click.testing import CliRunner
+
+from RAMP import packer, unpacker, ramp
+from RAMP.commands_discovery import discover_modules_commands
+from RAMP.disposableredis import REDIS_PATH_ENVVAR
+from RAMP.version import VERSION
+from benchmarks.synthetic import make_module, make_dependency, make_commands, make_bundle
+
+MB = 1024 * 1024
+
+# Bump when results stop being comparable with earlier ones
+SUITE_FORMAT = 1
+
+
+def timed(func, runs):
+    """
+    Calls func `runs` times, returns the wall clock seconds of every call.
+    """
+    seconds = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        func()
+        seconds.append(time.perf_counter() - started)
+    return seconds
+
+
+def summarize(seconds, size=None):
+    result = {'seconds': [round(s, 4) for s in seconds],
+              'best': round(min(seconds), 4),
+              'median': round(statistics.median(seconds), 4)}
+    if size is not None:
+        result['bytes'] = size
+        result['mb_per_second'] = round(size / MB / min(seconds), 1)
+    return result
+
+
+def skipped(reason):
+    return {'skipped': reason}
+
+
+def drain(stream):
+    while stream.read(MB):
+        pass
+
+
+def bench_archive(module_path, dep_dirs, commands, out_dir, runs):
+    bundle = os.path.join(out_dir, 'bench.zip')
+
+    def archive():
+        make_bundle(module_path, bundle, dep_dirs, commands=commands)
+
+    size = os.path.getsize(module_path) + sum(packer._tree_size(d) for d in dep_dirs)
+    return bundle, summarize(timed(archive, runs), size)
+
+
+def bench_unpack(bundle, runs):
+    def unpack():
+        _, module, deps = unpacker.unpack(bundle)
+        drain(module)
+        for dep in deps.values():
+            drain(dep)
+
+    return summarize(timed(unpack, runs), os.path.getsize(bundle))
+
+
+def bench_cli(command, argv, cwd, runs):
+    runner = CliRunner()
+
+    def invoke():
+        original_cwd = os.getcwd()
+        os.chdir(cwd)
+        try:
+            result = runner.invoke(command, argv)
+        finally:
+            os.chdir(original_cwd)
+        if result.exit_code != 0:
+            raise RuntimeError(result.output)
+
+    return summarize(timed(invoke, runs))
+
+
+def bench_discovery(module_path, module_args, runs):
+    return summarize(timed(lambda: discover_modules_commands(module_path, module_args), runs))
+
+
+def bench_package(module_path, module_args, out_dir, runs):
+    argv = [module_path, '-o', os.path.join(out_dir, 'package.zip'), '-c', module_args,
+            '--no-discovery-cache', '--no-build-cache']
+
+    def package():
+        with ramp.pack.make_context('pack', list(argv)) as ctx, contextlib.redirect_stdout(io.StringIO()):
+            packer.package(ctx.params.pop('module'), **ctx.params)
+
+    return summarize(timed(package, runs), os.path.getsize(module_path))
+
+
+def run(args):
+    redis_server = shutil.which(os.getenv(REDIS_PATH_ENVVAR, 'redis-server'))
+    benchmarks = {}
+    with tempfile.TemporaryDirectory() as temp_dir:
+        module_path = args.module or make_module(os.path.join(temp_dir, 'bench.so'), int(args.module_size * MB))
+        dep_dirs = [make_dependency(temp_dir, 'dep%d' % i, int(args.dep_size * MB), files=args.dep_files, seed=i)
+                    for i in range(args.deps)]
+        commands = make_commands(args.commands)
+        out_dir = os.path.join(temp_dir, 'out')
+        os.mkdir(out_dir)
+
+        bundle, benchmarks['archive'] = bench_archive(module_path, dep_dirs, commands, temp_dir, args.runs)
+        benchmarks['unpack'] = bench_unpack(bundle, args.runs)
+        benchmarks['cli_unpack'] = bench_cli(ramp.unpack, [bundle], out_dir, args.runs)
+        benchmarks['cli_validate'] = bench_cli(ramp.validate, [bundle], out_dir, args.runs)
+
+        if not args.module:
+            reason = 'needs a real module, see --module'
+            benchmarks['discovery'] = benchmarks['package'] = skipped(reason)
+        elif redis_server is None:
+            reason = 'redis-server not found'
+            benchmarks['discovery'] = benchmarks['package'] = skipped(reason)
+        else:
+            benchmarks['discovery'] = bench_discovery(module_path, args.module_args, args.runs)
+            benchmarks['package'] = bench_package(module_path, args.module_args, out_dir, args.runs)
+
+    return {
+        'format': SUITE_FORMAT,
+        'ramp': VERSION,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'started': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'params': {'module': args.module, 'module_size_mb': args.module_size, 'commands': args.commands,
+                   'deps': args.deps, 'dep_size_mb': args.dep_size, 'dep_files': args.dep_files, 'runs': args.runs},
+        'benchmarks': benchmarks,
+    }
+
+
+def compare(results, baseline, threshold):
+    """
+    Prints how the best times moved relative to a baseline, returns the names of benchmarks which regressed.
+    """
+    if baseline.get('params') != results['params']:
+        print('warning: the baseline was run with different parameters', file=sys.stderr)
+    regressions = []
+    print('%-14s %10s %10s %8s' % ('benchmark', 'baseline', 'current', 'ratio'))
+    for name, current in sorted(results['benchmarks'].items()):
+        before = baseline.get('benchmarks', {}).get(name, {})
+        if 'best' not in current or 'best' not in before:
+            continue
+        ratio = current['best'] / before['best'] if before['best'] else float('inf')
+        regressed = ratio > 1 + threshold
+        if regressed:
+            regressions.append(name)
+        print('%-14s %10.4f %10.4f %7.2fx%s' % (name, before['best'], current['best'], ratio,
+                                                '  REGRESSION' if regressed else ''))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--module', help='benchmark this module instead of a synthetic one, enables discovery')
+    parser.add_argument('--module-args', default='', help='command line arguments of --module')
+    parser.add_argument('--module-size', type=float, default=64, help='synthetic module size in MB')
+    parser.add_argument('--commands', type=int, default=100, help='number of commands in the bundle metadata')
+    parser.add_argument('--deps', type=int, default=2, help='number of synthetic dependencies')
+    parser.add_argument('--dep-size', type=float, default=16, help='size of each synthetic dependency in MB')
+    parser.add_argument('--dep-files', type=int, default=4, help='number of files in each dependency')
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--output', '-o', help='write the results to this file instead of stdout')
+    parser.add_argument('--baseline', help='results of an earlier run to compare with')
+    parser.add_argument('--threshold', type=float, default=0.2, help='slowdown ratio reported as a regression')
+    args = parser.parse_args()
+
+    results = run(args)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+            f.write('\n')
+    else:
+        print(json.dumps(results, indent=2))
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get('format') != SUITE_FORMAT:
+            print('error: the baseline has format {}, expected {}'.format(baseline.get('format'), SUITE_FORMAT),
+                  file=sys.stderr)
+            sys.exit(2)
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+"""
+Synthetic modules and dependencies for benchmarks.
+"""
+import contextlib
+import io
+import os
+import random
+
+from RAMP import packer, module_metadata
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def make_module(path, size, seed=0):
+    """
+    Writes a fake module binary of `size` bytes: an ELF magic followed by a mix of
+    random bytes (code) and repetitive data (symbol tables, debug info), so it
+    compresses roughly like a real module.
+    """
+    rnd = random.Random(seed)
+    text = b''.join(b'RedisModule_%08x\x00' % rnd.getrandbits(32) for _ in range(CHUNK_SIZE // 20))
+    written = 0
+    with open(path, 'wb') as f:
+        f.write(b'\x7fELF')
+        written += 4
+        while written < size:
+            n = min(CHUNK_SIZE, size - written)
+            if rnd.random() < 0.5:
+                f.write(rnd.randbytes(n) if hasattr(rnd, 'randbytes') else os.urandom(n))
+            else:
+                f.write(text[:n])
+            written += n
+    return path
+
+
+def make_dependency(directory, name, size, files=4, seed=0):
+    """
+    Creates a dependency directory of `files` fake libraries, `size` bytes in total.
+    """
+    dep_dir = os.path.join(directory, name)
+    os.makedirs(dep_dir, exist_ok=True)
+    for i in range(files):
+        make_module(os.path.join(dep_dir, 'lib%s%d.so' % (name, i)), max(size // files, 4), seed=seed + i)
+    return dep_dir
+
+
+def make_commands(count, prefix='synthetic'):
+    """
+    Returns `count` command entries as found in module.json.
+    """
+    return [{"command_name": "%s.CMD%d" % (prefix, i),
+             "command_arity": -2,
+             "flags": ["write", "denyoom", "module"],
+             "first_key": 1,
+             "last_key": 1,
+             "step": 1} for i in range(count)]
+
+
+def make_bundle(module_path, bundle, dep_dirs=(), compression=packer.COMPRESSION, compression_level=None,
+                **metadata):
+    """
+    Packs module_path into bundle as module `bench`, with dep_dirs embedded as local dependencies
+    and metadata overriding the defaults. The module checksum is computed while archiving.
+    """
+    fields = module_metadata.create_default_metadata(module_path, checksum=False)
+    fields['module_name'] = 'bench'
+    fields['dependencies'] = {os.path.basename(d): {'url': 'http://example.com', 'local_path': d} for d in dep_dirs}
+    fields.update(metadata)
+    with contextlib.redirect_stdout(io.StringIO()):
+        packer.archive(module_path, fields, archive_name=bundle, compression=compression,
+                       compression_level=compression_level)
+    return bundle
@@ -0,0 +1,65 @@
+"""
+Measures `ramp unpack` throughput on a large module.
+
+    python -m benchmarks.unpack [--module-size MB] [--compression NAME] [--module PATH] [--json]
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+
+from click.testing import CliRunner
+
+from RAMP import packer, ramp
+from benchmarks.synthetic import make_module, make_bundle
+
+MB = 1024 * 1024
+
+
+def bench_unpack(bundle, out_dir):
+    runner = CliRunner()
+    original_cwd = os.getcwd()
+    os.chdir(out_dir)
+    try:
+        started = time.time()
+        result = runner.invoke(ramp.unpack, [bundle])
+        seconds = time.time() - started
+    finally:
+        os.chdir(original_cwd)
+    if result.exit_code != 0:
+        raise RuntimeError(result.output)
+    return seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--module', help='benchmark this module instead of a synthetic one')
+    parser.add_argument('--module-size', type=int, default=300, help='synthetic module size in MB')
+    parser.add_argument('--compression', default='deflate', choices=sorted(packer.COMPRESSIONS))
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--json', action='store_true', help='print results as json')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        module_path = args.module or make_module(os.path.join(temp_dir, 'bench.so'), args.module_size * MB)
+        module_bytes = os.path.getsize(module_path)
+        bundle = os.path.join(temp_dir, 'bench.zip')
+        make_bundle(module_path, bundle, compression=args.compression)
+
+        out_dir = os.path.join(temp_dir, 'out')
+        os.mkdir(out_dir)
+        runs = [bench_unpack(bundle, out_dir) for _ in range(args.runs)]
+
+    best = min(runs)
+    result = {'module_bytes': module_bytes, 'compression': args.compression,
+              'seconds': [round(r, 3) for r in runs], 'best_mb_per_second': round(module_bytes / MB / best, 1)}
+    if args.json:
+        print(json.dumps(result, indent=2))
+    else:
+        print('unpacked %d MB (%s) in %.3fs at best, %.1f MB/s' % (
+            module_bytes // MB, args.compression, best, result['best_mb_per_second']))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,19 @@
 import os
 import yaml
 import click
+import atexit
+import shutil
 import hashlib
+import tempfile
 from click.testing import CliRunner
 
 from module_capabilities import MODULE_CAPABILITIES
-from RAMP import ramp, packer, unpacker, module_metadata
+from RAMP import ramp, packer, unpacker, module_metadata, commands_discovery, cache
+
+# keep the caches these tests fill out of ~/.cache/ramp, so they neither pollute it nor pass thanks to an earlier run
+TEST_CACHE_DIR = tempfile.mkdtemp(prefix='ramp-test-cache-')
+os.environ[cache.CACHE_DIR_ENVVAR] = TEST_CACHE_DIR
+atexit.register(shutil.rmtree, TEST_CACHE_DIR, True)
 
 
 MODULE_FILE = "redisgraph.so"
@@ -103,6 +111,107 @@ def test_defaults():
 
     validate_module_commands(metadata["commands"])
 
+def test_batched_command_info():
+    """Test batched COMMAND INFO matches the per-command lookup."""
+    with commands_discovery.redis({}) as redis_client:
+        commands_discovery._load_module(redis_client, MODULE_FILE_PATH, "")
+        names = ["graph.QUERY", "graph.DELETE", "graph.EXPLAIN"]
+        batched = commands_discovery._get_redis_commands_info(redis_client, names)
+        single = [commands_discovery._get_redis_command_info(redis_client, name) for name in names]
+        assert [c.to_dict() for c in batched] == [c.to_dict() for c in single]
+
+def _wait_for_idle_server(pool, timeout=10):
+    import time
+    deadline = time.time() + timeout
+    while not pool._idle:
+        assert time.time() < deadline, "the pool did not warm a server"
+        time.sleep(0.01)
+    return pool._idle[-1]
+
+def test_discovery_server_pool():
+    """Test the pool warms a server, reuses clean ones and replaces recycled ones."""
+    from RAMP.disposableredis import DisposableRedisPool
+    with DisposableRedisPool(size=1) as pool:
+        warm = _wait_for_idle_server(pool)
+        with pool.acquire() as redis_client:
+            pid = redis_client.info('server')['process_id']
+            assert pid == warm.process.pid
+        # nothing was loaded, so the same server comes back
+        with pool.acquire() as redis_client:
+            assert redis_client.info('server')['process_id'] == pid
+
+        # redisgraph can't be unloaded, so its server is recycled and a replacement warmed
+        first = commands_discovery.discover_modules_commands(MODULE_FILE_PATH, "", {}, pool=pool)
+        replacement = _wait_for_idle_server(pool)
+        assert replacement.process.pid != pid
+        second = commands_discovery.discover_modules_commands(MODULE_FILE_PATH, "", {}, pool=pool)
+        assert first.name == second.name
+        assert sorted(c.command_name for c in first.commands) == sorted(c.command_name for c in second.commands)
+        assert replacement.process.returncode is not None
+
+def test_async_discovery():
+    """Test concurrent async discoveries, each on its own server, match the sync discovery."""
+    import asyncio
+    from RAMP.disposableredis.aio import AsyncDisposableRedis
+
+    async def discover_all():
+        server = AsyncDisposableRedis(unix_socket=True)
+        async with server as redis_client:
+            assert await redis_client.ping()
+            private_dir = server.dir
+        assert not os.path.exists(private_dir)
+        return await asyncio.gather(*(commands_discovery.async_discover_modules_commands(MODULE_FILE_PATH, "")
+                                      for _ in range(4)))
+
+    expected = commands_discovery.discover_modules_commands(MODULE_FILE_PATH, "")
+    for module in asyncio.run(discover_all()):
+        assert (module.name, module.version) == (expected.name, expected.version)
+        assert [c.to_dict() for c in module.commands] == [c.to_dict() for c in expected.commands]
+
+def test_redis_version_cache():
+    """Test redis-server version is probed once and persisted in the cache dir."""
+    import tempfile
+    from RAMP import cache, disposableredis
+    with tempfile.TemporaryDirectory() as cache_dir:
+        os.environ[cache.CACHE_DIR_ENVVAR] = cache_dir
+        try:
+            disposableredis._redis_versions.clear()
+            version = disposableredis.get_redis_version()
+            assert version >= 40000
+            versions = cache.load_json(disposableredis.REDIS_VERSIONS_CACHE)
+            assert list(versions.values()) == [version]
+            disposableredis._redis_versions.clear()
+            assert disposableredis.get_redis_version() == version
+        finally:
+            os.environ[cache.CACHE_DIR_ENVVAR] = TEST_CACHE_DIR
+
+def test_unix_socket_redis():
+    """Test DisposableRedis can listen on a private unix socket."""
+    from RAMP.disposableredis import DisposableRedis
+    server = DisposableRedis(unix_socket=True)
+    with server as redis_client:
+        assert redis_client.ping()
+        assert os.path.exists(server.socket_path)
+        private_dir = server.dir
+    assert not os.path.exists(private_dir)
+
+def test_discovery_cache():
+    """Test a discovery is cached and restored with the same commands."""
+    import tempfile
+    from RAMP import cache, discovery_cache
+    with tempfile.TemporaryDirectory() as cache_dir:
+        os.environ[cache.CACHE_DIR_ENVVAR] = cache_dir
+        try:
+            module = commands_discovery.discover_modules_commands(MODULE_FILE_PATH, "", {})
+            key = discovery_cache.discovery_key(sha256_checksum(MODULE_FILE_PATH), "", 70000, {})
+            assert discovery_cache.load(key) is None
+            assert discovery_cache.store(key, module)
+            cached = discovery_cache.load(key)
+            assert (cached.name, cached.version) == (module.name, module.version)
+            assert [c.to_dict() for c in cached.commands] == [c.to_dict() for c in module.commands]
+        finally:
+            os.environ[cache.CACHE_DIR_ENVVAR] = TEST_CACHE_DIR
+
 def test_bundle_from_cmd():
     """
     Test metadata generated from command line arguments is as expected.
@@ -169,6 +278,123 @@ def test_bundle_from_cmd():
     commands = metadata["commands"]
     validate_module_commands(commands)
 
+def test_pack_many():
+    """Test packing several bundles in parallel reports every bundle."""
+    import json
+    import tempfile
+    with tempfile.TemporaryDirectory() as out_dir:
+        entries = [{'module': MODULE_FILE_PATH, 'output': os.path.join(out_dir, 'a.zip')},
+                   {'module': MODULE_FILE_PATH, 'manifest': MENIFEST_FILE_PATH,
+                    'output': os.path.join(out_dir, 'b.zip'), 'args': ['-E', 'graph.BULK']}]
+        entries_file = os.path.join(out_dir, 'entries.json')
+        with open(entries_file, 'w') as f:
+            json.dump(entries, f)
+        summary_file = os.path.join(out_dir, 'summary.json')
+
+        runner = CliRunner()
+        result = runner.invoke(ramp.ramp, ['pack-many', entries_file, '-j', '2', '-s', summary_file])
+        assert result.exit_code == 0
+
+        with open(summary_file) as f:
+            summary = json.load(f)
+        assert summary['failed'] == 0
+        assert [r['bundle'] for r in summary['bundles']] == [e['output'] for e in entries]
+        for entry in entries:
+            assert unpacker.unpack(entry['output'])[0]["module_name"] == "graph"
+
+        # without --summary, stdout holds nothing but the summary: the workers print to stderr
+        import subprocess
+        import sys
+        process = subprocess.run([sys.executable, '-m', 'RAMP.ramp', 'pack-many', entries_file, '-j', '2'],
+                                 stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+        assert process.returncode == 0, process.stderr
+        summary = json.loads(process.stdout)
+        assert [r['bundle'] for r in summary['bundles']] == [e['output'] for e in entries]
+        for entry in entries:
+            assert entry['output'] in process.stderr
+
+def test_build_cache():
+    """Test packing the same inputs twice restores the first bundle."""
+    import json
+    import tempfile
+    from RAMP import cache
+    with tempfile.TemporaryDirectory() as cache_dir:
+        os.environ[cache.CACHE_DIR_ENVVAR] = cache_dir
+        try:
+            runner = CliRunner()
+            argv = [MODULE_FILE_PATH, '-m', MENIFEST_FILE_PATH, '-o', BUNDLE_ZIP_FILE, '--build-cache']
+            assert runner.invoke(ramp.pack, argv).exit_code == 0
+            with open(BUNDLE_ZIP_FILE, 'rb') as f:
+                first = f.read()
+            mode = os.stat(BUNDLE_ZIP_FILE).st_mode
+            assert runner.invoke(ramp.pack, argv).exit_code == 0
+            with open(BUNDLE_ZIP_FILE, 'rb') as f:
+                assert f.read() == first
+            # the restored bundle is a copy with the mode of a built one, not a link to the read only entry
+            assert os.stat(BUNDLE_ZIP_FILE).st_mode == mode
+            assert os.stat(BUNDLE_ZIP_FILE).st_nlink == 1
+
+            stats = json.loads(runner.invoke(ramp.ramp, ['cache-stats']).output)
+            assert (stats['hits'], stats['misses'], stats['bundles']) == (1, 1, 1)
+
+            # a changed input is a miss
+            assert runner.invoke(ramp.pack, argv + ['-a', 'someone else']).exit_code == 0
+            assert unpacker.unpack(BUNDLE_ZIP_FILE)[0]['author'] == 'someone else'
+            os.remove(BUNDLE_ZIP_FILE)
+        finally:
+            os.environ[cache.CACHE_DIR_ENVVAR] = TEST_CACHE_DIR
+
+def test_pack_timings():
+    """Test --timings-file records the phases of a pack."""
+    import json
+    import tempfile
+    with tempfile.TemporaryDirectory() as temp_dir:
+        timings_file = os.path.join(temp_dir, 'timings.json')
+        runner = CliRunner()
+        result = runner.invoke(ramp.pack, [MODULE_FILE_PATH, '-m', MENIFEST_FILE_PATH, '-o', BUNDLE_ZIP_FILE,
+                                           '--no-discovery-cache', '--no-build-cache',
+                                           '--timings-file', timings_file, '--timings-format', 'chrome'])
+        assert result.exit_code == 0, result.output
+        with open(timings_file) as f:
+            events = json.load(f)['traceEvents']
+        names = set(e['name'] for e in events)
+        for phase in ['pack', 'default metadata', 'git rev-parse', 'discovery', 'redis spawn', 'redis ready',
+                      'MODULE LOAD', 'COMMAND INFO', 'archive', 'compress module']:
+            assert phase in names, phase
+        assert all(e['ph'] == 'X' and e['dur'] >= 0 for e in events)
+        os.remove(BUNDLE_ZIP_FILE)
+
+def test_static_discovery():
+    """Test static discovery finds the commands dynamic discovery finds, without redis."""
+    from RAMP import static_discovery
+    dynamic = commands_discovery.discover_modules_commands(MODULE_FILE_PATH, "")
+    try:
+        static_discovery.discover_modules_commands(MODULE_FILE_PATH, {'version': MODULE_VERSION})
+        assert False, "commands without hints were accepted"
+    except Exception as e:
+        assert 'allow_unknown' in str(e)
+    static = static_discovery.discover_modules_commands(MODULE_FILE_PATH, {'version': MODULE_VERSION,
+                                                                            'allow_unknown': True})
+    assert static.name == dynamic.name
+    assert static.version == dynamic.version
+    assert [cmd.command_name for cmd in static.commands] == [cmd.command_name for cmd in dynamic.commands]
+    for cmd in static.commands:
+        assert 'module' in cmd.flags
+
+    import tempfile
+    with tempfile.NamedTemporaryFile('w', suffix='.yml') as manifest:
+        manifest.write('static_discovery:\n    version: {}\n    allow_unknown: true\n'.format(MODULE_VERSION))
+        manifest.flush()
+        runner = CliRunner()
+        result = runner.invoke(ramp.pack, [MODULE_FILE_PATH, '-m', manifest.name, '-o', BUNDLE_ZIP_FILE,
+                                           '--static-discovery', '--no-build-cache'],
+                               env={'REDIS_PATH': '/nonexistent/redis-server'})
+    assert result.exit_code == 0, result.output
+    metadata = unpacker.unpack(BUNDLE_ZIP_FILE)[0]
+    assert metadata["module_name"] == "graph"
+    assert [cmd["command_name"] for cmd in metadata["commands"]] == [cmd.command_name for cmd in dynamic.commands]
+    os.remove(BUNDLE_ZIP_FILE)
+
 def _test_bundle_from_manifest(manifest_file, manifest_file_path):
     """
     Test metadata generated from menifest file is as expected.
@@ -259,7 +485,17 @@ def test_cli_unpack():
 
 if __name__ == '__main__':
     test_defaults()
+    test_batched_command_info()
+    test_discovery_server_pool()
+    test_async_discovery()
+    test_redis_version_cache()
+    test_unix_socket_redis()
+    test_discovery_cache()
     test_bundle_from_manifest()
     test_bundle_from_cmd()
+    test_pack_many()
+    test_build_cache()
+    test_pack_timings()
+    test_static_discovery()
     test_cli_unpack()
     print("PASS")
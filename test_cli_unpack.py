@@ -8,7 +8,7 @@ import os
 import tempfile
 import shutil
 from click.testing import CliRunner
-from RAMP import ramp
+from RAMP import ramp, packer, module_metadata
 
 
 def test_cli_unpack_binary_files():
@@ -87,6 +87,172 @@ def test_cli_unpack_binary_files():
             os.chdir(original_cwd)
 
 
+def test_cli_unpack_streams_module():
+    """Test CLI unpack writes the module byte for byte, newlines included."""
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        original_cwd = os.getcwd()
+        module_path = os.path.join(temp_dir, "synthetic.so")
+        module_data = b'\x7fELF' + (b'\n' + os.urandom(1000)) * 5000
+        with open(module_path, 'wb') as f:
+            f.write(module_data)
+        bundle_path = os.path.join(temp_dir, "synthetic.zip")
+        metadata = module_metadata.create_default_metadata(module_path)
+        metadata['module_name'] = 'synthetic'
+        metadata['dependencies'] = {}
+        packer.archive(module_path, metadata, archive_name=bundle_path)
+
+        out_dir = os.path.join(temp_dir, "out")
+        os.mkdir(out_dir)
+        try:
+            os.chdir(out_dir)
+            runner = CliRunner()
+            result = runner.invoke(ramp.unpack, [bundle_path])
+            assert result.exit_code == 0, result.output
+
+            assert sorted(os.listdir('.')) == ['synthetic.json', 'synthetic.so']
+            with open('synthetic.so', 'rb') as f:
+                assert f.read() == module_data
+
+            result = runner.invoke(ramp.validate, [bundle_path])
+            assert result.exit_code == 0
+            assert "package is valid" in result.output
+
+            with open(bundle_path, 'rb') as f:
+                result = runner.invoke(ramp.validate, ['-'], input=f.read())
+            assert result.exit_code == 0
+            assert "package is valid" in result.output
+        finally:
+            os.chdir(original_cwd)
+
+    print("✅ CLI unpack streaming test passed!")
+
+
+def test_cli_validate_many():
+    """Test CLI validate reports every bundle matched by the given globs."""
+    import json
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        module_path = os.path.join(temp_dir, "synthetic.so")
+        with open(module_path, 'wb') as f:
+            f.write(b'\x7fELF' + os.urandom(4096))
+        for i in range(3):
+            metadata = module_metadata.create_default_metadata(module_path)
+            metadata['module_name'] = 'synthetic'
+            metadata['dependencies'] = {}
+            packer.archive(module_path, metadata, archive_name=os.path.join(temp_dir, "bundle%d.zip" % i))
+        with open(os.path.join(temp_dir, "broken.zip"), 'wb') as f:
+            f.write(b'not a zip')
+
+        runner = CliRunner()
+        result = runner.invoke(ramp.validate, [os.path.join(temp_dir, "bundle*.zip"), '--json', '-j', '2'])
+        assert result.exit_code == 0, result.output
+        report = json.loads(result.output)
+        assert report['invalid'] == 0
+        assert [os.path.basename(r['bundle']) for r in report['bundles']] == ["bundle0.zip", "bundle1.zip", "bundle2.zip"]
+
+        result = runner.invoke(ramp.validate, [os.path.join(temp_dir, "*.zip"), '--json'])
+        assert result.exit_code == 1
+        report = json.loads(result.output)
+        assert report['invalid'] == 1
+        assert [r['status'] for r in report['bundles']] == ['invalid', 'valid', 'valid', 'valid']
+
+    print("✅ CLI validate many test passed!")
+
+
+def test_cli_delta():
+    """Test CLI delta creates a delta bundle which unpack restores against the old bundle."""
+    with tempfile.TemporaryDirectory() as temp_dir:
+        modules = {}
+        old_data = b'\x7fELF' + os.urandom(64 * 1024)
+        for version, data in [('old', old_data), ('new', old_data[:30000] + b'patched' + old_data[30000:])]:
+            module_path = os.path.join(temp_dir, version, "synthetic.so")
+            os.makedirs(os.path.dirname(module_path))
+            with open(module_path, 'wb') as f:
+                f.write(data)
+            modules[version] = data
+            metadata = module_metadata.create_default_metadata(module_path)
+            metadata['module_name'] = 'synthetic'
+            metadata['dependencies'] = {}
+            packer.archive(module_path, metadata, archive_name=os.path.join(temp_dir, version + ".zip"))
+
+        runner = CliRunner()
+        old_bundle, new_bundle = os.path.join(temp_dir, "old.zip"), os.path.join(temp_dir, "new.zip")
+        result = runner.invoke(ramp.ramp, ['delta', old_bundle, new_bundle])
+        assert result.exit_code == 0, result.output
+        delta_bundle = os.path.join(temp_dir, "new.delta.zip")
+        assert os.path.getsize(delta_bundle) < os.path.getsize(new_bundle) / 4
+
+        out_dir = os.path.join(temp_dir, "out")
+        os.mkdir(out_dir)
+        original_cwd = os.getcwd()
+        os.chdir(out_dir)
+        try:
+            result = runner.invoke(ramp.unpack, [delta_bundle])
+            assert result.exit_code != 0 and '--base' in result.output
+            with open(delta_bundle, 'rb') as f:
+                delta_data = f.read()
+            result = runner.invoke(ramp.unpack, ['-'], input=delta_data)
+            assert result.exit_code != 0 and '--base' in result.output
+            result = runner.invoke(ramp.unpack, ['-', '--base', old_bundle], input=delta_data)
+            assert result.exit_code == 0, result.output
+            os.remove("synthetic.so")
+            result = runner.invoke(ramp.unpack, [delta_bundle, '--base', new_bundle])
+            assert result.exit_code != 0
+            assert not os.path.exists("synthetic.so")
+
+            result = runner.invoke(ramp.unpack, [delta_bundle, '--base', old_bundle])
+            assert result.exit_code == 0, result.output
+            with open("synthetic.so", 'rb') as f:
+                assert f.read() == modules['new']
+
+            # without dependencies, the old module alone is enough
+            os.remove("synthetic.so")
+            result = runner.invoke(ramp.unpack, [delta_bundle, '--base', os.path.join(temp_dir, 'old', 'synthetic.so')])
+            assert result.exit_code == 0, result.output
+            with open("synthetic.so", 'rb') as f:
+                assert f.read() == modules['new']
+        finally:
+            os.chdir(original_cwd)
+
+    print("✅ CLI delta test passed!")
+
+
+def test_cli_lazy_imports():
+    """Test the CLI only loads the modules a command needs."""
+    import subprocess
+    import sys
+    from RAMP import catalog, timings
+
+    assert ramp.COMPRESSION_CHOICES == sorted(packer.COMPRESSIONS)
+    assert ramp.CATALOG_FILE == catalog.CATALOG_FILE
+    assert ramp.TIMINGS_FORMATS == timings.FORMATS
+
+    heavy = ['redis', 'yaml', 'semantic_version', 'distro', 'tarfile', 'sqlite3', 'RAMP.packer']
+    script = (
+        "import sys\n"
+        "from click.testing import CliRunner\n"
+        "from RAMP import ramp\n"
+        "assert CliRunner().invoke(ramp.ramp, sys.argv[1:]).exit_code == 0\n"
+        "print(' '.join(m for m in %r if m in sys.modules))\n" % heavy
+    )
+    with tempfile.TemporaryDirectory() as temp_dir:
+        module_path = os.path.join(temp_dir, "synthetic.so")
+        with open(module_path, 'wb') as f:
+            f.write(b'\x7fELF' + os.urandom(4096))
+        metadata = module_metadata.create_default_metadata(module_path)
+        metadata['module_name'] = 'synthetic'
+        metadata['dependencies'] = {}
+        bundle_path = os.path.join(temp_dir, "bundle.zip")
+        packer.archive(module_path, metadata, archive_name=bundle_path)
+
+        for argv in [['--help'], ['version'], ['--version'], ['validate', bundle_path]]:
+            out = subprocess.check_output([sys.executable, '-c', script] + argv, universal_newlines=True)
+            assert out.strip() == '', "ramp %s loaded %s" % (' '.join(argv), out.strip())
+
+    print("✅ CLI lazy imports test passed!")
+
+
 def test_cli_unpack_nonexistent_file():
     """Test CLI unpack command handles missing files gracefully."""
     
@@ -107,6 +273,10 @@ if __name__ == '__main__':
     
     try:
         test_cli_unpack_binary_files()
+        test_cli_unpack_streams_module()
+        test_cli_validate_many()
+        test_cli_delta()
+        test_cli_lazy_imports()
         test_cli_unpack_nonexistent_file()
         print("\n🎉 All CLI unpack tests passed!")
     except Exception as e:
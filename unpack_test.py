@@ -1,7 +1,17 @@
+import io
+import sys
+import json
+import time
+import contextlib
+import struct
 import os
 import hashlib
+import tempfile
+import tarfile
+import zipfile
+import shutil
 
-from RAMP import packer, unpacker, module_metadata
+from RAMP import packer, unpacker, module_metadata, catalog, timings, static_discovery, delta
 
 MODULE_FILE = "redisgraph.so"
 MODULE_FILE_PATH = os.path.join(os.getcwd() + "/test_module", MODULE_FILE)
@@ -32,12 +42,825 @@ def test_valid_bundle():
     path_to_bundle = os.path.join(os.getcwd(), BUNDLE_ZIP_FILE)
     metadata = module_metadata.create_default_metadata(module_path)
     metadata['module_name'] = 'module_name'
+    metadata['dependencies'] = {}
 
     packer.archive(module_path, metadata)
     metadata, binary, files = unpacker.unpack(path_to_bundle)
     assert metadata is not None
     assert binary is not None
-    assert files is None
+    assert files == {}
+
+
+def _synthetic_module(directory, size=256 * 1024):
+    """Writes a fake module binary, returns its path"""
+    path = os.path.join(directory, "synthetic.so")
+    with open(path, 'wb') as f:
+        f.write(b'\x7fELF' + os.urandom(size))
+    return path
+
+
+def _synthetic_dependency(directory, name, size=1024):
+    """Writes a fake dependency directory holding lib/lib<name>.so, returns its path"""
+    path = os.path.join(directory, name)
+    os.makedirs(os.path.join(path, 'lib'))
+    with open(os.path.join(path, 'lib', 'lib%s.so' % name), 'wb') as f:
+        f.write(os.urandom(size))
+    return path
+
+
+def _archive_module(module_path, bundle_path, dependencies=None, checksum=True, overrides=None, **kwargs):
+    """
+    Bundles module_path as module_name to bundle_path, with dependencies ({name: local directory})
+    embedded, overrides replacing the default metadata and kwargs passed on to packer.archive.
+    Returns the metadata it was archived with.
+    """
+    metadata = module_metadata.create_default_metadata(module_path, checksum=checksum)
+    metadata['module_name'] = 'module_name'
+    metadata['dependencies'] = {name: {'url': 'http://example.com/%s.tgz' % name, 'local_path': path}
+                                for name, path in (dependencies or {}).items()}
+    metadata.update(overrides or {})
+    packer.archive(module_path, metadata, archive_name=bundle_path, **kwargs)
+    return metadata
+
+
+def test_archive_computes_checksum():
+    """
+    test the module checksum is filled in while archiving
+    """
+    with tempfile.TemporaryDirectory() as temp_dir:
+        module_path = _synthetic_module(temp_dir)
+        path_to_bundle = os.path.join(temp_dir, BUNDLE_ZIP_FILE)
+        assert module_metadata.create_default_metadata(module_path, checksum=False)['sha256'] is None
+
+        _archive_module(module_path, path_to_bundle, checksum=False)
+        metadata, binary, files = unpacker.unpack(path_to_bundle)
+        assert metadata['sha256'] == sha256_checksum(module_path)
+        with open(module_path, 'rb') as f:
+            assert binary.read() == f.read()
+
+
+def test_archive_local_dependencies():
+    """
+    test local_path dependencies are embedded as hashed tarballs,
+    both streamed (single dependency) and built concurrently
+    """
+    for deps_count in (1, 3):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            module_path = _synthetic_module(temp_dir)
+            path_to_bundle = os.path.join(temp_dir, BUNDLE_ZIP_FILE)
+            dependencies = {}
+            for i in range(deps_count):
+                dependencies['runtime%d' % i] = _synthetic_dependency(temp_dir, 'runtime%d' % i, 64 * 1024)
+                # packed as a link, like tar does, whether it resolves or not
+                os.symlink('missing.so', os.path.join(dependencies['runtime%d' % i], 'lib', 'dangling.so'))
+            _archive_module(module_path, path_to_bundle, dependencies)
+            metadata, binary, files = unpacker.unpack(path_to_bundle)
+            assert sorted(files) == ['deps/runtime%d.tgz' % i for i in range(deps_count)]
+            for i in range(deps_count):
+                dep = metadata['dependencies']['runtime%d' % i]
+                assert 'local_path' not in dep
+                data = files['deps/runtime%d.tgz' % i].read()
+                assert hashlib.sha256(data).hexdigest() == dep['sha256']
+                tgz_path = os.path.join(temp_dir, 'runtime.tgz')
+                with open(tgz_path, 'wb') as f:
+                    f.write(data)
+                with tarfile.open(tgz_path) as tar:
+                    assert 'runtime%d/lib/libruntime%d.so' % (i, i) in tar.getnames()
+                    assert tar.getmember('runtime%d/lib/dangling.so' % i).issym()
+
+
+def test_archive_compressions():
+    """
+    test bundles can be packed and unpacked with every compression
+    """
+    with tempfile.TemporaryDirectory() as temp_dir:
+        module_path = _synthetic_module(temp_dir)
+        dependencies = {'runtime': _synthetic_dependency(temp_dir, 'runtime')}
+        with open(module_path, 'rb') as f:
+            module_data = f.read()
+        for compression in packer.COMPRESSIONS:
+            path_to_bundle = os.path.join(temp_dir, compression + '.zip')
+            _archive_module(module_path, path_to_bundle, dependencies, compression=compression)
+
+            with zipfile.ZipFile(path_to_bundle) as zf:
+                assert zf.getinfo('synthetic.so').compress_type == packer.COMPRESSIONS[compression]
+                assert zf.getinfo('deps/runtime.tgz').compress_type == zipfile.ZIP_STORED
+            metadata, binary, files = unpacker.unpack(path_to_bundle)
+            assert binary.read() == module_data
+
+
+def test_reproducible_archive():
+    """
+    test packing the same inputs twice in reproducible mode gives byte identical bundles,
+    even when the files' timestamps and permissions changed in between
+    """
+    with tempfile.TemporaryDirectory() as temp_dir:
+        module_path = _synthetic_module(temp_dir)
+        os.chmod(module_path, 0o755)
+        dep_dirs = {name: _synthetic_dependency(temp_dir, name, 4096) for name in ['runtime', 'assets']}
+
+        bundles = []
+        for i in range(2):
+            path_to_bundle = os.path.join(temp_dir, 'module%d.zip' % i)
+            _archive_module(module_path, path_to_bundle, dep_dirs, reproducible=True)
+            with open(path_to_bundle, 'rb') as f:
+                bundles.append(f.read())
+
+            # a later checkout of the same sources
+            for root, _, files in os.walk(temp_dir):
+                for name in files:
+                    os.utime(os.path.join(root, name), (1234567890 + i, 1234567890 + i))
+            os.chmod(module_path, 0o700)
+
+        assert bundles[0] == bundles[1]
+        with zipfile.ZipFile(io.BytesIO(bundles[0])) as zf:
+            assert set(info.date_time for info in zf.infolist()) == {(1980, 1, 1, 0, 0, 0)}
+            assert [info.filename for info in zf.infolist()] == \
+                ['synthetic.so', 'deps/assets.tgz', 'deps/runtime.tgz', 'module.json']
+            with tarfile.open(fileobj=zf.open('deps/runtime.tgz'), mode='r:gz') as tar:
+                assert set((m.mtime, m.uid, m.uname) for m in tar.getmembers()) == {(packer.REPRODUCIBLE_EPOCH, 0, '')}
+
+
+def test_archive_timings():
+    """
+    test archiving records a span per phase while timings are enabled, and none otherwise
+    """
+    with tempfile.TemporaryDirectory() as temp_dir:
+        module_path = _synthetic_module(temp_dir)
+        dependencies = {'runtime': _synthetic_dependency(temp_dir, 'runtime')}
+
+        timings.enable()
+        try:
+            _archive_module(module_path, os.path.join(temp_dir, 'module.zip'), dependencies)
+            spans = timings.spans()
+            timings.write(os.path.join(temp_dir, 'timings.json'))
+        finally:
+            timings.disable()
+
+        assert [(s['name'], s['depth']) for s in spans] == \
+            [('archive', 0), ('compress module', 1), ('dependencies', 1), ('tar dependency', 2)]
+        assert spans[0]['duration'] >= sum(s['duration'] for s in spans if s['depth'] == 1)
+        with open(os.path.join(temp_dir, 'timings.json')) as f:
+            assert [s['name'] for s in json.load(f)['spans']] == [s['name'] for s in spans]
+        assert timings.spans() == []
+
+
+def _synthetic_elf(path, strings, exports, elf_class=2, endian='<'):
+    """Writes a shared object with the given .rodata strings and defined dynamic symbols"""
+    rodata = b''.join(s.encode('ascii') + b'\0' for s in strings)
+    dynstr = b'\0' + b''.join(name.encode('ascii') + b'\0' for name in exports)
+    symbol_format = 'IIIBBH' if elf_class == 1 else 'IBBHQQ'
+    dynsym = b'\0' * struct.calcsize(endian + symbol_format)
+    offset = 1
+    for name in exports:
+        fields = (offset, 0, 0, 0x12, 0, 1) if elf_class == 1 else (offset, 0x12, 0, 1, 0, 0)
+        dynsym += struct.pack(endian + symbol_format, *fields)
+        offset += len(name) + 1
+    shstrtab = b'\0.rodata\0.dynstr\0.dynsym\0.shstrtab\0'
+
+    header_size = 52 if elf_class == 1 else 64
+    blobs = [rodata, dynstr, dynsym, shstrtab]
+    offsets = []
+    offset = header_size
+    for blob in blobs:
+        offsets.append(offset)
+        offset += len(blob)
+    shoff = offset
+    section_format = 'IIIIIIIIII' if elf_class == 1 else 'IIQQQQIIQQ'
+    sections = [(0, 0, 0, 0, 0, 0, 0, 0, 0, 0),
+                (1, 1, 2, 0, offsets[0], len(rodata), 0, 0, 1, 0),
+                (9, 3, 2, 0, offsets[1], len(dynstr), 0, 0, 1, 0),
+                (17, 11, 2, 0, offsets[2], len(dynsym), 2, 1, 8, struct.calcsize(endian + symbol_format)),
+                (25, 3, 0, 0, offsets[3], len(shstrtab), 0, 0, 1, 0)]
+    ident = b'\x7fELF' + bytes([elf_class, 1 if endian == '<' else 2, 1]) + b'\0' * 9
+    address = 'I' if elf_class == 1 else 'Q'
+    header = ident + struct.pack(endian + 'HHI' + address * 3 + 'IHHHHHH', 3, 183, 1, 0, 0, shoff, 0,
+                                 header_size, 0, 0, struct.calcsize(endian + section_format), len(sections), 4)
+    with open(path, 'wb') as f:
+        f.write(header + b''.join(blobs))
+        for section in sections:
+            f.write(struct.pack(endian + section_format, *section))
+    return path
+
+
+def test_static_discovery():
+    """
+    test commands, name and version are recovered from the module binary, whatever its class and byte order
+    """
+    strings = ['graph', 'GRAPH.QUERY', 'GRAPH.DELETE', 'GRAPH.EXPLAIN', 'graph.c', 'libc.so', '1.0.12',
+               'write deny-oom', 'RedisModule_CreateCommand', 'Failed to %s.%s']
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for elf_class, endian in [(2, '<'), (1, '<'), (2, '>')]:
+            path = _synthetic_elf(os.path.join(temp_dir, 'module.so'), strings, ['RedisModule_OnLoad'],
+                                  elf_class, endian)
+            module = static_discovery.discover_modules_commands(path, {'allow_unknown': True})
+            assert (module.name, module.version) == ('graph', 10012)
+            assert [cmd.command_name for cmd in module.commands] == ['graph.delete', 'graph.explain', 'graph.query']
+            assert all(cmd.command_arity == -1 and cmd.flags == ['module'] for cmd in module.commands)
+
+        # commands without hints would be packed with made up key positions
+        try:
+            static_discovery.discover_modules_commands(path)
+            assert False, "commands without hints were accepted"
+        except Exception as e:
+            assert 'allow_unknown' in str(e) and 'graph.delete graph.explain graph.query' in str(e)
+
+        hints = {'module_name': 'graph', 'version': 20000, 'allow_unknown': True,
+                 'commands': {'GRAPH.QUERY': {'flags': ['write'], 'first_key': 1, 'last_key': 1, 'step': 1},
+                              'GRAPH.LIST': {'flags': ['readonly']}}}
+        module = static_discovery.discover_modules_commands(path, hints)
+        assert module.version == 20000
+        commands = {cmd.command_name: cmd.to_dict() for cmd in module.commands}
+        assert sorted(commands) == ['graph.delete', 'graph.explain', 'graph.list', 'graph.query']
+        assert commands['graph.query'] == {'command_name': 'graph.query', 'command_arity': -1,
+                                           'flags': ['write', 'module'], 'first_key': 1, 'last_key': 1, 'step': 1}
+
+        path = _synthetic_elf(os.path.join(temp_dir, 'lib.so'), strings, ['inflate'])
+        try:
+            static_discovery.discover_modules_commands(path)
+            assert False, "a shared object which is not a module was accepted"
+        except Exception as e:
+            assert 'RedisModule_OnLoad' in str(e)
+
+
+@contextlib.contextmanager
+def _sandbox(redis_path=None):
+    """
+    Points the RAMP cache and temporary files at a private directory, and REDIS_PATH at redis_path if given.
+    Yields the temporary files directory.
+    """
+    from RAMP.cache import CACHE_DIR_ENVVAR
+    from RAMP.disposableredis import REDIS_PATH_ENVVAR
+    original_tempdir = tempfile.tempdir
+    original_environ = {k: os.environ.get(k) for k in (REDIS_PATH_ENVVAR, CACHE_DIR_ENVVAR)}
+    with tempfile.TemporaryDirectory() as sandbox:
+        tempfile.tempdir = os.path.join(sandbox, 'tmp')
+        os.mkdir(tempfile.tempdir)
+        if redis_path is not None:
+            os.environ[REDIS_PATH_ENVVAR] = redis_path
+        os.environ[CACHE_DIR_ENVVAR] = os.path.join(sandbox, 'cache')
+        try:
+            yield tempfile.tempdir
+        finally:
+            tempfile.tempdir = original_tempdir
+            for key, value in original_environ.items():
+                if value is None:
+                    os.environ.pop(key, None)
+                else:
+                    os.environ[key] = value
+
+# Reports a version, then accepts connections on its unix socket (if any) without ever answering
+SILENT_REDIS_SERVER = """#!{python}
+import socket, sys, time
+if '--version' in sys.argv:
+    print('Redis server v=7.2.4 sha=00000000:0 malloc=libc bits=64 build=0')
+    sys.exit(0)
+if '--unixsocket' in sys.argv:
+    server = socket.socket(socket.AF_UNIX)
+    server.bind(sys.argv[sys.argv.index('--unixsocket') + 1])
+    server.listen(8)
+time.sleep(60)
+"""
+
+def test_disposable_redis_missing_binary():
+    """
+    test a redis-server which can't be run leaves no private directory behind
+    """
+    from RAMP.disposableredis import DisposableRedis
+    with tempfile.TemporaryDirectory() as temp_dir, \
+            _sandbox(os.path.join(temp_dir, 'no-such-redis-server')) as sandbox_tmp:
+        try:
+            with DisposableRedis():
+                pass
+            assert False, "started a missing redis-server"
+        except OSError:
+            pass
+        assert os.listdir(sandbox_tmp) == []
+
+def test_disposable_redis_startup_timeout():
+    """
+    test a server which never answers is given up on after startup_timeout, and cleaned up
+    """
+    from RAMP.disposableredis import DisposableRedis
+    with tempfile.TemporaryDirectory() as temp_dir:
+        redis_path = os.path.join(temp_dir, 'redis-server')
+        with open(redis_path, 'w') as f:
+            f.write(SILENT_REDIS_SERVER.format(python=sys.executable))
+        os.chmod(redis_path, 0o755)
+
+        with _sandbox(redis_path) as sandbox_tmp:
+            # over TCP nothing listens, over the unix socket nothing answers
+            for unix_socket in (False, True):
+                server = DisposableRedis(startup_timeout=0.5, unix_socket=unix_socket)
+                started = time.time()
+                try:
+                    with server:
+                        pass
+                    assert False, "a silent server became ready"
+                except RuntimeError as e:
+                    assert 'did not become ready' in str(e)
+                assert time.time() - started < 5
+                assert server.process.returncode is not None
+                assert server.dir is None
+                assert os.listdir(sandbox_tmp) == []
+
+
+def test_disposable_redis_long_socket_path():
+    """
+    test a unix socket path too long for the platform makes the server listen on TCP instead
+    """
+    from RAMP.disposableredis import DisposableRedis
+    with tempfile.TemporaryDirectory() as temp_dir:
+        redis_path = os.path.join(temp_dir, 'redis-server')
+        with open(redis_path, 'w') as f:
+            f.write(SILENT_REDIS_SERVER.format(python=sys.executable))
+        os.chmod(redis_path, 0o755)
+
+        with _sandbox(redis_path) as sandbox_tmp:
+            tempfile.tempdir = os.path.join(sandbox_tmp, 'x' * 100)
+            os.mkdir(tempfile.tempdir)
+            server = DisposableRedis(startup_timeout=0.5, unix_socket=True)
+            try:
+                with server:
+                    pass
+                assert False, "a silent server became ready"
+            except RuntimeError as e:
+                # rather than exiting because the socket can't be bound
+                assert 'did not become ready' in str(e)
+            assert not server.unix_socket and server.socket_path is None and server.port
+
+
+class _CountingFile(object):
+    """Wraps a file, adding the bytes read through it to counts['read']"""
+    def __init__(self, f, counts):
+        self._f = f
+        self._counts = counts
+
+    def read(self, *args):
+        data = self._f.read(*args)
+        self._counts['read'] += len(data)
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self._f, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self._f.close()
+
+
+class _CountingHash(object):
+    """Wraps a sha256, adding the bytes hashed through it to counts['hashed']"""
+    def __init__(self, new, counts, data=b''):
+        self._h = new()
+        self._counts = counts
+        self.update(data)
+
+    def update(self, data):
+        self._counts['hashed'] += len(data)
+        self._h.update(data)
+
+    def __getattr__(self, name):
+        return getattr(self._h, name)
+
+
+@contextlib.contextmanager
+def _count_io(path):
+    """
+    Counts the bytes read from path, and hashed with sha256 (whatever the data), while the block runs.
+    """
+    import builtins
+    counts = {'read': 0, 'hashed': 0}
+    real_open, real_sha256 = builtins.open, hashlib.sha256
+    path = os.path.realpath(path)
+
+    def counting_open(file, mode='r', *args, **kwargs):
+        f = real_open(file, mode, *args, **kwargs)
+        if isinstance(file, str) and 'b' in mode and os.path.realpath(file) == path:
+            return _CountingFile(f, counts)
+        return f
+
+    builtins.open = counting_open
+    hashlib.sha256 = lambda *args: _CountingHash(real_sha256, counts, *args)
+    try:
+        yield counts
+    finally:
+        builtins.open, hashlib.sha256 = real_open, real_sha256
+
+
+def test_package_module_reads():
+    """
+    test how often a pack reads and hashes the module: a default pack hashes it for the cache keys and
+    while archiving, a repack of an unchanged module only while archiving, a build cache hit not at all
+    """
+    from RAMP import ramp
+    strings = ['graph', 'GRAPH.QUERY', '1.0.12']
+    size = 1024 * 1024
+    # static discovery reads a few headers and sections, anything below this is not a full read
+    small = 64 * 1024
+    with tempfile.TemporaryDirectory() as temp_dir, _sandbox():
+        module_path = _synthetic_elf(os.path.join(temp_dir, 'graph.so'), strings, ['RedisModule_OnLoad'])
+        with open(module_path, 'ab') as f:
+            f.write(os.urandom(size - os.path.getsize(module_path)))
+        path_to_bundle = os.path.join(temp_dir, BUNDLE_ZIP_FILE)
+        manifest = os.path.join(temp_dir, 'ramp.yml')
+        with open(manifest, 'w') as f:
+            f.write('static_discovery:\n    commands:\n        GRAPH.QUERY: {first_key: 1, last_key: 1, step: 1}\n')
+
+        def pack(*extra_args):
+            argv = [module_path, '-m', manifest, '-o', path_to_bundle, '--static-discovery'] + list(extra_args)
+            with ramp.pack.make_context('pack', argv) as ctx, _count_io(module_path) as counts:
+                packer.package(ctx.params.pop('module'), **ctx.params)
+            return counts
+
+        # read and hashed for the cache keys, then into the bundle
+        counts = pack()
+        assert 2 * size <= counts['read'] < 2 * size + small
+        assert 2 * size <= counts['hashed'] < 2 * size + small
+        assert unpacker.unpack(path_to_bundle)[0]['sha256'] == sha256_checksum(module_path)
+
+        # the digest is remembered, the module is only read into the bundle
+        counts = pack('--build-cache')
+        assert size <= counts['read'] < size + small
+        assert size <= counts['hashed'] < size + small
+
+        # the bundle is restored from the build cache without reading the module at all
+        counts = pack('--build-cache')
+        assert counts['read'] == 0
+
+
+def test_static_discovery_name_hint():
+    """
+    test static discovery is only told the module name from the manifest, -n just names the package
+    """
+    from RAMP import ramp
+    strings = ['graph', 'GRAPH.QUERY', '1.0.12']
+    with tempfile.TemporaryDirectory() as temp_dir, _sandbox():
+        module_path = _synthetic_elf(os.path.join(temp_dir, 'graph.so'), strings, ['RedisModule_OnLoad'])
+        path_to_bundle = os.path.join(temp_dir, BUNDLE_ZIP_FILE)
+        manifest = os.path.join(temp_dir, 'ramp.yml')
+        discover_modules_commands = static_discovery.discover_modules_commands
+        given = []
+
+        def pack(manifest_lines, *extra_args):
+            with open(manifest, 'w') as f:
+                f.write('\n'.join(['static_discovery:', '    allow_unknown: true'] + manifest_lines) + '\n')
+            argv = [module_path, '-m', manifest, '-o', path_to_bundle, '--static-discovery'] + list(extra_args)
+            with ramp.pack.make_context('pack', argv) as ctx:
+                packer.package(ctx.params.pop('module'), **ctx.params)
+            return given.pop()['module_name'], unpacker.unpack(path_to_bundle)[0]['module_name']
+
+        static_discovery.discover_modules_commands = lambda path, hints: \
+            given.append(dict(hints, module_name=hints.get('module_name'))) or discover_modules_commands(path, hints)
+        try:
+            assert pack([], '-n', 'display') == (None, 'display')
+            assert pack(['module_name: graph'], '-n', 'display') == ('graph', 'display')
+            assert pack(['module_name: graph']) == ('graph', 'graph')
+        finally:
+            static_discovery.discover_modules_commands = discover_modules_commands
+
+
+def test_archive_checks_precomputed_checksum():
+    """
+    test a module which doesn't match the digest computed upfront fails the pack instead of being bundled
+    """
+    with tempfile.TemporaryDirectory() as temp_dir:
+        module_path = _synthetic_module(temp_dir)
+        path_to_bundle = os.path.join(temp_dir, BUNDLE_ZIP_FILE)
+        # the module is rewritten after it was hashed
+        stale = sha256_checksum(module_path)
+        _synthetic_module(temp_dir)
+        try:
+            _archive_module(module_path, path_to_bundle, overrides={'sha256': stale})
+            assert False, "a module not matching its checksum was bundled"
+        except Exception as e:
+            assert 'changed while it was packed' in str(e)
+        assert os.listdir(temp_dir) == ['synthetic.so']
+
+
+def _count_build_cache_hits(times):
+    from RAMP.build_cache import BuildCache
+    for _ in range(times):
+        BuildCache()._count('hits')
+
+def test_build_cache_entries():
+    """
+    test restored bundles are plain copies, and concurrent processes don't lose counter updates
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    from RAMP.build_cache import BuildCache
+    with tempfile.TemporaryDirectory() as temp_dir, _sandbox():
+        bundle = os.path.join(temp_dir, 'built.zip')
+        with open(bundle, 'wb') as f:
+            f.write(b'bundle')
+        build_cache = BuildCache()
+        assert build_cache.store('key', bundle, 'built.zip')
+        assert build_cache.lookup('key') == 'built.zip'
+
+        restored = os.path.join(temp_dir, 'restored.zip')
+        build_cache.restore('key', restored)
+        assert os.stat(restored).st_nlink == 1
+        assert os.stat(restored).st_mode & 0o777 == os.stat(bundle).st_mode & 0o777
+        with open(restored, 'ab') as f:
+            f.write(b' changed')
+        build_cache.restore('key', os.path.join(temp_dir, 'again.zip'))
+        with open(os.path.join(temp_dir, 'again.zip'), 'rb') as f:
+            assert f.read() == b'bundle'
+
+        with ProcessPoolExecutor(max_workers=4) as executor:
+            list(executor.map(_count_build_cache_hits, [25] * 4))
+        assert build_cache.stats()['hits'] == 1 + 100
+
+def test_build_cache_key():
+    """
+    test the build cache key changes with what goes into the bundle only, not with e.g. --debug
+    or where a local dependency is
+    """
+    with tempfile.TemporaryDirectory() as temp_dir, _sandbox():
+        module_path = _synthetic_module(temp_dir)
+        dependencies = [_synthetic_dependency(os.path.join(temp_dir, 'a'), 'dep'), os.path.join(temp_dir, 'b', 'dep')]
+        shutil.copytree(dependencies[0], dependencies[1])
+
+        def key(dependency=dependencies[0], **changes):
+            metadata = packer.set_defaults(module_path)
+            metadata['dependencies'] = {'dep': {'url': 'http://example.com/dep.tgz', 'local_path': dependency}}
+            metadata.update(changes)
+            return packer._build_key(metadata, '{short_name}.zip', None)
+
+        assert key() is not None
+        assert key(debug=True) == key(debug=False) == key(verbose=True) == key()
+        assert key(dependencies[1]) == key()
+        assert key(compression='lzma') != key()
+        assert key(module_name='renamed') != key()
+        with open(os.path.join(dependencies[1], 'lib.so'), 'ab') as f:
+            f.write(b'changed')
+        assert key(dependencies[1]) != key()
+
+def test_disk_cache_eviction():
+    """
+    test a cache entry's files are evicted together, least recently used first
+    """
+    from RAMP.cache import DiskCache
+    with tempfile.TemporaryDirectory() as temp_dir, _sandbox():
+        disk_cache = DiskCache('entries', 3 * 1024)
+        os.makedirs(disk_cache.path)
+        # (key, mtime of <key>.zip, mtime of <key>.json): the old archive was last used by a recent hit
+        for key, zip_time, json_time in [('old', 0, 1000), ('new', 100, 100), ('third', None, None)]:
+            with open(disk_cache.entry_path(key, '.zip'), 'wb') as f:
+                f.write(b'x' * 1024)
+            assert disk_cache.put_json(key, {})
+            if zip_time is not None:
+                os.utime(disk_cache.entry_path(key, '.zip'), (zip_time, zip_time))
+                os.utime(disk_cache.entry_path(key, '.json'), (json_time, json_time))
+        assert sorted(os.listdir(disk_cache.path)) == ['old.json', 'old.zip', 'third.json', 'third.zip']
+
+def test_tampered_bundle():
+    """
+    test a module not matching its sha256 is detected while it is read
+    """
+    with tempfile.TemporaryDirectory() as temp_dir:
+        module_path = _synthetic_module(temp_dir)
+        path_to_bundle = os.path.join(temp_dir, BUNDLE_ZIP_FILE)
+        _archive_module(module_path, path_to_bundle)
+
+        metadata, binary, files = unpacker.unpack(path_to_bundle)
+        unpacker.verify(binary, files)
+
+        tampered_bundle = os.path.join(temp_dir, 'tampered.zip')
+        with zipfile.ZipFile(path_to_bundle) as src, zipfile.ZipFile(tampered_bundle, 'w') as dst:
+            dst.writestr('module.json', src.read('module.json'))
+            module_data = src.read('synthetic.so')
+            dst.writestr('synthetic.so', module_data[:-1] + bytes([module_data[-1] ^ 1]))
+        metadata, binary, files = unpacker.unpack(tampered_bundle)
+        try:
+            unpacker.verify(binary, files)
+            assert False, "tampered module passed validation"
+        except unpacker.UnpackerPackageError as e:
+            assert e.error_code == "module_sha256_mismatch"
+
+
+def test_open_bundle():
+    """
+    test bundle entries are listed and opened on demand
+    """
+    with tempfile.TemporaryDirectory() as temp_dir:
+        module_path = _synthetic_module(temp_dir)
+        path_to_bundle = os.path.join(temp_dir, BUNDLE_ZIP_FILE)
+        _archive_module(module_path, path_to_bundle, {'runtime': _synthetic_dependency(temp_dir, 'runtime')})
+
+        with unpacker.open_bundle(path_to_bundle) as bundle:
+            assert bundle.metadata['module_name'] == 'module_name'
+            entries = dict((entry.name, entry) for entry in bundle.entries())
+            assert sorted(entries) == ['deps/runtime.tgz', 'module.json', 'synthetic.so']
+            assert entries['synthetic.so'].kind == 'module'
+            assert entries['synthetic.so'].size == os.path.getsize(module_path)
+            assert entries['synthetic.so'].compressed_size > 0
+            assert bundle.dependencies() == ['deps/runtime.tgz']
+            with bundle.open_module() as module:
+                assert module.read() == open(module_path, 'rb').read()
+            with bundle.open_dependency('deps/runtime.tgz') as dep:
+                assert hashlib.sha256(dep.read()).hexdigest() == bundle.metadata['dependencies']['runtime']['sha256']
+
+
+def test_delta_bundle():
+    """
+    test a delta bundle restores the new module and dependencies from the old bundle
+    """
+    with tempfile.TemporaryDirectory() as temp_dir:
+        old_module = _synthetic_module(temp_dir)
+        with open(old_module, 'rb') as f:
+            data = bytearray(f.read())
+        data[1000:1000] = os.urandom(2000)
+        for offset in range(4096, len(data), 8192):
+            data[offset] ^= 0xff
+        new_module = os.path.join(temp_dir, 'new', 'synthetic.so')
+        os.makedirs(os.path.dirname(new_module))
+        with open(new_module, 'wb') as f:
+            f.write(bytes(data))
+
+        deps = {name: _synthetic_dependency(temp_dir, name) for name in ['runtime', 'assets']}
+        bundles = {}
+        for version, module_path in [('old', old_module), ('new', new_module)]:
+            if version == 'new':
+                with open(os.path.join(deps['assets'], 'lib', 'libassets.so'), 'wb') as f:
+                    f.write(os.urandom(1024))
+            bundles[version] = os.path.join(temp_dir, version + '.zip')
+            _archive_module(module_path, bundles[version], deps, reproducible=True)
+
+        delta_path = os.path.join(temp_dir, 'new.delta.zip')
+        stats = delta.create_delta(bundles['old'], bundles['new'], delta_path)
+        assert stats['delta_bytes'] < stats['bundle_bytes'] / 4
+        assert delta.is_delta(delta_path) and not delta.is_delta(bundles['new'])
+        with zipfile.ZipFile(delta_path) as zf:
+            assert sorted(zf.namelist()) == ['delta.json', 'deps/assets.tgz', 'module.json', 'synthetic.so.patch']
+
+        new_metadata, _, new_deps = unpacker.unpack(bundles['new'])
+        metadata, module, deps_files = delta.open_delta(delta_path, bundles['old'])
+        assert metadata == new_metadata
+        assert module.read() == bytes(data)
+        assert sorted(deps_files) == ['deps/assets.tgz', 'deps/runtime.tgz']
+        for filename, dep in deps_files.items():
+            assert dep.read() == new_deps[filename].read()
+
+        # the old module alone can't supply the dependencies which didn't change
+        try:
+            delta.open_delta(delta_path, old_module)
+            assert False, "a delta was restored without its base dependencies"
+        except unpacker.UnpackerPackageError as e:
+            assert e.error_code == 'delta_base_incomplete'
+
+        for base in [bundles['new'], new_module]:
+            try:
+                delta.open_delta(delta_path, base)
+                assert False, "a delta was applied to the wrong base"
+            except unpacker.UnpackerPackageError as e:
+                assert e.error_code == 'delta_base_mismatch'
+        try:
+            unpacker.unpack(delta_path)
+            assert False, "a delta was unpacked as a bundle"
+        except unpacker.UnpackerPackageError:
+            pass
+
+
+def test_delta_unrelated_module():
+    """
+    test a module sharing nothing with its base is not diffed byte by byte, the full bundle is written instead
+    """
+    with tempfile.TemporaryDirectory() as temp_dir:
+        bundles = []
+        for version in ['old', 'new']:
+            os.makedirs(os.path.join(temp_dir, version))
+            module_path = _synthetic_module(os.path.join(temp_dir, version), size=4 * 1024 * 1024)
+            bundles.append(os.path.join(temp_dir, version + '.zip'))
+            _archive_module(module_path, bundles[-1])
+
+        delta_path = os.path.join(temp_dir, 'new.delta.zip')
+        started = time.time()
+        stats = delta.create_delta(bundles[0], bundles[1], delta_path)
+        assert time.time() - started < 5
+        assert stats['full'] and stats['patch_bytes'] == 0
+        assert not delta.is_delta(delta_path)
+        with open(delta_path, 'rb') as f, open(bundles[1], 'rb') as new_bundle:
+            assert f.read() == new_bundle.read()
+
+        metadata, module, _ = delta.open_delta(delta_path, bundles[0])
+        with open(module_path, 'rb') as f:
+            assert module.read() == f.read()
+
+
+class _NonSeekableStream(io.RawIOBase):
+    """A pipe-like stream over bytes"""
+
+    def __init__(self, data):
+        super(_NonSeekableStream, self).__init__()
+        self._data = io.BytesIO(data)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return False
+
+    def readinto(self, b):
+        return self._data.readinto(b)
+
+
+def test_unpack_memory():
+    """
+    test opening a bundle's entries doesn't allocate read buffers of their size, or of the copy buffer's
+    """
+    import tracemalloc
+    with tempfile.TemporaryDirectory() as temp_dir:
+        module_path = _synthetic_module(temp_dir)
+        path_to_bundle = os.path.join(temp_dir, BUNDLE_ZIP_FILE)
+        _archive_module(module_path, path_to_bundle,
+                        {'dep%d' % i: _synthetic_dependency(temp_dir, 'dep%d' % i) for i in range(3)})
+        tracemalloc.start()
+        try:
+            metadata, binary, files = unpacker.unpack(path_to_bundle)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        assert peak < unpacker.COPY_BUFFER_SIZE
+        unpacker.verify(binary, files)
+
+
+def test_unpack_non_seekable_stream():
+    """
+    test bundles can be read from streams which can't seek, spooled in memory or on disk
+    """
+    with tempfile.TemporaryDirectory() as temp_dir:
+        module_path = _synthetic_module(temp_dir)
+        path_to_bundle = os.path.join(temp_dir, BUNDLE_ZIP_FILE)
+        _archive_module(module_path, path_to_bundle)
+        with open(path_to_bundle, 'rb') as f:
+            bundle_data = f.read()
+        with open(module_path, 'rb') as f:
+            module_data = f.read()
+
+        spools = []
+
+        class TrackedSpool(tempfile.SpooledTemporaryFile):
+            def __init__(self, *args, **kwargs):
+                super(TrackedSpool, self).__init__(*args, **kwargs)
+                spools.append(self)
+
+        real_spool, tempfile.SpooledTemporaryFile = tempfile.SpooledTemporaryFile, TrackedSpool
+        try:
+            # larger than the bundle: kept in memory, smaller: spilled to a temporary file
+            for spool_max_size in (len(bundle_data) * 2, 1024):
+                with unpacker.open_bundle(_NonSeekableStream(bundle_data), spool_max_size) as bundle:
+                    assert bundle.metadata['module_name'] == 'module_name'
+                    module = bundle.open_module()
+                # entries opened remain readable, the copy is closed with the last of them
+                assert not spools[-1].closed
+                with module:
+                    assert module.read() == module_data
+                assert spools[-1].closed
+
+            metadata, binary, files = unpacker.unpack(_NonSeekableStream(bundle_data))
+            with binary:
+                assert binary.read() == module_data
+            assert len(spools) == 3 and spools[-1].closed
+        finally:
+            tempfile.SpooledTemporaryFile = real_spool
+
+
+def test_catalog():
+    """
+    test bundles are indexed incrementally and looked up by their metadata
+    """
+    with tempfile.TemporaryDirectory() as temp_dir:
+        module_path = _synthetic_module(temp_dir, size=1024)
+        bundles_dir = os.path.join(temp_dir, 'bundles')
+        os.mkdir(bundles_dir)
+        for version, arch, os_name, caps in [(10000, 'x86_64', 'rhel9', ['types']),
+                                             (10002, 'aarch64', 'rhel9', ['types', 'flash']),
+                                             (10001, 'aarch64', 'rhel9', ['types', 'flash']),
+                                             (20000, 'aarch64', 'ubuntu22.04', ['types', 'flash'])]:
+            _archive_module(module_path, os.path.join(bundles_dir, '%s-%s-%d.zip' % (os_name, arch, version)),
+                            overrides=dict(module_name='search', version=version, architecture=arch,
+                                           operating_systems=[os_name], capabilities=caps,
+                                           commands=[{'command_name': 'FT.SEARCH'}]))
+
+        db = os.path.join(temp_dir, 'catalog.db')
+        conn = catalog.connect(db)
+        assert catalog.index(conn, [bundles_dir])['added'] == 4
+        assert catalog.index(conn, [bundles_dir])['unchanged'] == 4
+
+        results = catalog.query(conn, module_name='search', os_name='rhel9', architecture='aarch64',
+                                capabilities=['flash'], latest=True)
+        assert [r['version'] for r in results] == [10002]
+        assert len(catalog.query(conn, command='ft.search')) == 4
+        assert len(catalog.query(conn, capabilities=['types', 'flash'])) == 3
+
+        os.remove(os.path.join(bundles_dir, 'rhel9-aarch64-10002.zip'))
+        assert catalog.index(conn, [bundles_dir])['removed'] == 1
+        results = catalog.query(conn, module_name='search', os_name='rhel9', architecture='aarch64', latest=True)
+        assert [r['version'] for r in results] == [10001]
+        conn.close()
 
 
 def test_valid_bundle_with_deps():